@@ -2,6 +2,7 @@ import torch.nn as nn
 from torch import cat, zeros, rand, arange, ger
 from torch.autograd import Variable
 from SelfAtten import SelfAttenModel
+from quantize import float_reference
 
 class PositionalEmbedding(nn.Module):
     def __init__(self, demb):
@@ -25,7 +26,7 @@ class AttenFlvModel(nn.Module):
     """Container module with an encoder, a recurrent module, and a decoder."""
 
     def __init__(self, ninp, nhid, nlayers, nmid,
-                 dropout=0.5, tie_weights=False, reset=0, nhead=1):
+                 dropout=0.5, tie_weights=False, reset=0, nhead=1, direct=False):
         """ntoken: vocabulary size
            ninp: word emb size
            nhid: hidden state size
@@ -34,6 +35,7 @@ class AttenFlvModel(nn.Module):
            dropout: RNN dropout rate
            reset: sentence boundary resetting
            nhead: number of attention heads
+           direct: encode with positional embeddings instead of the LSTM by default
 	"""
         super(AttenFlvModel, self).__init__()
         self.drop = nn.Dropout(dropout)
@@ -41,7 +43,7 @@ class AttenFlvModel(nn.Module):
         self.rnn = nn.LSTM(ninp, nhid, nlayers, dropout=dropout)
         self.pos_emb = PositionalEmbedding(ninp)
         self.emb_drop = nn.Dropout(dropout)
-        self.emb_compressor = nn.Linear(ninp, ninp)
+        self.emb_compressor = nn.Linear(ninp, nhid)
         self.emb_act = nn.ReLU()
 
         self.init_weights()
@@ -51,6 +53,7 @@ class AttenFlvModel(nn.Module):
         self.nlayers = nlayers
         self.ninp = ninp
         self.reset = reset
+        self.direct = direct
         self.mode = 'train'
 
     def set_mode(self, m):
@@ -59,28 +62,41 @@ class AttenFlvModel(nn.Module):
     def init_weights(self):
         initrange = 0.1
 
-    def forward(self, emb, hidden, device='cuda', eosidx=1, direct=False):
+    def forward(self, emb, hidden, device='cuda', eosidx=1, direct=None, reduce=True):
         """emb: input word embedding
            hidden: initial/carries hidden states
            device: cuda or cpu
            eosidx: end of sequence idx
-           direct: use word embeddings directly or after LSTM encoding
+           direct: use word embeddings directly or after LSTM encoding,
+                   None for the setting the model was built with
+           reduce: sum the attention penalty over the batch
         """
+        if direct is None:
+            direct = getattr(self, 'direct', False)
         if direct:
-            # Adding positional encoding
-            pos_seq = arange(input.size(0)-1, -1, -1.0, dtype=emb.dtype).to(device)
-            pos_emb = self.pos_emb(pos_seq, input.size(1))
-            output = self.emb_compressor(cat([emb, pos_emb], 2))
+            # Adding positional encoding, positions count back from the segment end
+            pos_seq = arange(emb.size(0)-1, -1, -1.0, dtype=emb.dtype, device=emb.device)
+            pos_emb = self.pos_emb(pos_seq, emb.size(1))
+            output = self.emb_compressor(emb + pos_emb)
             output = self.emb_act(output)
             output = self.emb_drop(output)
-            output = emb
         else:
             output, hidden = self.rnn(emb, hidden)
-        extracted, penalty = self.selfatten(output.transpose(0,1), device=device, wordlevel=True)
+        extracted, penalty = self.selfatten(output.transpose(0,1), device=device, wordlevel=True, reduce=reduce)
         return extracted, penalty 
 
+    def forward_pair(self, emb, nprev, hidden, device='cuda', eosidx=1, direct=None):
+        """Previous and future context in one call, stacked along the batch
+           emb: [seglen, nprev+npost, ninp] word embeddings, previous segments first
+           nprev: number of previous context segments
+           Returns the pooled vectors and summed penalty of each side:
+           prev_extracted, prev_penalty, post_extracted, post_penalty
+        """
+        extracted, penalty = self.forward(emb, hidden, device=device, eosidx=eosidx, direct=direct, reduce=False)
+        return extracted[:nprev], penalty[:nprev].sum(), extracted[nprev:], penalty[nprev:].sum()
+
     def init_hidden(self, bsz):
-        weight = next(self.parameters())
+        weight = float_reference(self)
         return (weight.new_zeros(self.nlayers, bsz, self.nhid),
                 weight.new_zeros(self.nlayers, bsz, self.nhid))
 
@@ -3,6 +3,7 @@ from torch.utils.data import Dataset, DataLoader
 import torch
 
 from ErrorSampling import ErrorSampling
+from hiercontext import utterance_matrix
 
 class Dictionary(object):
     def __init__(self, dictfile, use_sampling=False, errorfile='', reference='', ratio=1, random=False):
@@ -58,8 +59,10 @@ class Dictionary(object):
 
 
 class LMdata(Dataset):
-    def __init__(self, data_file, dictionary, maxlen_prev, maxlen_post):
-        '''Load data_file'''
+    def __init__(self, data_file, dictionary, maxlen_prev, maxlen_post, uttlen=0):
+        '''Load data_file
+           uttlen: hierarchical context, return the [nutt, uttlen] utterance word
+           ids in place of the previous context windows (and None for the future)'''
         self.data_file = data_file
         self.datascp = []
         with open(self.data_file, 'r') as f:
@@ -68,6 +71,7 @@ class LMdata(Dataset):
         self.dictionary = dictionary
         self.maxlen_prev = maxlen_prev
         self.maxlen_post = maxlen_post
+        self.uttlen = uttlen
 
     def __len__(self):
         return len(self.datascp)
@@ -91,6 +95,9 @@ class LMdata(Dataset):
                 input_seg_file += idx_line
                 sent_ind += [i for j in range(len(idx_line))]
                 sent_list.append(sampled_sent[1:])
+            if self.uttlen > 0:
+                return (torch.LongTensor(input_seg_file), torch.LongTensor(sent_ind),
+                        utterance_matrix(sent_list, self.uttlen, eosidx), None)
             # Second run to get context
             for i, sent in enumerate(sent_list):
                 sent_cursor = i - 1
@@ -127,12 +134,12 @@ def collate_fn(batch):
 def create(datapath, dictfile, batchSize=1,
            shuffle=False, workers=0, maxlen_prev=30,
 	   maxlen_post=30, use_sampling=False, errorfile='', reference='',
-           ratio=1, random=False):
+           ratio=1, random=False, uttlen=0):
     loaders = []
     dictionary = Dictionary(dictfile, use_sampling, errorfile, reference, ratio, random)
     for split in ['train', 'valid', 'test']:
         data_file = os.path.join(datapath, '%s.scp' %split)
-        dataset = LMdata(data_file, dictionary, maxlen_prev, maxlen_post)
+        dataset = LMdata(data_file, dictionary, maxlen_prev, maxlen_post, uttlen)
         loaders.append(DataLoader(dataset=dataset, batch_size=batchSize,
                                   shuffle=shuffle, collate_fn=collate_fn,
                                   num_workers=workers))
@@ -1,7 +1,12 @@
 import torch.nn as nn
-from torch import cat, zeros
+import torch.nn.functional as F
+from torch import cat, zeros, arange
 from torch.autograd import Variable
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from SelfAtten import SelfAttenModel
+from inputproj import ProjectionTable, lstm_scan
+from chunkedce import chunked_cross_entropy
+from quantize import float_reference
 
 class L2RNNModel(nn.Module):
     """Container module with an encoder, a recurrent module, and a decoder."""
@@ -78,35 +83,174 @@ class L2RNNModel(nn.Module):
         self.decoder.bias.data.zero_()
         self.decoder.weight.data.uniform_(-initrange, initrange)
 
-    def forward(self, input, auxiliary, hidden, eosidx = 0, target=None, device='cuda'):
-        emb = self.drop(self.encoder(input))
-        penalty = zeros(1).to(device)
-        bsz = auxiliary.size(0)*auxiliary.size(1)
-        if self.atten:
-            auxiliary_in, penalty = self.selfatten(auxiliary.view(bsz, -1), device=device)
-            if self.nutt * self.nhead != self.naux:
-                auxiliary_in = self.comp4atten(auxiliary_in)
-                auxiliary_in = self.compressDrop(auxiliary_in)
+    def forward(self, input, auxiliary, hidden, eosidx = 0, target=None, device='cuda', outputflag=0, auxind=None):
+        """auxiliary: [seq_len, bsz, naux_in] context vector at each position, or
+           with auxind [nctx, naux_in] distinct context vectors, which are then
+           compressed once each
+           auxind: LongTensor [seq_len, bsz], row of auxiliary used at each position
+        """
+        if auxind is None:
+            bsz = auxiliary.size(0)*auxiliary.size(1)
+            auxiliary_in, penalty = self.compress_context(auxiliary.view(bsz, -1), device=device)
         else:
-            auxiliary_in = self.compressor(auxiliary.view(bsz, auxiliary.size(2)))
-            auxiliary_in = self.compressDrop(auxiliary_in)
-        to_input = cat([auxiliary_in.view(auxiliary.size(0), auxiliary.size(1), -1), emb], 2)
+            auxiliary_in, penalty = self.compress_context(auxiliary, device=device, dropout=False,
+                                                          auxind=auxind.view(-1))
+            # the dropout mask is still drawn per position
+            auxiliary_in = self.drop_context(auxiliary_in[auxind.view(-1)])
+        auxiliary_in = auxiliary_in.view(input.size(0), input.size(1), -1)
         output_list = []
-        if self.reset:
+        if self.reset and self.use_projection_table():
+            # only in place of the per-step reset loop, the fused LSTM is kept otherwise
+            aux_gates = F.linear(auxiliary_in, self.rnn.weight_ih_l0[:, :self.naux])
+            gates_in = self.word_gates(input) + aux_gates
+            output, hidden = lstm_scan(self.rnn, gates_in, hidden, (input != eosidx).float())
+        elif self.reset:
+            emb = self.drop(self.encoder(input))
+            to_input = cat([auxiliary_in, emb], 2)
             for i in range(emb.size(0)):
                 hidden = self.resetsent(hidden, input[i,:], eosidx)
                 each_output, hidden = self.rnn(to_input[i,:,:].view(1,emb.size(1),-1), hidden)
                 output_list.append(each_output)
             output = cat(output_list, 0)
         else:
+            emb = self.drop(self.encoder(input))
+            to_input = cat([auxiliary_in, emb], 2)
             output, hidden = self.rnn(to_input, hidden)
         output = self.drop(output)
+        if outputflag == 1:
+            # the caller decodes, e.g. with decode_loss
+            return output, hidden, penalty
 
         decoded = self.decoder(output.view(output.size(0)*output.size(1), output.size(2)))
         return decoded.view(output.size(0), output.size(1), decoded.size(1)), hidden, penalty
 
+    def compress_context(self, auxiliary, device='cuda', dropout=True, auxind=None):
+        """Context vectors [n, naux_in] -> LSTM context inputs [n, naux] and the
+           attention penalty. With auxind, the penalty of each row is counted
+           once per position that uses it, as if the rows had been expanded.
+        """
+        penalty = zeros(1).to(device)
+        if self.atten:
+            auxiliary_in, penalty = self.selfatten(auxiliary, device=device, reduce=auxind is None)
+            if auxind is not None:
+                penalty = penalty[auxind].sum()
+            if self.nutt * self.nhead != self.naux:
+                auxiliary_in = self.comp4atten(auxiliary_in)
+        else:
+            auxiliary_in = self.compressor(auxiliary)
+        if dropout:
+            auxiliary_in = self.drop_context(auxiliary_in)
+        return auxiliary_in, penalty
+
+    def drop_context(self, auxiliary_in):
+        """Dropout of the compressed context, not applied to the attention
+           output when it is used without comp4atten"""
+        if self.atten and self.nutt * self.nhead == self.naux:
+            return auxiliary_in
+        return self.compressDrop(auxiliary_in)
+
+    def set_projection_table(self, enable=True, half=False):
+        """Inference only: take the word part of the first layer input projection
+           from a [ntoken, 4*nhid] table, optionally stored in float16. Used by
+           the paths that step the LSTM anyway (reset, auxgate, incremental);
+           without reset forward() keeps the fused LSTM"""
+        if enable and self.rnn_type != 'LSTM':
+            raise ValueError('The input projection table needs an LSTM second level model')
+        self.projtable = ProjectionTable(half) if enable else None
+
+    def use_projection_table(self):
+        return not self.training and getattr(self, 'projtable', None) is not None
+
+    def word_gates(self, input):
+        """First layer input gates of the words, with the LSTM biases"""
+        biases = [self.rnn.bias_ih_l0, self.rnn.bias_hh_l0]
+        if self.use_projection_table():
+            return self.projtable(input, self.encoder.weight, self.rnn.weight_ih_l0, biases, start=self.naux)
+        return F.linear(self.drop(self.encoder(input)), self.rnn.weight_ih_l0[:, self.naux:], sum(biases))
+
+    def forward_auxgate(self, input, auxiliary, auxind, hidden, eosidx=0, device='cuda', outputflag=0):
+        """Same as forward() for an LSTM, but the context is projected through its
+           columns of the first layer input weights once per distinct context vector
+           and added as a gate bias, so each step only projects the word embedding.
+           auxiliary: [nctx, naux_in] distinct context vectors
+           auxind: LongTensor [seq_len, bsz], row of auxiliary used at each position
+           The attention penalty is computed over the distinct context vectors.
+           In training the context dropout mask is drawn per position as in
+           forward(), so the projection is then done per position.
+        """
+        if self.rnn_type != 'LSTM':
+            raise ValueError('The context gate bias needs an LSTM second level model')
+        auxiliary_in, penalty = self.compress_context(auxiliary, device=device, dropout=False)
+        # the LSTM input is [context, word], split W_ih the same way
+        aux_weight = self.rnn.weight_ih_l0[:, :self.naux]
+        if self.training:
+            aux_gates = F.linear(self.drop_context(auxiliary_in[auxind]), aux_weight)
+        else:
+            aux_gates = F.linear(auxiliary_in, aux_weight)[auxind]
+        gates_in = self.word_gates(input) + aux_gates
+        keep = (input != eosidx).float() if self.reset else None
+        output, hidden = lstm_scan(self.rnn, gates_in, hidden, keep)
+        output = self.drop(output)
+        if outputflag == 1:
+            # the caller decodes, e.g. with decode_loss
+            return output, hidden, penalty
+
+        decoded = self.decoder(output.view(output.size(0)*output.size(1), output.size(2)))
+        return decoded.view(output.size(0), output.size(1), decoded.size(1)), hidden, penalty
+
+    def init_state(self, auxiliary, device='cuda'):
+        """Incremental scoring: state of bsz histories before their first token
+           auxiliary: [bsz, naux_in] context vector of each history
+           A state is (hidden, context gate bias), see advance() and step().
+        """
+        if self.rnn_type != 'LSTM':
+            raise ValueError('Incremental scoring needs an LSTM second level model')
+        auxiliary_in, _ = self.compress_context(auxiliary, device=device)
+        aux_gates = F.linear(auxiliary_in, self.rnn.weight_ih_l0[:, :self.naux])
+        return self.init_hidden(auxiliary.size(0)), aux_gates
+
+    def advance(self, state, token_ids, eosidx=0):
+        """Feeds one token [bsz] to each history, returns the new state"""
+        hidden, aux_gates = state
+        gates_in = (self.word_gates(token_ids) + aux_gates).unsqueeze(0)
+        keep = (token_ids != eosidx).float().unsqueeze(0) if self.reset else None
+        _, hidden = lstm_scan(self.rnn, gates_in, hidden, keep)
+        return hidden, aux_gates
+
+    def state_logprobs(self, state):
+        """Next token log-probs [bsz, ntoken] of each history"""
+        return F.log_softmax(self.decoder(self.drop(state[0][0][-1])).float(), dim=-1)
+
+    def step(self, state, token_ids, eosidx=0):
+        """advance() then state_logprobs(), returns (log-probs, new state)"""
+        state = self.advance(state, token_ids, eosidx)
+        return self.state_logprobs(state), state
+
+    def forward_packed(self, input, auxiliary, lengths, device='cuda'):
+        """Scoring of padded sequences without running the decoder on padding.
+           input: [seq_len, bsz] word ids, padded after lengths[i]
+           auxiliary: [bsz, naux_in] context vector of each sequence
+           lengths: LongTensor of real sequence lengths
+           Returns the decoder output of the real positions [sum(lengths), ntoken],
+           sequence by sequence, and the hidden state at the end of each sequence.
+           The hidden state starts from zero and sentence resetting is skipped, which
+           gives the same scores as forward() when <eos> only starts each sequence.
+        """
+        emb = self.drop(self.encoder(input))
+        auxiliary_in, _ = self.compress_context(auxiliary, device=device)
+        # the context is the same at every step of a sequence
+        auxiliary_in = auxiliary_in.unsqueeze(0).expand(emb.size(0), -1, -1)
+        to_input = cat([auxiliary_in, emb], 2)
+        packed = pack_padded_sequence(to_input, lengths.cpu(), enforce_sorted=False)
+        output, hidden = self.rnn(packed)
+        output, _ = pad_packed_sequence(output, total_length=emb.size(0))
+        mask = (arange(emb.size(0), device=lengths.device).unsqueeze(1) < lengths.unsqueeze(0)).to(output.device)
+        # batch-major selection keeps the positions of each sequence contiguous
+        output = self.drop(output.transpose(0, 1)[mask.t()])
+        return self.decoder(output), hidden
+
     def init_hidden(self, bsz):
-        weight = next(self.parameters())
+        weight = float_reference(self)
         if self.rnn_type == 'LSTM':
             return (weight.new_zeros(self.nlayers, bsz, self.nhid),
                     weight.new_zeros(self.nlayers, bsz, self.nhid))
@@ -127,5 +271,11 @@ class L2RNNModel(nn.Module):
             expandedmask = expandedmask.float()
             return hidden*expandedmask
 
+    def decode_loss(self, output, target, chunk=256):
+        """Per-token cross-entropy [seq_len*bsz] of the decoder on output
+           (forward with outputflag=1), chunk positions at a time"""
+        return chunked_cross_entropy(output.view(-1, output.size(-1)), self.decoder.weight,
+                                     self.decoder.bias, target.view(-1), chunk)
+
     def get_word_emb(self, input_seq):
         return self.drop(self.encoder(input_seq))
@@ -0,0 +1,58 @@
+"""
+Minimal container for named numpy arrays in a single file, used by the
+packed rescoring stores. Arrays are 64-byte aligned and read back as
+memory maps, so slicing them does not copy or parse anything.
+Layout: magic (8 bytes) | header length (uint64) | json header | arrays
+"""
+import json
+import struct
+
+import numpy as np
+
+ALIGN = 64
+LENGTH = struct.Struct('<Q')
+
+def save(path, magic, arrays, meta=None):
+    '''arrays: list of (name, ndarray) pairs, meta: json serialisable dict'''
+    entries = []
+    offset = 0
+    for name, array in arrays:
+        array = np.ascontiguousarray(array)
+        entries.append({'name': name, 'dtype': array.dtype.str,
+                        'shape': list(array.shape), 'offset': offset})
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    header = json.dumps({'arrays': entries, 'meta': meta or {}}).encode('utf8')
+    start = len(magic) + LENGTH.size + len(header)
+    start = -(-start // ALIGN) * ALIGN
+    with open(path, 'wb') as fout:
+        fout.write(magic)
+        fout.write(LENGTH.pack(len(header)))
+        fout.write(header)
+        for entry, (name, array) in zip(entries, arrays):
+            fout.seek(start + entry['offset'])
+            fout.write(np.ascontiguousarray(array).tobytes())
+        fout.truncate(start + offset)
+
+def is_store(path, magic):
+    with open(path, 'rb') as fin:
+        return fin.read(len(magic)) == magic
+
+def load(path, magic, mode='c'):
+    '''Returns ({name: memmap}, meta). The default copy-on-write mode keeps
+       the maps writeable so torch.from_numpy can wrap them without a copy'''
+    with open(path, 'rb') as fin:
+        if fin.read(len(magic)) != magic:
+            raise ValueError('{} is not a {} store'.format(path, magic.decode()))
+        length, = LENGTH.unpack(fin.read(LENGTH.size))
+        header = json.loads(fin.read(length).decode('utf8'))
+    start = len(magic) + LENGTH.size + length
+    start = -(-start // ALIGN) * ALIGN
+    arrays = {}
+    for entry in header['arrays']:
+        shape = tuple(entry['shape'])
+        if np.prod(shape) == 0:
+            arrays[entry['name']] = np.zeros(shape, dtype=entry['dtype'])
+        else:
+            arrays[entry['name']] = np.memmap(path, dtype=entry['dtype'], mode=mode,
+                                              offset=start+entry['offset'], shape=shape)
+    return arrays, header['meta']
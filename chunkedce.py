@@ -0,0 +1,129 @@
+# coding: utf-8
+"""
+Decoder and cross-entropy fused over chunks of positions (--cechunk in
+train_with_dataloader.py and jointtrain_singleseg.py).
+The [npositions, ntoken] logits are never held in full: the forward pass keeps
+only the log-sum-exp of each position, and the backward pass recomputes the
+logits of one chunk at a time to form softmax - onehot. Peak decoder memory
+is chunk x ntoken instead of two npositions x ntoken tensors.
+
+Run as a script to compare loss, gradients and peak memory with the
+unchunked decoder + CrossEntropyLoss.
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, hidden, weight, bias, target, chunk):
+        # the forward logits must match the ones recomputed in backward
+        with torch.autocast(device_type=hidden.device.type, enabled=False):
+            return ChunkedCrossEntropy.chunked_forward(ctx, hidden, weight, bias, target, chunk)
+
+    @staticmethod
+    def chunked_forward(ctx, hidden, weight, bias, target, chunk):
+        nrows = hidden.size(0)
+        losses = hidden.new_empty(nrows, dtype=torch.float)
+        lse = hidden.new_empty(nrows, dtype=torch.float)
+        for start in range(0, nrows, chunk):
+            logits = F.linear(hidden[start:start+chunk], weight, bias).float()
+            lse[start:start+chunk] = logits.logsumexp(1)
+            losses[start:start+chunk] = lse[start:start+chunk] - logits.gather(
+                1, target[start:start+chunk].unsqueeze(1)).squeeze(1)
+        ctx.save_for_backward(hidden, weight, bias, target, lse)
+        ctx.chunk = chunk
+        return losses
+
+    @staticmethod
+    def backward(ctx, grad_losses):
+        hidden, weight, bias, target, lse = ctx.saved_tensors
+        chunk = ctx.chunk
+        grad_hidden = torch.empty_like(hidden) if ctx.needs_input_grad[0] else None
+        grad_weight = torch.zeros_like(weight) if ctx.needs_input_grad[1] else None
+        grad_bias = torch.zeros_like(bias) if ctx.needs_input_grad[2] else None
+        for start in range(0, hidden.size(0), chunk):
+            each_hidden = hidden[start:start+chunk]
+            logits = F.linear(each_hidden, weight, bias).float()
+            # d loss / d logits = softmax - onehot(target)
+            grad_logits = torch.exp(logits - lse[start:start+chunk].unsqueeze(1))
+            grad_logits.scatter_add_(1, target[start:start+chunk].unsqueeze(1),
+                                     grad_logits.new_full((each_hidden.size(0), 1), -1.0))
+            grad_logits = (grad_logits * grad_losses[start:start+chunk].unsqueeze(1)).to(hidden.dtype)
+            if grad_hidden is not None:
+                grad_hidden[start:start+chunk] = grad_logits.mm(weight)
+            if grad_weight is not None:
+                grad_weight.addmm_(grad_logits.t(), each_hidden)
+            if grad_bias is not None:
+                grad_bias += grad_logits.sum(0)
+        return grad_hidden, grad_weight, grad_bias, None, None
+
+def chunked_cross_entropy(hidden, weight, bias, target, chunk=256):
+    '''hidden: [npositions, nhid] decoder input
+       weight, bias: decoder parameters [ntoken, nhid], [ntoken]
+       target: [npositions] word ids
+       Returns the per-position losses [npositions], i.e.
+       F.cross_entropy(F.linear(hidden, weight, bias), target, reduction='none')
+       The decoder runs in the precision of its weights, also under autocast.'''
+    return ChunkedCrossEntropy.apply(hidden.to(weight.dtype), weight, bias, target, chunk)
+
+def peak_memory(fn, device):
+    '''Peak bytes allocated on top of the current allocation while running fn'''
+    if device.type != 'cuda':
+        fn()
+        return None
+    torch.cuda.synchronize()
+    base = torch.cuda.memory_allocated()
+    torch.cuda.reset_peak_memory_stats()
+    fn()
+    torch.cuda.synchronize()
+    return torch.cuda.max_memory_allocated() - base
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare chunked and full decoder cross-entropy')
+    parser.add_argument('--ntokens', type=int, default=13080,
+                        help='vocabulary size')
+    parser.add_argument('--nhid', type=int, default=256,
+                        help='decoder input size')
+    parser.add_argument('--batchsize', type=int, default=64,
+                        help='batch size')
+    parser.add_argument('--bptts', type=str, default='12 36 100',
+                        help='sequence lengths')
+    parser.add_argument('--chunk', type=int, default=128,
+                        help='positions per chunk')
+    parser.add_argument('--cuda', action='store_true',
+                        help='use CUDA')
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+    decoder = torch.nn.Linear(args.nhid, args.ntokens).to(device)
+    for bptt in [int(v) for v in args.bptts.split()]:
+        npos = bptt * args.batchsize
+        hidden = torch.randn(npos, args.nhid, device=device, requires_grad=True)
+        target = torch.randint(args.ntokens, (npos,), device=device)
+        results = {}
+        for name in ['full', 'chunked']:
+            decoder.zero_grad()
+            hidden.grad = None
+            def run():
+                if name == 'full':
+                    loss = F.cross_entropy(decoder(hidden), target)
+                else:
+                    loss = chunked_cross_entropy(hidden, decoder.weight, decoder.bias, target, args.chunk).mean()
+                loss.backward()
+                results[name + '_loss'] = float(loss)
+            start = time.time()
+            results[name + '_mem'] = peak_memory(run, device)
+            results[name + '_ms'] = (time.time() - start) * 1000
+            results[name + '_grads'] = (hidden.grad.clone(), decoder.weight.grad.clone())
+        grad_diff = max(float((a - b).abs().max()) for a, b in zip(results['full_grads'], results['chunked_grads']))
+        if results['full_mem'] is None:
+            memory = 'peak memory n/a on cpu'
+        else:
+            memory = 'peak MB full {:8.1f} chunked {:8.1f}'.format(
+                results['full_mem'] / 2**20, results['chunked_mem'] / 2**20)
+        print('| bptt {:4d} | loss diff {:.2e} | grad diff {:.2e} | ms full {:7.2f} chunked {:7.2f} | {} |'.format(
+            bptt, abs(results['full_loss'] - results['chunked_loss']), grad_diff,
+            results['full_ms'], results['chunked_ms'], memory))
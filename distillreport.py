@@ -0,0 +1,94 @@
+# coding: utf-8
+"""
+Speed and 1-best agreement of distilled students against their teacher.
+Students are trained with jointtrain_singleseg.py --teacher/--teacherFLv,
+which also logs the student and teacher test perplexities, and rescore with
+jointforward.py like any other model pair.
+
+Each model pair is given as <2nd level model>:<1st level model>. The scoring
+time is measured on random n-best batches (context encoding + scoring, as in
+jointforward.py), the agreement from the .1best MLFs jointforward.py wrote
+for each model on the same n-best lists.
+"""
+import argparse
+
+import torch
+
+import wer
+from onnxexport import eager_context, eager_score, timeit
+
+def load_pair(pair):
+    model_path, FLv_path = pair.split(':')
+    model = torch.load(model_path, map_location='cpu')
+    FLvmodel = torch.load(FLv_path, map_location='cpu')
+    model.eval()
+    model.set_mode('eval')
+    FLvmodel.eval()
+    FLvmodel.set_mode('eval')
+    return model, FLvmodel
+
+def nparams(model, FLvmodel):
+    return sum(p.numel() for p in list(model.parameters()) + list(FLvmodel.parameters()))
+
+def nbest_time(model, FLvmodel, args):
+    '''Seconds per n-best list: one context encoding and one scoring batch'''
+    ntokens = model.decoder.out_features
+    splits = max(1, args.maxlen // args.seglen)
+    context = torch.randint(ntokens, (args.seglen, 2 * splits))
+    input = torch.randint(ntokens, (args.hyplen, args.nhyps))
+    target = torch.randint(ntokens, (args.hyplen, args.nhyps))
+    auxiliary = torch.randn(args.nhyps, model.nutt * model.nseg)
+    mask = torch.ones(args.hyplen, args.nhyps)
+    with torch.no_grad():
+        return timeit(lambda: (eager_context(model, FLvmodel, context),
+                               eager_score(model, input, auxiliary, target, mask)), args.repeats)
+
+def agreement(teacher_hyps, student_hyps):
+    '''Fraction of utterances with the same 1-best, and the student 1-best
+       error counts against the teacher 1-best'''
+    same = sum(1 for name, words in teacher_hyps.items() if student_hyps.get(name) == words)
+    return float(same) / max(1, len(teacher_hyps)), wer.score(teacher_hyps, student_hyps)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Report speed and 1-best agreement of distilled students')
+    parser.add_argument('--teacher', type=str, required=True,
+                        help='<model>:<FLvmodel> of the teacher')
+    parser.add_argument('--students', type=str, required=True,
+                        help='space separated <model>:<FLvmodel> of the students')
+    parser.add_argument('--onebest', type=str, default='',
+                        help='space separated .1best MLFs of the teacher and then each student')
+    parser.add_argument('--ref', type=str, default='',
+                        help='reference MLF or STM, to add the WER of each model')
+    parser.add_argument('--maxlen', type=int, default=36,
+                        help='context words on each side')
+    parser.add_argument('--seglen', type=int, default=12,
+                        help='context segment length')
+    parser.add_argument('--nhyps', type=int, default=50,
+                        help='hypotheses per n-best list in the speed test')
+    parser.add_argument('--hyplen', type=int, default=15,
+                        help='hypothesis length in the speed test')
+    parser.add_argument('--repeats', type=int, default=20,
+                        help='timed repetitions')
+    args = parser.parse_args()
+
+    pairs = [args.teacher] + args.students.split()
+    onebest = args.onebest.split()
+    if onebest != [] and len(onebest) != len(pairs):
+        raise ValueError('--onebest needs one MLF for the teacher and one per student')
+    hyps = [wer.read_mlf(path) for path in onebest]
+    refs = wer.read_reference(args.ref) if args.ref else None
+    teacher_time = None
+    for i, pair in enumerate(pairs):
+        model, FLvmodel = load_pair(pair)
+        seconds = nbest_time(model, FLvmodel, args)
+        if teacher_time is None:
+            teacher_time = seconds
+        line = '| {:8s} | {:30s} | params {:10d} | ms per n-best {:8.2f} | speed-up {:5.2f} |'.format(
+            'teacher' if i == 0 else 'student', pair.split(':')[0], nparams(model, FLvmodel),
+            seconds * 1000, teacher_time / seconds)
+        if hyps != [] and i > 0:
+            same, counts = agreement(hyps[0], hyps[i])
+            line += ' 1-best agreement {:5.1f}% | vs teacher 1-best {} |'.format(100 * same, counts.summary())
+        if hyps != [] and refs is not None:
+            line += ' {} |'.format(wer.score(refs, hyps[i]).summary())
+        print(line)
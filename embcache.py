@@ -0,0 +1,53 @@
+"""
+Persistent cache of the per-utterance context vectors that jointforward.py
+computes with the first level LM. Entries are keyed by a hash of the
+weights that produce them, the context arrangement settings and the
+content of the .context file, and stored as a memory-mapped matrix.
+"""
+import sys, os
+import hashlib
+import tempfile
+
+import numpy as np
+
+import binstore
+
+MAGIC = b'CTXEMB01'
+
+def cache_key(weightfiles, settings, contextfile):
+    '''weightfiles: saved models holding every weight the context depends on
+       settings: dict of the arrangement options'''
+    key = hashlib.sha1()
+    for path in weightfiles + [contextfile]:
+        with open(path, 'rb') as fin:
+            for chunk in iter(lambda: fin.read(1 << 20), b''):
+                key.update(chunk)
+    key.update(repr(sorted(settings.items())).encode('utf8'))
+    return key.hexdigest()
+
+def cache_path(cachedir, key):
+    return os.path.join(cachedir, key + '.ctx')
+
+def load(cachedir, key):
+    '''Returns the [nutt, dim] context matrix, or None on a cache miss'''
+    path = cache_path(cachedir, key)
+    if not os.path.exists(path):
+        return None
+    arrays, meta = binstore.load(path, MAGIC)
+    if meta.get('key') != key:
+        return None
+    return arrays['context']
+
+def save(cachedir, key, matrix, dtype='float32'):
+    os.makedirs(cachedir, exist_ok=True)
+    path = cache_path(cachedir, key)
+    # write a file of this run's own then rename, so concurrent runs never
+    # read a partial entry
+    fd, tmppath = tempfile.mkstemp(dir=cachedir, prefix=key, suffix='.tmp')
+    os.close(fd)
+    try:
+        binstore.save(tmppath, MAGIC, [('context', np.asarray(matrix, dtype=dtype))], meta={'key': key})
+        os.replace(tmppath, path)
+    except BaseException:
+        os.remove(tmppath)
+        raise
@@ -0,0 +1,74 @@
+"""
+Hierarchical long-range context. Each utterance of a document is encoded
+once by the first level model into a segment embedding. The context of an
+utterance is then the embeddings of the K previous and K following
+utterances, which the second level model (L2RNNModel with atten=True)
+attends over with its SelfAttenModel. Contexts of hundreds of utterances
+cost one encoding per utterance instead of one maxlen window each.
+"""
+import torch
+from torch.utils.checkpoint import checkpoint as checkpoint_function
+
+from quantize import float_reference
+
+def utterance_matrix(sent_list, uttlen, eosidx):
+    '''Word ids of each utterance, its last uttlen words front padded with
+       <eos>: LongTensor [nutt, uttlen]'''
+    rows = []
+    for sent in sent_list:
+        sent = list(sent)[-uttlen:]
+        rows.append([eosidx] * (uttlen - len(sent)) + sent)
+    return torch.LongTensor(rows).view(len(rows), uttlen)
+
+def unique_utterances(utt_index):
+    '''Distinct utterance ids of a batch in order of appearance, and the row
+       of each position among them'''
+    seen = {}
+    lookup = [seen.setdefault(int(utt_id), len(seen)) for utt_id in utt_index]
+    return list(seen), torch.LongTensor(lookup)
+
+def encode_utterances(model, FLvmodel, utts, device, batchsize=256, checkpoint=False):
+    '''Segment embeddings [nutt, nhid*nhead] of the rows of utts and the sum
+       of the attention penalties.
+       checkpoint: recompute the first level activations in backward'''
+    encode = lambda input, FLvhidden: FLvmodel(model.get_word_emb(input), FLvhidden, device=device)
+    extracted = []
+    penalty = 0
+    for start in range(0, utts.size(0), batchsize):
+        input = utts[start:start+batchsize].t().contiguous().to(device)
+        FLvhidden = FLvmodel.init_hidden(input.size(1))
+        if checkpoint and torch.is_grad_enabled():
+            each_extracted, each_penalty = checkpoint_function(encode, input, FLvhidden, use_reentrant=False)
+        else:
+            each_extracted, each_penalty = encode(input, FLvhidden)
+        extracted.append(each_extracted)
+        penalty = penalty + each_penalty
+    if extracted == []:
+        weight = float_reference(FLvmodel)
+        return weight.new_zeros(0, FLvmodel.nhid * FLvmodel.nhead), penalty
+    return torch.cat(extracted, 0), penalty
+
+def window_index(utt_ids, nutt, K):
+    '''Utterances of the K previous and K following positions of each of
+       utt_ids, -1 outside the document: LongTensor [len(utt_ids), 2K]'''
+    offsets = list(range(-K, 0)) + list(range(1, K + 1))
+    index = torch.LongTensor([[u + k for k in offsets] for u in utt_ids]).view(len(utt_ids), 2 * K)
+    return index.masked_fill((index < 0) | (index >= nutt), -1)
+
+def gather_windows(embeddings, index):
+    '''embeddings: [n, D]; index: [m, 2K] rows of embeddings, -1 for none
+       Returns the context rows [m, 2K*D], zeros outside the document'''
+    table = torch.cat([embeddings.new_zeros(1, embeddings.size(1)), embeddings], 0)
+    return table[(index + 1).to(table.device)].view(index.size(0), -1)
+
+def encode_windows(model, FLvmodel, utts, utt_ids, K, device, checkpoint=False):
+    '''Context rows of utt_ids, encoding only the utterances their windows
+       need (each once), for training where the first level model changes
+       between batches. Returns the rows and the attention penalty.'''
+    index = window_index(utt_ids, utts.size(0), K)
+    needed = sorted(set(index[index >= 0].tolist()))
+    position = torch.full((utts.size(0),), -1, dtype=torch.long)
+    position[needed] = torch.arange(len(needed))
+    local = torch.where(index >= 0, position[index.clamp(min=0)], index)
+    embeddings, penalty = encode_utterances(model, FLvmodel, utts[needed], device, checkpoint=checkpoint)
+    return gather_windows(embeddings, local), penalty
@@ -0,0 +1,38 @@
+# coding: utf-8
+"""
+Batched scoring of n-best hypotheses with the 2nd level LM, shared by
+jointforward.py and rescoreserver.py so their scores stay the same.
+Hypotheses are <eos>-prefixed, padded with <eos> into [seq_len, nhyp]
+tensors and forwarded from a zero state; the context vector of each
+hypothesis is passed as a distinct row with auxind, not copied per position.
+"""
+import torch
+import torch.nn.functional as F
+
+def unique_sequences(keys):
+    '''Distinct keys in first-seen order and the index of each key among them'''
+    unique_index = {}
+    key_to_unique = [unique_index.setdefault(key, len(unique_index)) for key in keys]
+    return list(unique_index), key_to_unique
+
+def pad_hypotheses(hyp_ids, eosidx, device):
+    '''hyp_ids: word id lists
+       Returns input, target and mask [seq_len, nhyp] and the lengths [nhyp],
+       counting the final <eos>'''
+    lengths = torch.LongTensor([len(ids) + 1 for ids in hyp_ids])
+    seq_len = int(lengths.max())
+    padded = [[eosidx] + list(ids) + [eosidx] * (seq_len - len(ids)) for ids in hyp_ids]
+    padded = torch.LongTensor(padded).to(device).t()
+    mask = (torch.arange(seq_len).unsqueeze(1) < lengths.unsqueeze(0)).float().to(device)
+    return padded[:-1].contiguous(), padded[1:].contiguous(), mask, lengths
+
+def score_hypotheses(model, input, target, mask, auxiliary, auxind, eosidx, device):
+    '''auxiliary: [nctx, naux_in] distinct context vectors
+       auxind: LongTensor [seq_len, nhyp], row of auxiliary of each position
+       Returns the per-position negative log-probs [seq_len*nhyp], their sums
+       over the mask [nhyp] and the final hidden state'''
+    seq_len, bsize = input.size()
+    hidden = model.init_hidden(bsize)
+    output, hidden, _ = model(input, auxiliary, hidden, eosidx=eosidx, device=device, auxind=auxind)
+    logProb = F.cross_entropy(output.view(-1, output.size(2)).float(), target.view(-1), reduction='none')
+    return logProb, torch.sum(logProb.view(seq_len, bsize)*mask, 0), hidden
@@ -0,0 +1,153 @@
+# coding: utf-8
+"""
+Incremental scoring with the second level LM, for first-pass decoding,
+lattice expansion and prefix sharing in n-best rescoring.
+L2RNNModel.init_state/advance/step move many histories forward by one token
+at a time; IncrementalLM keeps the resulting states in an LRU cache keyed
+by (context, word history), so a shared prefix is only forwarded once.
+
+Run as a script to benchmark expansions per second.
+"""
+import argparse
+import os
+import time
+from collections import OrderedDict
+
+import torch
+
+class StateCache(object):
+    '''Least recently used cache of single-history LM states'''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        state = self.entries.get(key)
+        if state is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return state
+
+    def put(self, key, state):
+        self.entries[key] = state
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+def split_state(state):
+    '''Batched state -> list of single-history states'''
+    (h, c), aux_gates = state
+    return [((h[:, i:i+1].clone(), c[:, i:i+1].clone()), aux_gates[i:i+1].clone())
+            for i in range(aux_gates.size(0))]
+
+def stack_states(states):
+    '''List of single-history states -> batched state'''
+    return ((torch.cat([state[0][0] for state in states], 1), torch.cat([state[0][1] for state in states], 1)),
+            torch.cat([state[1] for state in states], 0))
+
+class IncrementalLM(object):
+    '''Next word log-probs of word histories under a context vector. A history
+       is a tuple of word ids, the leading <eos> is implicit.'''
+    def __init__(self, model, eosidx, capacity=100000, device='cpu'):
+        self.model = model
+        self.eosidx = eosidx
+        self.device = device
+        self.cache = StateCache(capacity)
+
+    def states(self, context_key, auxiliary, histories):
+        '''context_key: hashable name of the context (e.g. the utterance)
+           auxiliary: [1, naux_in] context vector
+           Returns the state after each history, computing missing prefixes
+           one length at a time, all histories of a length in one batch'''
+        known = {}
+        needed = set()
+        for history in histories:
+            history = tuple(history)
+            while history not in known and history not in needed:
+                state = self.cache.get((context_key, history))
+                if state is not None:
+                    known[history] = state
+                    break
+                needed.add(history)
+                if len(history) == 0:
+                    break
+                history = history[:-1]
+        by_length = {}
+        for history in needed:
+            by_length.setdefault(len(history), []).append(history)
+        for length in sorted(by_length):
+            group = by_length[length]
+            if length == 0:
+                parents = self.model.init_state(auxiliary.expand(len(group), -1), device=self.device)
+                tokens = [self.eosidx] * len(group)
+            else:
+                parents = stack_states([known[history[:-1]] for history in group])
+                tokens = [history[-1] for history in group]
+            new_state = self.model.advance(parents, torch.LongTensor(tokens).to(self.device), self.eosidx)
+            for history, state in zip(group, split_state(new_state)):
+                known[history] = state
+                self.cache.put((context_key, history), state)
+        return [known[tuple(history)] for history in histories]
+
+    def logprobs(self, context_key, auxiliary, histories):
+        '''Next word log-probs [len(histories), ntoken]'''
+        return self.model.state_logprobs(stack_states(self.states(context_key, auxiliary, histories)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark incremental scoring of the 2nd level LM')
+    parser.add_argument('--data', type=str, default='./data/AMI',
+                        help='location of the data corpus (for the dictionary)')
+    parser.add_argument('--model', type=str, default='model.pt',
+                        help='location of the 2nd level model')
+    parser.add_argument('--cuda', action='store_true',
+                        help='use CUDA')
+    parser.add_argument('--beam', type=int, default=64,
+                        help='histories kept after each step')
+    parser.add_argument('--expand', type=int, default=8,
+                        help='words tried on each history per step')
+    parser.add_argument('--steps', type=int, default=20,
+                        help='search steps per utterance')
+    parser.add_argument('--utts', type=int, default=10,
+                        help='simulated utterances')
+    parser.add_argument('--capacity', type=int, default=100000,
+                        help='state cache size')
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+    model = torch.load(args.model, map_location=device)
+    model.eval()
+    model.set_mode('eval')
+    eosidx = 0
+    with open(os.path.join(args.data, 'dictionary.txt')) as vocabin:
+        for line in vocabin:
+            ind, word = line.strip().split(' ')
+            if word == '<eos>':
+                eosidx = int(ind)
+    lm = IncrementalLM(model, eosidx, capacity=args.capacity, device=device)
+    expansions = 0
+    start = time.time()
+    with torch.no_grad():
+        for utt in range(args.utts):
+            auxiliary = torch.randn(1, model.nutt * model.nseg).to(device)
+            beam = [()]
+            beam_scores = torch.zeros(1)
+            for i in range(args.steps):
+                # extend each history by its most likely words, keep the best totals
+                logprobs = lm.logprobs(utt, auxiliary, beam)
+                scores, words = logprobs.topk(args.expand, dim=1)
+                totals = (beam_scores.unsqueeze(1) + scores.cpu()).view(-1)
+                top = totals.topk(min(args.beam, totals.numel()))[1].tolist()
+                beam = [beam[j // args.expand] + (int(words[j // args.expand, j % args.expand]),) for j in top]
+                beam_scores = totals[top]
+                expansions += logprobs.size(0) * args.expand
+    elapsed = time.time() - start
+    lookups = max(1, lm.cache.hits + lm.cache.misses)
+    print('| {} expansions in {:5.2f}s | {:8.1f} expansions/s | cache hit rate {:5.1f}% | cached states {} |'.format(
+        expansions, elapsed, expansions / elapsed, 100.0 * lm.cache.hits / lookups, len(lm.cache)))
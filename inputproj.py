@@ -0,0 +1,60 @@
+"""
+Inference-only vocabulary table of the first layer LSTM input projection.
+W_ih . emb(w) + b_ih + b_hh only depends on the word id w, so it is folded
+into a [ntoken, 4*nhid] table and the per-token input matmul becomes a row
+gather. The table is rebuilt when any weight it was built from changes
+(moved to another device, replaced, or updated in place).
+Also holds the step loop that runs an nn.LSTM from such precomputed gates.
+"""
+import torch
+import torch.nn.functional as F
+
+class ProjectionTable(object):
+    def __init__(self, half=False):
+        '''half: keep the table in float16, gathered rows are returned as float32'''
+        self.half = half
+        self.table = None
+        self.key = None
+
+    def __call__(self, input, embedding, weight_ih, biases, start=0):
+        '''input: word ids of any shape
+           embedding: [ntoken, ninp] word embedding matrix
+           weight_ih: first layer input weights, the word columns start at start
+           biases: first layer biases, summed into the table
+           Returns the word input gates, input.shape + [4*nhid]'''
+        sources = [embedding, weight_ih] + list(biases)
+        key = tuple((t.data_ptr(), t._version, str(t.device)) for t in sources)
+        if key != self.key:
+            with torch.no_grad():
+                table = F.linear(embedding, weight_ih[:, start:start+embedding.size(1)], sum(biases))
+            self.table = table.half() if self.half else table
+            self.key = key
+        return self.table[input].float()
+
+def lstm_scan(rnn, gates_in, hidden, keep=None):
+    '''Runs the layers of rnn (an nn.LSTM) step by step, the first layer from
+       precomputed input gates [seq_len, bsz, 4*nhid].
+       keep: optional [seq_len, bsz] float mask, the state is zeroed before the
+       steps where it is 0 (sentence boundary resetting)
+       Returns the last layer output [seq_len, bsz, nhid] and the final state'''
+    h = list(hidden[0].unbind(0))
+    c = list(hidden[1].unbind(0))
+    output_list = []
+    for i in range(gates_in.size(0)):
+        if keep is not None:
+            step_keep = keep[i].unsqueeze(1)
+            h = [state * step_keep for state in h]
+            c = [state * step_keep for state in c]
+        for l in range(rnn.num_layers):
+            if l == 0:
+                gates = gates_in[i]
+            else:
+                layer_in = F.dropout(h[l-1], rnn.dropout, rnn.training)
+                gates = F.linear(layer_in, getattr(rnn, 'weight_ih_l%d' % l),
+                                 getattr(rnn, 'bias_ih_l%d' % l) + getattr(rnn, 'bias_hh_l%d' % l))
+            gates = gates + F.linear(h[l], getattr(rnn, 'weight_hh_l%d' % l))
+            ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
+            c[l] = torch.sigmoid(forgetgate) * c[l] + torch.sigmoid(ingate) * torch.tanh(cellgate)
+            h[l] = torch.sigmoid(outgate) * torch.tanh(c[l])
+        output_list.append(h[-1])
+    return torch.stack(output_list, 0), (torch.stack(h, 0), torch.stack(c, 0))
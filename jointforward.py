@@ -2,12 +2,26 @@
 import argparse
 import sys, os
 import torch
+import torch.multiprocessing as mp
 import math
+import contextlib
 import torch.nn.functional as F
 from operator import itemgetter
+from collections import deque
 import time
 
 import data
+from ngramstore import NgramProbStore, parse_probline
+from nbestarchive import NbestArchive
+from scorestore import ScoreWriter
+from mlf import read_namemap, write_1best, write_entry
+import embcache
+from quantize import quantize_model, model_size
+from incremental import IncrementalLM
+from lattice import read_slf, write_slf, LatticeRescorer
+import hiercontext
+import hypscore
+import precision
 
 parser = argparse.ArgumentParser(description='PyTorch Level-2 RNN/LSTM Language Model')
 parser.add_argument('--data', type=str, default='./data/AMI',
@@ -28,10 +42,20 @@ parser.add_argument('--lm', type=str, default='original',
                     help='Specify which language model to be used: rnn, ngram or original')
 parser.add_argument('--nbest', type=str, default='dev.nbest.info.txt',
                     help='Specify which nbest file to be used')
+parser.add_argument('--nbestbin', action='store_true',
+                    help='--nbest is an n-best archive (see nbestarchive.py)')
 parser.add_argument('--ngram', type=str, default='dev_ngram.st',
                     help='Specify which ngram stream file to be used')
+parser.add_argument('--ngrambin', action='store_true',
+                    help='--ngram is a packed n-gram probability store (see ngramstore.py)')
+parser.add_argument('--savescores', type=str, default='',
+                    help='save raw per-hypothesis scores for rerank.py to this path')
 parser.add_argument('--saveemb', action='store_true',
-                    help='save utterance embeddings')
+                    help='save utterance embeddings in --embcache and reuse them on later runs')
+parser.add_argument('--embcache', type=str, default='embcache',
+                    help='directory of the persistent context embedding cache')
+parser.add_argument('--embdtype', type=str, default='float32',
+                    help='storage type of cached embeddings: float32 or float16')
 parser.add_argument('--context', type=str, default='0',
                     help='Specify which utterance embeddings to be used')
 parser.add_argument('--interp', action='store_true',
@@ -47,7 +71,11 @@ parser.add_argument('--logfile', type=str, default='resnet_nbest/log.txt',
 parser.add_argument('--outputcell', type=int, default=1,
                     help='which hidden state to be used')
 parser.add_argument('--arrange', type=str, default='sentence',
-                    help='Arrangements: sentence, segments or attention')
+                    help='Arrangements: sentence, segments, attention, atten_shared or hier')
+parser.add_argument('--hier', type=int, default=4,
+                    help='--arrange hier: no. of previous and of future utterance embeddings')
+parser.add_argument('--uttlen', type=int, default=36,
+                    help='--arrange hier: no. of words of each utterance the first level LM encodes')
 parser.add_argument('--maxlen', type=int, default=36,
                     help='No. of words to look at')
 parser.add_argument('--seglen', type=int, default=20,
@@ -58,6 +86,46 @@ parser.add_argument('--sepchunk', action='store_true',
                     help='Use separate RNNs for segments')
 parser.add_argument('--map', type=str, default='nbest/dev.map',
                     help='AMI name mapping file')
+parser.add_argument('--nworkers', type=int, default=1,
+                    help='rescore meetings in this many CPU processes')
+parser.add_argument('--quantize', action='store_true',
+                    help='dynamic int8 quantization of LSTM and Linear layers (CPU only)')
+parser.add_argument('--quantemb', action='store_true',
+                    help='with --quantize, also quantize the word embeddings')
+parser.add_argument('--backend', type=str, default='pytorch',
+                    help='inference backend: pytorch or onnxruntime (CPU, see onnxexport.py)')
+parser.add_argument('--onnxdir', type=str, default='onnx',
+                    help='directory of the exported ONNX models')
+parser.add_argument('--stream', action='store_true',
+                    help='online rescoring of n-best files as they arrive on --nbest (- for stdin)')
+parser.add_argument('--lookahead', type=int, default=0,
+                    help='streaming mode: no. of future words to wait for before scoring an utterance')
+parser.add_argument('--packed', action='store_true',
+                    help='run the n-best batch as packed sequences, skipping the padding')
+parser.add_argument('--amp', type=str, default='fp32', choices=precision.AMP_MODES,
+                    help='bf16: LSTM, attention and decoder matmuls under bfloat16 autocast, scores in fp32')
+parser.add_argument('--projtable', action='store_true',
+                    help='gather the 2nd level LSTM input projection of each word from a vocabulary table '
+                         'in the per-step paths (reset models, --auxgate, --incremental)')
+parser.add_argument('--projhalf', action='store_true',
+                    help='store the --projtable tables in float16')
+parser.add_argument('--incremental', action='store_true',
+                    help='score n-best lists with the step API, forwarding each shared prefix once')
+parser.add_argument('--statecache', type=int, default=100000,
+                    help='--incremental: no. of LM states kept in the LRU cache')
+parser.add_argument('--lattice', action='store_true',
+                    help='--nbest lists HTK lattices (SLF, optionally .gz) to rescore instead of n-best files')
+parser.add_argument('--lathist', type=int, default=3,
+                    help='--lattice: no. of last words that identify an LM state when merging paths')
+parser.add_argument('--latdir', type=str, default='',
+                    help='--lattice: write the rescored lattices to this directory')
+parser.add_argument('--wdpenalty', type=float, default=0.0,
+                    help='--lattice: word insertion penalty used for the 1-best')
+parser.add_argument('--directemb', action='store_true',
+                    help='check that the 1st level model encodes context with positional embeddings '
+                         'instead of its LSTM (trained with jointtrain_singleseg.py --directemb)')
+parser.add_argument('--auxgate', action='store_true',
+                    help='project the context through the LSTM input weights once per utterance')
 args = parser.parse_args()
 
 def logging(s, print_=True, log_=True):
@@ -83,6 +151,24 @@ ntokens = len(dictionary)
 eosidx = int(dictionary['<eos>'])
 context_shift = [int(i) for i in args.context.strip().split()]
 device = torch.device("cuda" if args.cuda else "cpu")
+if args.quantize and args.cuda:
+    raise ValueError('--quantize is a CPU inference mode, it cannot be combined with --cuda')
+if args.nworkers > 1 and args.cuda:
+    raise ValueError('--nworkers is for CPU rescoring, it cannot be combined with --cuda')
+if args.backend == 'onnxruntime' and (args.arrange != 'atten_shared' or args.interp or args.cuda):
+    raise ValueError('--backend onnxruntime supports the atten_shared arrangement on CPU without --interp')
+if args.incremental and (args.packed or args.auxgate or args.quantize or args.backend != 'pytorch'):
+    raise ValueError('--incremental needs the float pytorch backend without --packed and --auxgate')
+if args.lattice and (args.arrange == 'sentence' or args.stream or args.quantize or args.backend != 'pytorch'):
+    raise ValueError('--lattice needs the float pytorch backend, a per-utterance context arrangement and no --stream')
+if args.auxgate and (args.packed or args.quantize or args.backend != 'pytorch'):
+    raise ValueError('--auxgate needs the float pytorch backend and cannot be combined with --packed')
+if args.amp != 'fp32' and (args.quantize or args.backend != 'pytorch'):
+    raise ValueError('--amp needs the float pytorch backend')
+if args.projtable and (args.quantize or args.backend != 'pytorch'):
+    raise ValueError('--projtable needs the float pytorch backend')
+if args.stream and (args.arrange != 'atten_shared' or args.interp or args.nbestbin):
+    raise ValueError('--stream supports the atten_shared arrangement without --interp and --nbestbin')
 
 def readin_model():
     # Read in trained 1st level model
@@ -94,6 +180,9 @@ def readin_model():
         model.rnn.flatten_parameters()
         if args.cuda:
             model.cuda()
+    if args.quantize:
+        model = quantize_model(model, embedding=args.quantemb)
+        logging('Quantized 2nd level model, {:5.1f}MB'.format(model_size(model) / 2**20))
     return model
 
 def readin_FLvmodel():
@@ -103,6 +192,9 @@ def readin_FLvmodel():
         FLvmodel.rnn.flatten_parameters()
         if args.cuda:
             FLvmodel.cuda()
+    if args.quantize:
+        FLvmodel = quantize_model(FLvmodel)
+        logging('Quantized 1st level model, {:5.1f}MB'.format(model_size(FLvmodel) / 2**20))
     return FLvmodel
 
 def repackage_hidden(h):
@@ -319,6 +411,23 @@ def FLvAttenForwarding(infile, FLvmodel):
                 logging('first level completed: ' + str(i))
     return sentdict
 
+def shared_atten_context(model, FLvmodel, sent_tank_prev, sent_tank_post):
+    '''Context vector from maxlen previous and maxlen future word ids'''
+    # Try splitting the context
+    splits = args.maxlen // args.seglen
+
+    # Start forwarding, previous and future segments stacked in one batch
+    input_prev = torch.LongTensor(sent_tank_prev).view(splits, args.seglen).t()
+    input_post = torch.LongTensor(sent_tank_post).view(splits, args.seglen).t()
+    input = torch.cat([input_prev, input_post], 1).contiguous()
+    if args.backend == 'onnxruntime':
+        return onnx_rescorer.encode_context(input).view(1, -1)
+    input = input.to(device)
+    FLvhidden = FLvmodel.init_hidden(2 * splits)
+    extracted, _ = FLvmodel(model.get_word_emb(input), FLvhidden, device=device)
+    # previous segments first, so this is [prev vectors, post vectors]
+    return extracted.view(1, -1)
+
 def SharedFLvAttenForwarding(infile, FLvmodel, model):
     '''Forward first level LM to get segment level embeddings'''
     logging('Start forwarding the first level LM')
@@ -355,55 +464,109 @@ def SharedFLvAttenForwarding(infile, FLvmodel, model):
             else:
                 sent_tank_post = sent_tank_post[:args.maxlen]
 
-            # Try splitting the context
-            splits = args.maxlen // args.seglen
-
-            # Start forwarding
-            input_prev = torch.LongTensor(sent_tank_prev).to(device).view(splits, args.seglen).t().contiguous()
-            prev_emb = model.get_word_emb(input_prev)
-            FLvhidden = FLvmodel.init_hidden(splits)
-            prev_extracted, prevpenalty = FLvmodel(prev_emb, FLvhidden, device=device)
-            prev_extracted = prev_extracted.view(1, -1)
-
-            input_post = torch.LongTensor(sent_tank_post).to(device).view(splits, args.seglen).t().contiguous()
-            post_emb = model.get_word_emb(input_post)
-            FLvhidden = FLvmodel.init_hidden(splits)
-            post_extracted, postpenalty = FLvmodel(post_emb, FLvhidden, device=device)
-            post_extracted = post_extracted.view(1, -1)
-
-            sentdict[i] = torch.cat([prev_extracted, post_extracted], 1)
+            sentdict[i] = shared_atten_context(model, FLvmodel, sent_tank_prev, sent_tank_post)
             if i % 1000 == 0:
                 logging('first level completed: ' + str(i))
     return sentdict
 
+def HierFLvForwarding(infile, FLvmodel, model):
+    '''Forward first level LM once per utterance, the context of each
+       utterance is the embeddings of its neighbouring utterances'''
+    logging('Start forwarding the first level LM')
+    sent_list = []
+    with open(infile) as fin:
+        for i, line in enumerate(fin):
+            currentline = []
+            linevec = line.strip().split()
+            for j, word in enumerate(linevec[1:-1]):
+                if word in dictionary:
+                    currentline.append(int(dictionary[word]))
+                else:
+                    currentline.append(int(dictionary['OOV']))
+            sent_list.append(currentline)
+    utts = hiercontext.utterance_matrix(sent_list, args.uttlen, eosidx)
+    embeddings, _ = hiercontext.encode_utterances(model, FLvmodel, utts, device)
+    logging('first level completed: ' + str(len(sent_list)))
+    index = hiercontext.window_index(range(len(sent_list)), len(sent_list), args.hier)
+    return hiercontext.gather_windows(embeddings, index)
+
+def read_hypotheses(lines):
+    '''Encode the hypotheses of a text n-best file'''
+    hyp_ids = []
+    ac_scores = []
+    lm_scores = []
+    utterances = []
+    for line in lines:
+        linevec = line.strip().split()
+        # Not sure if we need <eos> at the beginning of the sequence
+        utterance = linevec[4:-1]
+        currentline = []
+        for i, word in enumerate(utterance):
+            if word in dictionary:
+                currentline.append(int(dictionary[word]))
+            else:
+                currentline.append(int(dictionary['OOV']))
+        hyp_ids.append(currentline)
+        ac_scores.append(float(linevec[0]))
+        lm_scores.append(float(linevec[1]))
+        utterances.append(utterance)
+    return hyp_ids, ac_scores, lm_scores, utterances
+
+def context_forwarding(contextfile, model, FLvmodel):
+    '''Context vectors of all utterances, read from the embedding cache when
+       the first level weights, arrangement and context file are unchanged'''
+    if args.saveemb:
+        # atten_shared and hier also use the word embeddings of the 2nd level model
+        weightfiles = [args.FLvmodel]
+        if args.arrange in ['atten_shared', 'hier']:
+            weightfiles.append(args.model)
+        settings = {'arrange': args.arrange, 'maxlen': args.maxlen, 'seglen': args.seglen,
+                    'overlap': args.overlap, 'outputcell': args.outputcell,
+                    'quantize': args.quantize, 'quantemb': args.quantemb,
+                    'directemb': args.directemb,
+                    'hier': args.hier, 'uttlen': args.uttlen, 'amp': args.amp}
+        key = embcache.cache_key(weightfiles, settings, contextfile)
+        cached = embcache.load(args.embcache, key)
+        if cached is not None:
+            logging('Context embeddings read from cache ' + embcache.cache_path(args.embcache, key))
+            return torch.from_numpy(cached).float().to(device)
+    with torch.no_grad():
+        if args.arrange == 'sentence':
+            sent_dict, totalutt = FLvForwarding(contextfile, FLvmodel)
+        elif args.arrange == 'segment':
+            if args.overlap == 0:
+                sent_dict = FLvFixedForwarding(contextfile, FLvmodel)
+            else:
+                sent_dict = FLvSegOverlapForwarding(contextfile, FLvmodel)
+        elif args.arrange == 'attention':
+            sent_dict = FLvAttenForwarding(contextfile, FLvmodel)
+        elif args.arrange == 'atten_shared':
+            sent_dict = SharedFLvAttenForwarding(contextfile, FLvmodel, model)
+        elif args.arrange == 'hier':
+            sent_dict = HierFLvForwarding(contextfile, FLvmodel, model)
+    # one row per utterance
+    sent_dict = torch.stack([sent_dict[i].view(-1) for i in range(len(sent_dict))]).float()
+    if args.saveemb:
+        embcache.save(args.embcache, key, sent_dict.cpu().numpy(), args.embdtype)
+        logging('Context embeddings saved to ' + embcache.cache_path(args.embcache, key))
+    return sent_dict
+
 # Forward each sentence in the nbest list
-def forward_each_utterance(model, line, forwardCrit, utt_idx, ngram_probs, aux_in, hidden):
+def forward_each_utterance(model, ids, acoustic_score, utterance, forwardCrit, utt_idx, ngram_probs, aux_in, hidden):
     # hidden = model.init_hidden(1)
-    linevec = line.strip().split()
-    acoustic_score = float(linevec[0])
-    lmscore = float(linevec[1])
-    # Not sure if we need <eos> at the beginning of the sequence
-    utterance = linevec[4:-1]
-    currentline = []
-    for i, word in enumerate(utterance):
-        if word in dictionary:
-            currentline.append(int(dictionary[word]))
-        else:
-            currentline.append(int(dictionary['OOV']))
-    currentline = [eosidx] + currentline
+    currentline = [eosidx] + ids
     currenttarget = currentline[1:]
     currenttarget.append(eosidx)
     targets = torch.LongTensor(currenttarget).to(device)
     input = torch.LongTensor(currentline).to(device)
     input = input.view(1, -1).t()
     n = input.size(0)
-    # Expand the auxiliary input feature
-    aux_in = aux_in.repeat(n, 1).view(n, 1, -1)
-    output, hidden, penalty = model(input, aux_in, hidden, eosidx=eosidx, device=device)
-    logProb = forwardCrit(output.view(-1, ntokens), targets)
+    # The same auxiliary input feature at every position
+    auxind = torch.zeros(n, 1, dtype=torch.long, device=device)
+    output, hidden, penalty = model(input, aux_in.view(1, -1), hidden, eosidx=eosidx, device=device, auxind=auxind)
+    logProb = forwardCrit(output.view(-1, ntokens).float(), targets)
     if args.interp:
-        ngram_probs = torch.tensor([float(prob)/args.gscale for prob in ngram_probs])
-        log_prob_ngram = ngram_probs.to(device)
+        log_prob_ngram = (torch.as_tensor(ngram_probs) / args.gscale).to(device)
         rnnProbs = torch.exp(log_prob_ngram) * args.factor + torch.exp(-logProb) * (1 - args.factor)
         rnnscore = - float(torch.log(rnnProbs).sum())
     else:
@@ -411,169 +574,390 @@ def forward_each_utterance(model, line, forwardCrit, utt_idx, ngram_probs, aux_i
     # Calculate total score
     total_score = - rnnscore * args.rnnscale + acoustic_score
     out = '\t'.join([str(utt_idx), str(acoustic_score), '{:5.2f}'.format(rnnscore), '{:5.2f}'.format(total_score), ' '.join(utterance)+' <eos>\n'])
-    return out, total_score, utterance, hidden
+    return out, total_score, utterance, hidden, -logProb
 
 # Forward each utterance batched
-def forward_each_utt_batched(model, lines, forwardCrit, utt_name, aux_in, hidden):
-    # Process each line
-    inputs = []
-    targets = []
-    ac_scores = []
-    maxlen = 0
-    utterances = []
-    for line in lines:
-        linevec = line.strip().split()
-        ac_score = float(linevec[0])
-        utterance = linevec[4:-1]
-        currentline = []
-        for i, word in enumerate(utterance):
-            if word in dictionary:
-                currentline.append(int(dictionary[word]))
-            else:
-                currentline.append(int(dictionary['OOV']))
-        currentline = [eosidx] + currentline
-        currenttarget = currentline[1:]
-        currenttarget.append(eosidx)
-        inputs.append(currentline)
-        targets.append(currenttarget)
-        utterances.append(utterance)
-        ac_scores.append(ac_score)
-        if len(currentline) > maxlen:
-            maxlen = len(currentline)
-    mask = []
+def forward_each_utt_batched(model, hyp_ids, ac_scores, forwardCrit, utt_name, aux_in, hidden):
+    # Hypotheses with the same word sequence (pronunciation or timing variants)
+    # are forwarded once and their LM score is shared
+    unique_keys, hyp_to_unique = hypscore.unique_sequences([tuple(ids) for ids in hyp_ids])
+    unique_ids = [list(ids) for ids in unique_keys]
+    ndup = len(hyp_ids) - len(unique_ids)
+    # Process each unique hypothesis
     ac_score_tensor = torch.tensor(ac_scores).to(device)
-    for i, symbols in enumerate(inputs):
-        inputs[i] = symbols + [eosidx] * (maxlen - len(symbols))
-        targets[i] = targets[i] + [eosidx] * (maxlen - len(symbols))
-        mask.append([1.0] * len(symbols) + [0.0] * (maxlen - len(symbols)))
-    input_tensor = torch.LongTensor(inputs).to(device).t().contiguous()
-    target_tensor = torch.LongTensor(targets).to(device).t().contiguous()
-    mask_tensor = torch.tensor(mask).to(device).t().contiguous()
+    input_tensor, target_tensor, mask_tensor, lengths = hypscore.pad_hypotheses(unique_ids, eosidx, device)
     bsize = input_tensor.size(1)
     seq_len = input_tensor.size(0)
-    aux_in = aux_in.repeat(seq_len, bsize, 1)
-    hidden = model.init_hidden(bsize)
-    output, hidden, _ = model(input_tensor, aux_in, hidden, eosidx=eosidx, device=device)
-    logProb = F.cross_entropy(output.view(-1, ntokens), target_tensor.view(-1), reduction='none')
-    rnnscores = torch.sum(logProb.view(seq_len, bsize)*mask_tensor, 0)
+    if args.backend == 'onnxruntime':
+        token_logprobs, logprobs = onnx_rescorer.score(input_tensor, aux_in.view(1, -1).expand(bsize, -1),
+                                                       target_tensor, mask_tensor)
+        logProb = -token_logprobs
+        rnnscores = -logprobs
+        hidden = None
+    elif args.packed:
+        # decoder and loss on the real positions only, hypothesis by hypothesis
+        output, hidden = model.forward_packed(input_tensor, aux_in.view(1, -1).expand(bsize, -1),
+                                              lengths.to(device), device=device)
+        logProb = F.cross_entropy(output.float(), target_tensor.t()[mask_tensor.t() > 0], reduction='none')
+        offsets = torch.cat([lengths.new_zeros(1), torch.cumsum(lengths, 0)]).to(device)
+        cumulative = torch.cat([logProb.new_zeros(1, dtype=torch.float64), torch.cumsum(logProb.double(), 0)])
+        rnnscores = (cumulative[offsets[1:]] - cumulative[offsets[:-1]]).float()
+    elif args.incremental:
+        # every distinct prefix is forwarded once, the cache also keeps them across calls
+        histories = [tuple(ids[:j]) for ids in unique_ids for j in range(len(ids) + 1)]
+        history_index = {}
+        history_of_pos = [history_index.setdefault(h, len(history_index)) for h in histories]
+        logprobs = incremental_lm.logprobs(utt_name, aux_in.view(1, -1), list(history_index))
+        token_targets = torch.LongTensor([w for ids in unique_ids for w in ids + [eosidx]]).to(device)
+        logProb = -logprobs[torch.LongTensor(history_of_pos).to(device), token_targets]
+        offsets = torch.cat([lengths.new_zeros(1), torch.cumsum(lengths, 0)]).to(device)
+        cumulative = torch.cat([logProb.new_zeros(1, dtype=torch.float64), torch.cumsum(logProb.double(), 0)])
+        rnnscores = (cumulative[offsets[1:]] - cumulative[offsets[:-1]]).float()
+        hidden = None
+    elif args.auxgate:
+        # one context for the whole batch, its gate contribution is computed once
+        hidden = model.init_hidden(bsize)
+        auxind = torch.zeros(seq_len, bsize, dtype=torch.long, device=device)
+        output, hidden, _ = model.forward_auxgate(input_tensor, aux_in.view(1, -1), auxind, hidden,
+                                                  eosidx=eosidx, device=device)
+        logProb = F.cross_entropy(output.view(-1, ntokens).float(), target_tensor.view(-1), reduction='none')
+        rnnscores = torch.sum(logProb.view(seq_len, bsize)*mask_tensor, 0)
+    else:
+        # one context for the whole batch, it is compressed once
+        auxind = torch.zeros(seq_len, bsize, dtype=torch.long, device=device)
+        logProb, rnnscores, hidden = hypscore.score_hypotheses(
+            model, input_tensor, target_tensor, mask_tensor, aux_in.view(1, -1), auxind, eosidx, device)
+    # back to one score per hypothesis
+    rnnscores = rnnscores[torch.LongTensor(hyp_to_unique).to(rnnscores.device)]
     total_scores = - rnnscores *args.rnnscale + ac_score_tensor
     # Get output in some format
     outputlines = []
-    for i, utt in enumerate(utterances):
+    for i in range(len(hyp_ids)):
         out = ' '.join([utt_name+'-'+str(i+1), '{:5.2f}'.format(rnnscores[i])])
         outputlines.append(out+'\n')
-    max_ind = torch.argmax(total_scores)
-    best_utt = utterances[max_ind]
-    best_hid = (hidden[0][:, max_ind, :], hidden[1][:, max_ind, :])
-    return best_utt, best_hid, outputlines
+    max_ind = int(torch.argmax(total_scores))
+    best_hid = None
+    if hidden is not None:
+        best_unique = hyp_to_unique[max_ind]
+        best_hid = (hidden[0][:, best_unique, :], hidden[1][:, best_unique, :])
+    # Per-token log-probs are only kept when the raw scores are saved
+    token_logprobs = None
+    if args.savescores and (args.packed or args.incremental) and args.backend != 'onnxruntime':
+        unique_logprobs = [tokens.numpy() for tokens in torch.split(-logProb.cpu(), lengths.tolist())]
+        token_logprobs = [unique_logprobs[u] for u in hyp_to_unique]
+    elif args.savescores:
+        logProb = -logProb.view(seq_len, bsize).cpu()
+        token_logprobs = [logProb[:len(unique_ids[u])+1, u].numpy() for u in hyp_to_unique]
+    return max_ind, best_hid, outputlines, token_logprobs, ndup
+
+def utterance_name(nbest, utt_idx):
+    if args.nbestbin:
+        return nbest.name(utt_idx)
+    return nbest[utt_idx].split('/')[-1]
+
+def load_utterance(nbest, utt_idx):
+    '''nbest: NbestArchive or list of n-best files'''
+    labname = utterance_name(nbest, utt_idx) + '.rec'
+    utterances = None
+    if args.nbestbin:
+        hyp_ids = [ids.tolist() for ids in nbest.token_ids(utt_idx)]
+        ac_scores, lm_scores = [scores.tolist() for scores in nbest.scores(utt_idx)]
+        # Words are only decoded when they have to be written out
+        if args.interp or args.savescores:
+            utterances = [nbest.words(utt_idx, i) for i in range(len(hyp_ids))]
+    else:
+        with open(nbest[utt_idx]) as uttfile:
+            hyp_ids, ac_scores, lm_scores, utterances = read_hypotheses(uttfile.readlines())
+    return labname, hyp_ids, ac_scores, lm_scores, utterances
+
+def load_ngram_probs(ngram, utt_idx):
+    '''ngram: NgramProbStore or list of n-gram probability files'''
+    if args.ngrambin:
+        return [torch.from_numpy(probs) for probs in ngram.utterance(utt_idx)]
+    with open(ngram[utt_idx]) as ngram_probfile:
+        return [torch.tensor(parse_probline(line)) for line in ngram_probfile if line.strip() != '']
+
+def rescore_utterances(model, nbest, ngram, sent_dict, utt_indices):
+    '''Rescores the given utterances in order, returns one (labname, best words,
+       .renew lines, raw scores, no. of duplicate hypotheses) tuple per utterance'''
+    prev_hid = model.init_hidden(1)
+    if args.interp:
+        forwardCrit = torch.nn.CrossEntropyLoss(reduction='none')
+    else:
+        forwardCrit = torch.nn.CrossEntropyLoss()
+    totalutt = len(sent_dict)
+    results = []
+    with torch.no_grad():
+        for count, utt_idx in enumerate(utt_indices):
+            labname, hyp_ids, ac_scores, lm_scores, utterances = load_utterance(nbest, utt_idx)
+            # Fill in contexts for utterance embeddings indexing
+            if args.arrange == 'sentence':
+                current_context = []
+                for i in context_shift:
+                    if i + utt_idx < 0:
+                        current_context.append(sent_dict[0])
+                    elif i + utt_idx >= totalutt-1:
+                        current_context.append(sent_dict[totalutt-1])
+                    else:
+                        current_context.append(sent_dict[i+utt_idx])
+                current_aux_in = torch.cat(current_context)
+            elif args.arrange in ['segment', 'attention', 'atten_shared', 'hier']:
+                current_aux_in = sent_dict[utt_idx]
+            # Load ngram probabilities, only needed for interpolation
+            if args.interp:
+                ngram_prob_lines = load_ngram_probs(ngram, utt_idx)
+            uttscore = []
+            # Do re-ranking batch by batch
+            if not args.interp:
+                best_ind, prev_hid, to_write, token_logprobs, ndup = forward_each_utt_batched(model, hyp_ids, ac_scores, forwardCrit, labname[:-4], current_aux_in, prev_hid)
+            else:
+                ndup = 0
+                to_write = []
+                token_logprobs = []
+                for i, ids in enumerate(hyp_ids):
+                    ngram_probs = ngram_prob_lines[i]
+                    outputline, score, utt, hid, logprobs = forward_each_utterance(model, ids, ac_scores[i], utterances[i], forwardCrit, utt_idx, ngram_probs, current_aux_in, prev_hid)
+                    to_write.append(outputline)
+                    token_logprobs.append(logprobs.cpu().numpy())
+                    uttscore.append((i, score, hid))
+                bestutt_group = max(uttscore, key=itemgetter(1))
+                best_ind = bestutt_group[0]
+                prev_hid = bestutt_group[2]
+            if args.nbestbin:
+                bestutt = nbest.words(utt_idx, best_ind)
+            else:
+                bestutt = utterances[best_ind]
+            raw_scores = None
+            if args.savescores:
+                raw_scores = (labname[:-4], ac_scores, lm_scores, token_logprobs, utterances,
+                              [probs.numpy() for probs in ngram_prob_lines] if args.interp else None)
+            results.append((labname, bestutt, to_write, raw_scores, ndup))
+            if (count + 1) % 100 == 0:
+                logging(str(count + 1))
+    return results
+
+def meeting_shards(nbest, nutts, nshards):
+    '''Groups utterances by meeting (from the --map names) and spreads the
+       meetings over nshards, largest first onto the least loaded shard'''
+    mapping = read_namemap(args.map)
+    meetings = {}
+    for utt_idx in range(nutts):
+        meeting = mapping[utterance_name(nbest, utt_idx)].split('_')[1]
+        meetings.setdefault(meeting, []).append(utt_idx)
+    shards = [[] for i in range(nshards)]
+    for utts in sorted(meetings.values(), key=len, reverse=True):
+        min(shards, key=len).extend(utts)
+    return [shard for shard in shards if shard != []]
+
+# Set in the parent before forking, workers read the models and inputs from here
+shard_inputs = {}
+
+def rescore_shard(utt_indices):
+    torch.set_num_threads(shard_inputs['nthreads'])
+    with precision.autocast(device, args.amp):
+        return utt_indices, rescore_utterances(shard_inputs['model'], shard_inputs['nbest'],
+                                               shard_inputs['ngram'], shard_inputs['sent_dict'], utt_indices)
 
 def forward_nbest_utterance(model, FLvmodel, nbestfile):
     start_time = time.time()
     logging('Start calculating language model scores')
     model.eval()
     model.set_mode('eval')
-    prev_hid = model.init_hidden(1)
     FLvmodel.eval()
     FLvmodel.set_mode('eval')
-    if args.interp:
-        forwardCrit = torch.nn.CrossEntropyLoss(reduction='none')
-    else:
-        forwardCrit = torch.nn.CrossEntropyLoss()
-    ngram_cursor = 0
-    to_write = []
     lmscored_lines = []
     best_utt_list = []
-    emb_list = []
-    utt_idx = 0
-    ngram_probs = []
+    # --interp carries the hidden state of each 1-best, which only a reset model discards
+    score_writer = ScoreWriter(carried_state=args.interp and not model.reset)
     # Ngram used for lattice rescoring
-    ngram_listfile = open(args.ngram)
+    ngram = None
+    if args.interp and args.ngrambin:
+        ngram = NgramProbStore(args.ngram)
+    elif args.interp:
+        with open(args.ngram) as ngram_listfile:
+            ngram = [line.strip() for line in ngram_listfile]
     # get context sentences
-    with torch.no_grad():
-        if args.arrange == 'sentence':
-            sent_dict, totalutt = FLvForwarding(nbestfile+'.context', FLvmodel)
-        elif args.arrange == 'segment':
-            if args.overlap == 0:
-                sent_dict = FLvFixedForwarding(nbestfile+'.context', FLvmodel)
-            else:
-                sent_dict = FLvSegOverlapForwarding(nbestfile+'.context', FLvmodel)
-        elif args.arrange == 'attention':
-            sent_dict = FLvAttenForwarding(nbestfile+'.context', FLvmodel)
-        elif args.arrange == 'atten_shared':
-            sent_dict = SharedFLvAttenForwarding(nbestfile+'.context', FLvmodel, model)
+    sent_dict = context_forwarding(nbestfile+'.context', model, FLvmodel)
     print('time for forwarding context is {:5.2f}'.format(time.time()-start_time))
-    with open(nbestfile) as filein:
-        with torch.no_grad():
-            for utterancefile in filein:
-                labname = utterancefile.strip().split('/')[-1]
-                labname = labname + '.rec'
-                # Fill in contexts for utterance embeddings indexing
-                if args.arrange == 'sentence':
-                    current_context = []
-                    for i in context_shift:
-                        if i + utt_idx < 0:
-                            current_context.append(sent_dict[0])
-                        elif i + utt_idx >= totalutt-1:
-                            current_context.append(sent_dict[totalutt-1])
-                        else:
-                            current_context.append(sent_dict[i+utt_idx])
-                    current_aux_in = torch.cat(current_context)
-                elif args.arrange in ['segment', 'attention', 'atten_shared']:
-                    current_aux_in = sent_dict[utt_idx]
-                # Load ngram probability file
-                ngram_probfile_name = ngram_listfile.readline()
-                ngram_probfile = open(ngram_probfile_name.strip())
-                ngram_prob_lines = ngram_probfile.readlines()
-                with open(utterancefile.strip()) as uttfile:
-                    uttlines = uttfile.readlines()
-                uttscore = []
-                # Do re-ranking batch by batch
-                if not args.interp:
-                    bestutt, prev_hid, to_write = forward_each_utt_batched(model, uttlines, forwardCrit, labname[:-4], current_aux_in, prev_hid)
-                else:
-                    for i, line in enumerate(uttlines):
-                        ngram_elems = ngram_prob_lines[i].strip().split(' ')
-                        sent_len = int(ngram_elems[0])
-                        ngram_probs = ngram_elems[sent_len+2:]
-                        outputline, score, utt, hid = forward_each_utterance(model, line, forwardCrit, utt_idx, ngram_probs, current_aux_in, prev_hid)
-                        to_write.append(outputline)
-                        uttscore.append((utt, score, hid))
-                    bestutt_group = max(uttscore, key=itemgetter(1))
-                    bestutt = bestutt_group[0]
-                    prev_hid = bestutt_group[2]
-                utt_idx += 1
-                best_utt_list.append((labname, bestutt))
-                lmscored_lines += to_write
-                if utt_idx % 100 == 0:
-                    logging(str(utt_idx))
-                # print(utt_idx)
+    if args.nbestbin:
+        nbest = NbestArchive(nbestfile)
+        nbest.check_dictionary(os.path.join(args.data, 'dictionary.txt'))
+    else:
+        with open(nbestfile) as filein:
+            nbest = [line.strip() for line in filein]
+    nutts = len(nbest)
+    if args.nworkers > 1:
+        # weights and contexts go to shared memory once, workers attach to them
+        model.share_memory()
+        sent_dict.share_memory_()
+        shard_inputs.update({'model': model, 'nbest': nbest, 'ngram': ngram, 'sent_dict': sent_dict,
+                             'nthreads': max(1, torch.get_num_threads() // args.nworkers)})
+        shards = meeting_shards(nbest, nutts, args.nworkers)
+        logging('Rescoring {} utterances in {} meeting shards'.format(nutts, len(shards)))
+        results = [None] * nutts
+        with mp.get_context('fork').Pool(len(shards)) as pool:
+            for utt_indices, shard_results in pool.imap_unordered(rescore_shard, shards):
+                for utt_idx, result in zip(utt_indices, shard_results):
+                    results[utt_idx] = result
+    else:
+        results = rescore_utterances(model, nbest, ngram, sent_dict, range(nutts))
+    # Merge back in the original order
+    nhyps = 0
+    nduplicates = 0
+    for labname, bestutt, to_write, raw_scores, ndup in results:
+        best_utt_list.append((labname, bestutt))
+        nhyps += len(to_write)
+        nduplicates += ndup
+        lmscored_lines += to_write
+        if args.savescores:
+            score_writer.add_utterance(*raw_scores)
     with open(nbestfile+'.renew.'+args.lm, 'w') as fout:
         fout.writelines(lmscored_lines)
+    logging('Scored {} hypotheses, {} duplicate word sequences scored once'.format(nhyps, nduplicates))
+
+    if args.savescores:
+        score_writer.save(args.savescores)
+        logging('Raw hypothesis scores saved to ' + args.savescores)
+
+    mapping = read_namemap(args.map)
+    write_1best(nbestfile + '.1best.'+args.lm, best_utt_list, mapping)
+    print('total time used is {:5.2f}'.format(time.time()-start_time))
+
+def stream_nbest_utterance(model, FLvmodel, nbestfile):
+    '''Online rescoring: n-best files are read one by one as they arrive
+       (nbestfile may be - for stdin), and each utterance is written out as
+       soon as --lookahead future words are available. The previous context
+       is a rolling buffer of the rescored 1-best words, the future context
+       the first (first pass best) hypothesis of the following n-best files,
+       padded with <eos> as at the end of a file'''
+    start_time = time.time()
+    logging('Start streaming rescoring')
+    model.eval()
+    model.set_mode('eval')
+    FLvmodel.eval()
+    FLvmodel.set_mode('eval')
+    forwardCrit = torch.nn.CrossEntropyLoss()
+    mapping = read_namemap(args.map)
+    outname = 'stream' if nbestfile == '-' else nbestfile
+    renew_out = open(outname+'.renew.'+args.lm, 'w')
+    mlf_out = open(outname+'.1best.'+args.lm, 'w')
+    mlf_out.write('#!MLF!#\n')
+    prev_tokens = deque([eosidx] * args.maxlen, maxlen=args.maxlen)
+    pending = deque()
+    lookahead = min(args.lookahead, args.maxlen)
+    latencies = []
+    duplicates = [0]
+
+    def future_words():
+        return sum(len(utt[2][0]) for utt in list(pending)[1:])
+
+    def emit():
+        arrival, labname, hyp_ids, ac_scores, lm_scores, utterances = pending.popleft()
+        sent_tank_post = []
+        for utt in pending:
+            sent_tank_post += utt[2][0]
+            if len(sent_tank_post) >= lookahead:
+                break
+        sent_tank_post = sent_tank_post[:lookahead]
+        sent_tank_post += [eosidx] * (args.maxlen - len(sent_tank_post))
+        aux_in = shared_atten_context(model, FLvmodel, list(prev_tokens), sent_tank_post)
+        best_ind, _, to_write, _, ndup = forward_each_utt_batched(
+            model, hyp_ids, ac_scores, forwardCrit, labname[:-4], aux_in, None)
+        duplicates[0] += ndup
+        prev_tokens.extend(hyp_ids[best_ind])
+        renew_out.writelines(to_write)
+        renew_out.flush()
+        write_entry(mlf_out, mapping[labname[:-4]], utterances[best_ind])
+        mlf_out.flush()
+        latencies.append(time.time() - arrival)
 
-    mapping = {}
-    with open(args.map) as fin:
-        for line in fin:
-            value, key, _, ctmstart, _ = line.split()
-            _, meeting, headset, _ = value.split('_')
-            mapping[key] = value
-    with open(nbestfile + '.1best.'+args.lm, 'w') as fout:
-        fout.write('#!MLF!#\n')
-        for eachutt in best_utt_list:
-            labname = mapping[eachutt[0][:-4]]
-            start = 100000
-            end = 200000
-            fout.write('\"'+labname+'\"\n')
-            for eachword in eachutt[1]:
-                if eachword[0] == '\'':
-                    eachword = '\\' + eachword
-                fout.write(str(start) + ' ' + str(end) + ' ' + eachword+'\n')
-                start += 100000
-                end += 100000
-            fout.write('.\n')
+    fin = contextlib.nullcontext(sys.stdin) if nbestfile == '-' else open(nbestfile)
+    with fin as lines, torch.no_grad():
+        for line in lines:
+            if line.strip() == '':
+                continue
+            with open(line.strip()) as uttfile:
+                hyps = read_hypotheses([l for l in uttfile if l.strip() != ''])
+            labname = line.strip().split('/')[-1] + '.rec'
+            if hyps[0] == []:
+                # nothing to rescore, and no first pass best for the future context
+                logging('Skipping {}: no hypotheses'.format(labname[:-4]))
+                continue
+            pending.append((time.time(), labname) + hyps)
+            while pending and future_words() >= lookahead:
+                emit()
+        # end of stream, the remaining future context is padded
+        while pending:
+            emit()
+    renew_out.close()
+    mlf_out.close()
+    if latencies:
+        latencies.sort()
+        logging('Streamed {} utterances | mean latency {:5.1f} ms | p99 {:5.1f} ms'.format(
+            len(latencies), 1000 * sum(latencies) / len(latencies),
+            1000 * latencies[min(len(latencies)-1, int(0.99 * len(latencies)))]))
+        logging('{} duplicate word sequences scored once'.format(duplicates[0]))
+    print('total time used is {:5.2f}'.format(time.time()-start_time))
+
+def forward_lattices(model, FLvmodel, latlist):
+    '''Rescores the HTK lattices listed in latlist, with the .context file of
+       the list giving the context of each utterance as for n-best lists'''
+    start_time = time.time()
+    logging('Start lattice rescoring')
+    model.eval()
+    model.set_mode('eval')
+    FLvmodel.eval()
+    FLvmodel.set_mode('eval')
+    sent_dict = context_forwarding(latlist+'.context', model, FLvmodel)
+    with open(latlist) as filein:
+        latfiles = [line.strip() for line in filein if line.strip() != '']
+    rescorer = LatticeRescorer(model, dictionary, eosidx, int(dictionary['OOV']), nhist=args.lathist,
+                               lmscale=args.rnnscale, wdpenalty=args.wdpenalty,
+                               factor=args.factor if args.interp else None, device=device)
+    if args.latdir and not os.path.isdir(args.latdir):
+        os.makedirs(args.latdir)
+    best_utt_list = []
+    nodes_in = 0
+    nodes_out = 0
+    with torch.no_grad():
+        for utt_idx, latfile in enumerate(latfiles):
+            lattice = read_slf(latfile)
+            expanded, bestutt = rescorer.rescore(lattice, sent_dict[utt_idx].view(1, -1))
+            nodes_in += len(lattice.nodes)
+            nodes_out += len(expanded.nodes)
+            name = os.path.basename(latfile)
+            for ext in ['.gz', '.lat']:
+                if name.endswith(ext):
+                    name = name[:-len(ext)]
+            best_utt_list.append((name + '.rec', bestutt))
+            if args.latdir:
+                write_slf(os.path.join(args.latdir, os.path.basename(latfile)), expanded)
+            if (utt_idx + 1) % 100 == 0:
+                logging(str(utt_idx + 1))
+    logging('Rescored {} lattices | {} nodes expanded to {} ({} last words per state)'.format(
+        len(latfiles), nodes_in, nodes_out, args.lathist))
+    mapping = read_namemap(args.map)
+    write_1best(latlist + '.1best.'+args.lm, best_utt_list, mapping)
     print('total time used is {:5.2f}'.format(time.time()-start_time))
 
 # Main code begins
 model = readin_model()
 FLvmodel = readin_FLvmodel()
+if args.directemb and not getattr(FLvmodel, 'direct', False):
+    # the setting is saved with the model, an LSTM encoder cannot be switched
+    raise ValueError('--directemb needs a first level model trained with jointtrain_singleseg.py --directemb')
+if args.projtable:
+    model.set_projection_table(half=args.projhalf)
+if args.incremental:
+    incremental_lm = IncrementalLM(model, eosidx, capacity=args.statecache, device=device)
+if args.backend == 'onnxruntime':
+    from onnxexport import OnnxRescorer
+    onnx_rescorer = OnnxRescorer(args.onnxdir)
 print('getting utterances')
-forward_nbest_utterance(model, FLvmodel, args.nbest)
+with precision.autocast(device, args.amp):
+    if args.lattice:
+        forward_lattices(model, FLvmodel, args.nbest)
+    elif args.stream:
+        stream_nbest_utterance(model, FLvmodel, args.nbest)
+    else:
+        forward_nbest_utterance(model, FLvmodel, args.nbest)
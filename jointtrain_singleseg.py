@@ -4,10 +4,15 @@ import argparse
 import sys, os
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import math
 import gc
 
 import L2joint_dataloader_atten
+import hiercontext
+import sparseemb
+import precision
 from model import RNNModel
 from L2model import L2RNNModel
 from AttenFlvmodel import AttenFlvModel
@@ -104,8 +109,42 @@ parser.add_argument('--randsample', action='store_true',
                     help='sample randomly, no acoustic error distributions')
 parser.add_argument('--tied', action='store_true',
                     help='Tie weights between encoder and decoder')
+parser.add_argument('--ckptctx', action='store_true',
+                    help='activation checkpointing of the first level context encoder, recomputed in backward')
+parser.add_argument('--ckptl2', action='store_true',
+                    help='activation checkpointing of the second level LSTM, recomputed in backward')
+parser.add_argument('--teacher', type=str, default='',
+                    help='distillation: 2nd level teacher model, the trained models are the student')
+parser.add_argument('--teacherFLv', type=str, default='',
+                    help='distillation: 1st level model of the teacher')
+parser.add_argument('--kdweight', type=float, default=0.5,
+                    help='distillation: weight of the teacher distribution loss, 1 - weight on the reference')
+parser.add_argument('--kdtemp', type=float, default=1.0,
+                    help='distillation: softmax temperature of teacher and student')
+parser.add_argument('--flvnhid', type=int, default=0,
+                    help='--useatten: hidden size of the first level LSTM (0 = that of the pretrained --FLvmodel)')
+parser.add_argument('--amp', type=str, default='fp32', choices=precision.AMP_MODES,
+                    help='bf16: LSTM, attention and decoder matmuls under bfloat16 autocast, loss and weights in fp32')
+parser.add_argument('--cechunk', type=int, default=0,
+                    help='decode and compute the loss this many positions at a time, recomputing in backward (0 = off)')
+parser.add_argument('--sparseemb', action='store_true',
+                    help='sparse word embedding gradients for the 2nd level LM, only the rows of each batch are updated')
+parser.add_argument('--hier', type=int, default=0,
+                    help='hierarchical context: attend over K previous and K future utterance embeddings (0 = off)')
+parser.add_argument('--uttlen', type=int, default=36,
+                    help='--hier: no. of words of each utterance the first level LM encodes')
+parser.add_argument('--auxgate', action='store_true',
+                    help='project each context through the LSTM input weights once, not per token '
+                         '(in evaluation; training projects per token for the per-position context dropout)')
 args = parser.parse_args()
 
+if args.hier and not args.useatten:
+    raise ValueError('--hier needs the attentive first level model (--useatten)')
+if args.teacher and (not args.useatten or args.teacherFLv == '' or args.cechunk > 0):
+    raise ValueError('--teacher needs --useatten and --teacherFLv, and the full logits (no --cechunk)')
+if args.sparseemb and args.tied:
+    raise ValueError('--sparseemb cannot be combined with --tied, the decoder gradient is dense')
+
 device = torch.device("cuda" if args.cuda else "cpu")
 
 def logging(s, print_=True, log_=True):
@@ -132,6 +171,7 @@ arglist.append(('Context', args.context))
 arglist.append(('Update delay', args.updatedelay))
 arglist.append(('No. of output cells', args.outputcell))
 arglist.append(('First level LM', args.FLvmodel))
+arglist.append(('First level hidden size', args.flvnhid))
 arglist.append(('Train from scratch', args.scratch))
 arglist.append(('Max no. of previous words', args.maxlen_prev))
 arglist.append(('Max no. of future words', args.maxlen_post))
@@ -237,6 +277,100 @@ def get_batch_emb(embeddings, data):
     batched_word_embeddings = torch.index_select(embeddings, 0, data.view(-1))
     return batched_word_embeddings.view(data.size(0), data.size(1), -1)
 
+# Seconds spent encoding context in the current epoch, for the encoder speed report
+context_time = [0.0]
+
+def checkpointed(enable, function, *inputs):
+    '''function(*inputs), only keeping its inputs and outputs for backward
+       when enable is set and gradients are being recorded'''
+    if enable and torch.is_grad_enabled():
+        return checkpoint(function, *inputs, use_reentrant=False)
+    return function(*inputs)
+
+def encode_contexts(model, FLvmodel, prev_utts_tensor, post_utts_tensor, original_bsize, emb_size):
+    '''Pooled previous and future context vectors [original_bsize, -1] and their
+       attention penalties. When both sides have segments of the same length
+       they are stacked along the batch and encoded in one FLvmodel call.'''
+    if args.cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    FLvbatchsize = prev_utts_tensor.size(0)
+    if args.maxlen_prev != 0 and args.maxlen_post != 0 and prev_utts_tensor.size(1) == post_utts_tensor.size(1):
+        utts_tensor = torch.cat([prev_utts_tensor, post_utts_tensor], 0).t().contiguous().to(device)
+        FLvhidden = FLvmodel.init_hidden(utts_tensor.size(1))
+        prev_extracted, prevpenalty, post_extracted, postpenalty = checkpointed(
+            args.ckptctx, lambda ids: FLvmodel.forward_pair(
+                model.get_word_emb(ids), FLvbatchsize, FLvhidden, device=device, eosidx=eosidx), utts_tensor)
+    else:
+        encode = lambda ids, FLvhidden: FLvmodel(model.get_word_emb(ids), FLvhidden, device=device, eosidx=eosidx)
+        if args.maxlen_prev != 0:
+            FLvhidden = FLvmodel.init_hidden(FLvbatchsize)
+            prev_extracted, prevpenalty = checkpointed(
+                args.ckptctx, encode, prev_utts_tensor.t().contiguous().to(device), FLvhidden)
+        else:
+            prev_extracted, prevpenalty = (torch.zeros(FLvbatchsize, emb_size*args.nhead).to(device), 0)
+        if args.maxlen_post != 0:
+            FLvhidden = FLvmodel.init_hidden(post_utts_tensor.size(0))
+            post_extracted, postpenalty = checkpointed(
+                args.ckptctx, encode, post_utts_tensor.t().contiguous().to(device), FLvhidden)
+        else:
+            post_extracted, postpenalty = (torch.zeros(FLvbatchsize, emb_size*args.nhead).to(device), 0)
+    if args.cuda:
+        torch.cuda.synchronize()
+    context_time[0] += time.time() - start
+    return (prev_extracted.view(original_bsize, -1), prevpenalty,
+            post_extracted.view(original_bsize, -1), postpenalty)
+
+def flat_contexts(model, FLvmodel, batch_ids, emb_size):
+    '''Context rows [nutt, -1] of the utterances of a batch: previous and
+       future context vectors side by side, their lookup and the penalty'''
+    prev_utts, post_utts, ind_lookup = batch_ids
+    prev_utts_tensor = prev_utts.view(-1, max(1, args.maxlen_prev))
+    post_utts_tensor = post_utts.view(-1, max(1, args.maxlen_post))
+
+    # Try splitting the context
+    original_bsize = prev_utts_tensor.size(0)
+    if args.maxlen_prev % args.seglen == 0:
+        prev_utts_tensor = prev_utts_tensor.view(-1, args.seglen)
+    if args.maxlen_post % args.seglen == 0:
+        post_utts_tensor = post_utts_tensor.view(-1, args.seglen)
+    prev_extracted, prevpenalty, post_extracted, postpenalty = encode_contexts(
+        model, FLvmodel, prev_utts_tensor, post_utts_tensor, original_bsize, emb_size)
+    return torch.cat([prev_extracted, post_extracted], 1), ind_lookup.to(device), prevpenalty + postpenalty
+
+def hier_contexts(model, FLvmodel, ind, utt_matrix):
+    '''Context rows [nutt, 2*hier*D] of the utterances of a batch: the
+       embeddings of the hier previous and future utterances, each encoded
+       once per batch, their lookup and the penalty'''
+    if args.cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    utt_ids, ind_lookup = hiercontext.unique_utterances(ind.view(-1))
+    context_rows, penalty = hiercontext.encode_windows(model, FLvmodel, utt_matrix, utt_ids, args.hier, device,
+                                                       checkpoint=args.ckptctx)
+    if args.cuda:
+        torch.cuda.synchronize()
+    context_time[0] += time.time() - start
+    return context_rows, ind_lookup.to(device), penalty
+
+def teacher_output(data, ind, batch_ids, utt_matrix, hidden, bsz, seq_len):
+    '''Logits of the teacher on a batch, from its own context vectors'''
+    with torch.no_grad():
+        if args.hier:
+            context_rows, ind_lookup, _ = hier_contexts(teacher, teacherFLvmodel, ind, utt_matrix)
+        else:
+            context_rows, ind_lookup, _ = flat_contexts(teacher, teacherFLvmodel, batch_ids, teacherFLvmodel.nhid)
+        output, hidden, _ = teacher(data, context_rows, hidden, eosidx=eosidx, device=device,
+                                    auxind=ind_lookup.view(seq_len, -1))
+    return output, hidden
+
+def distill_loss(output, teacher_output):
+    '''KL divergence per token from the teacher to the student distribution
+       at temperature kdtemp, scaled by kdtemp^2 to keep the gradient size'''
+    logprobs = F.log_softmax(output.view(-1, ntokens).float() / args.kdtemp, dim=-1)
+    teacher_probs = F.softmax(teacher_output.view(-1, ntokens).float() / args.kdtemp, dim=-1)
+    return F.kl_div(logprobs, teacher_probs, reduction='batchmean') * args.kdtemp ** 2
+
 def debug_print_params(model):
     for name, param in model.named_parameters():
         if param.requires_grad:
@@ -258,57 +392,42 @@ def evaluate(evaldata, sent_ind_batched, utt_dict_prev, utt_dict_post, model,
     prev_batched_embeddings = None
     post_batched_embeddings = None
     with torch.no_grad():
+        if args.hier:
+            # every utterance of the document is encoded once
+            with precision.autocast(device, args.amp):
+                doc_embeddings, _ = hiercontext.encode_utterances(model, FLvmodel, utt_dict_prev, device)
         for batch, i in enumerate(range(0, evaldata.size(0) - 1, args.bptt)):
             data, ind, targets, seq_len = get_batch(evaldata, sent_ind_batched, i)
-            # check if the batch context idices are already filled
-            if batch not in ids_dict:
-                prev_utts, post_utts, ind_lookup = get_needed_utterance(
-		    ind.view(-1), utt_dict_prev, utt_dict_post) 
-                ids_dict[batch] = (prev_utts, post_utts, ind_lookup)
-            else:
-                prev_utts, post_utts, ind_lookup = ids_dict[batch]
-            prev_utts_tensor = prev_utts.view(-1, max(1, args.maxlen_prev))
-            post_utts_tensor = post_utts.view(-1, max(1, args.maxlen_post))
-
-            # Try splitting the context
-            original_bsize = prev_utts_tensor.size(0)
-            if args.maxlen_prev % args.seglen == 0:
-                prev_utts_tensor = prev_utts_tensor.view(-1, args.seglen)
-            if args.maxlen_post % args.seglen == 0:
-                post_utts_tensor = post_utts_tensor.view(-1, args.seglen)
-
-            FLvbatchsize = prev_utts_tensor.size(0)
-            ind_lookup = ind_lookup.to(device)
-            # Forward previous context information
-            batched_embeddings = None
-            if args.useatten:
-                FLvhidden = FLvmodel.init_hidden(FLvbatchsize)
-                if args.maxlen_prev != 0:
-                    prev_embeddings = model.get_word_emb(prev_utts_tensor.t().contiguous().to(device))
-                    prev_extracted, prevpenalty = FLvmodel(
-		        prev_embeddings, FLvhidden, device, eosidx)
+            with precision.autocast(device, args.amp):
+                if args.hier:
+                    utt_ids, ind_lookup = hiercontext.unique_utterances(ind.view(-1))
+                    ind_lookup = ind_lookup.to(device)
+                    context_rows = hiercontext.gather_windows(
+                        doc_embeddings, hiercontext.window_index(utt_ids, utt_dict_prev.size(0), args.hier))
+                # check if the batch context idices are already filled
+                elif batch not in ids_dict:
+                    prev_utts, post_utts, ind_lookup = get_needed_utterance(
+                        ind.view(-1), utt_dict_prev, utt_dict_post)
+                    ids_dict[batch] = (prev_utts, post_utts, ind_lookup)
+                if not args.hier:
+                    context_rows, ind_lookup, _ = flat_contexts(model, FLvmodel, ids_dict[batch], emb_size)
+
+                # Here begins the forward path for second level LM
+                outputflag = 1 if args.cechunk > 0 else 0
+                if args.auxgate:
+                    output, hidden, penalty = model.forward_auxgate(
+                        data, context_rows, ind_lookup.view(seq_len, -1), hidden, eosidx=eosidx, device=device,
+                        outputflag=outputflag)
                 else:
-                    prev_extracted, prevpenalty = (
-		        torch.zeros(FLvbatchsize, emb_size*args.nhead).to(device), 0)
-                prev_extracted = prev_extracted.view(original_bsize, -1)
-                auxinput_prev = fill_uttemb_batch(prev_extracted, ind_lookup, eval_batch_size, seq_len)
-                FLvhidden = FLvmodel.init_hidden(FLvbatchsize)
-                if args.maxlen_post != 0:
-                    post_embeddings = model.get_word_emb(post_utts_tensor.t().contiguous().to(device))
-                    post_extracted, postpenalty = FLvmodel(
-		        post_embeddings, FLvhidden, device, eosidx)
+                    # each context row is compressed once, not once per token
+                    output, hidden, penalty = model(
+                        data, context_rows, hidden, eosidx=eosidx, device=device, outputflag=outputflag,
+                        auxind=ind_lookup.view(seq_len, -1))
+                if args.cechunk > 0:
+                    total_loss += model.decode_loss(output, targets, args.cechunk).mean() * len(data)
                 else:
-                    post_extracted, postpenalty = (
-		        torch.zeros(FLvbatchsize, emb_size*args.nhead).to(device), 0)
-                post_extracted = post_extracted.view(original_bsize, -1)
-                auxinput_post = fill_uttemb_batch(post_extracted, ind_lookup, eval_batch_size, seq_len)
-                auxinput = torch.cat([auxinput_prev, auxinput_post], 2)
-
-            # Here begins the forward path for second level LM
-            output, hidden, penalty = model(
-	        data, auxinput, hidden, eosidx=eosidx, device=device)
-            output_flat = output.view(-1, ntokens)
-            total_loss += criterion(output_flat, targets).data * len(data)
+                    output_flat = output.view(-1, ntokens).float()
+                    total_loss += criterion(output_flat, targets).data * len(data)
             total_words += len(data)
             hidden = repackage_hidden(hidden)
             
@@ -339,73 +458,68 @@ def train(traindata, sent_ind_batched, utt_dict_prev, utt_dict_post, model,
         FLvmodel.zero_grad()
         FLvoptimizer = torch.optim.SGD(FLvmodel.parameters(), lr=FLlr, weight_decay=args.wdecay)
     hidden = model.init_hidden(args.batchsize)
+    if args.teacher:
+        teacher_hidden = teacher.init_hidden(args.batchsize)
     # Sentence embedding size
     emb_size = FLvmodel.nhid
     # Use SGD to optimize both LMs, can have different lr
-    optimizer = torch.optim.SGD(model.parameters(), lr=lr, weight_decay=args.wdecay)
+    if args.sparseemb:
+        # the embedding rows of each batch are updated separately
+        optimizer = torch.optim.SGD(sparseemb.split_parameters(model, model.encoder), lr=lr,
+                                    weight_decay=args.wdecay)
+        embOptimizer = sparseemb.SparseEmbeddingSGD(model.encoder, lr, weight_decay=args.wdecay)
+    else:
+        optimizer = torch.optim.SGD(model.parameters(), lr=lr, weight_decay=args.wdecay)
     # optimizer = torch.optim.Adam(model.parameters(), lr=lr)
     start_time = time.time()
     prev_batched_embeddings = None
     post_batched_embeddings = None
     for batch, i in enumerate(range(0, traindata.size(0) - 1, args.bptt)):
         data, ind, targets, seq_len = get_batch(traindata, sent_ind_batched, i)
-        # check if the batch context idices are already filled
-        if batch not in ids_dict:
-            prev_utts, post_utts, ind_lookup = get_needed_utterance(
-                ind.view(-1), utt_dict_prev, utt_dict_post)
-            ids_dict[batch] = (prev_utts, post_utts, ind_lookup)
-        else:
-            prev_utts, post_utts, ind_lookup = ids_dict[batch]
-        prev_utts_tensor = prev_utts.view(-1, max(1, args.maxlen_prev))
-        post_utts_tensor = post_utts.view(-1, max(1, args.maxlen_post))
-
-        # Try splitting the context
-        original_bsize = prev_utts_tensor.size(0)
-        if args.maxlen_prev % args.seglen == 0:
-            prev_utts_tensor = prev_utts_tensor.view(-1, args.seglen)
-        if args.maxlen_post % args.seglen == 0:
-            post_utts_tensor = post_utts_tensor.view(-1, args.seglen)
-
-        FLvbatchsize = prev_utts_tensor.size(0)
-        ind_lookup = ind_lookup.to(device)
-        # Forward previous context information
-        batched_embeddings = None
-        if args.useatten:
-            FLvhidden = FLvmodel.init_hidden(FLvbatchsize)
-            if args.maxlen_prev != 0:
-                prev_embeddings = model.get_word_emb(prev_utts_tensor.t().contiguous().to(device))
-                prev_extracted, prevpenalty = FLvmodel(prev_embeddings,
-		                                       FLvhidden,
-						       device=device,
-						       eosidx=eosidx)
+        hidden = repackage_hidden(hidden)
+        with precision.autocast(device, args.amp):
+            if args.hier:
+                context_rows, ind_lookup, FLvpenalty = hier_contexts(model, FLvmodel, ind, utt_dict_prev)
             else:
-                prev_extracted, prevpenalty = (torch.zeros(FLvbatchsize, emb_size*args.nhead).to(device), 0)
-            prev_extracted = prev_extracted.view(original_bsize, -1)
-            auxinput_prev = fill_uttemb_batch(prev_extracted, ind_lookup, args.batchsize, seq_len)
-            FLvhidden = FLvmodel.init_hidden(FLvbatchsize)
-            if args.maxlen_post != 0:
-                post_embeddings = model.get_word_emb(post_utts_tensor.t().contiguous().to(device))
-                post_extracted, postpenalty = FLvmodel(post_embeddings,
-		                                       FLvhidden,
-						       device=device,
-						       eosidx=eosidx)
+                # check if the batch context idices are already filled
+                if batch not in ids_dict:
+                    prev_utts, post_utts, ind_lookup = get_needed_utterance(
+                        ind.view(-1), utt_dict_prev, utt_dict_post)
+                    ids_dict[batch] = (prev_utts, post_utts, ind_lookup)
+                context_rows, ind_lookup, FLvpenalty = flat_contexts(model, FLvmodel, ids_dict[batch], emb_size)
+
+            # Forward for the second level LM
+            outputflag = 1 if args.cechunk > 0 else 0
+            if args.auxgate:
+                output, hidden, penalty = checkpointed(
+                    args.ckptl2, lambda context_rows, hidden: model.forward_auxgate(
+                        data, context_rows, ind_lookup.view(seq_len, -1), hidden, eosidx=eosidx, device=device,
+                        outputflag=outputflag), context_rows, hidden)
             else:
-                post_extracted, postpenalty = (torch.zeros(FLvbatchsize, emb_size*args.nhead).to(device), 0)
-            post_extracted = post_extracted.view(original_bsize, -1)
-            auxinput_post = fill_uttemb_batch(post_extracted, ind_lookup, args.batchsize, seq_len)
-            auxinput = torch.cat([auxinput_prev, auxinput_post], 2)
-            FLvpenalty = prevpenalty + postpenalty
-
-        hidden = repackage_hidden(hidden)
-        # Forward for the second level LM
-        output, hidden, penalty = model(data, auxinput, hidden, eosidx=eosidx, device=device)
-
-        loss = criterion(output.view(-1, ntokens), targets)
+                # each context row is compressed once, not once per token
+                output, hidden, penalty = checkpointed(
+                    args.ckptl2, lambda context_rows, hidden: model(
+                        data, context_rows, hidden, eosidx=eosidx, device=device, outputflag=outputflag,
+                        auxind=ind_lookup.view(seq_len, -1)), context_rows, hidden)
+
+            if args.cechunk > 0:
+                # logits are formed chunk by chunk and recomputed in backward
+                loss = model.decode_loss(output, targets, args.cechunk).mean()
+            else:
+                # log-softmax and loss in fp32
+                loss = criterion(output.view(-1, ntokens).float(), targets)
+            trainloss = loss
+            if args.teacher:
+                # the student also fits the teacher's distribution at every position
+                teacher_hidden = repackage_hidden(teacher_hidden)
+                teacher_logits, teacher_hidden = teacher_output(
+                    data, ind, ids_dict.get(batch), utt_dict_prev, teacher_hidden, args.batchsize, seq_len)
+                trainloss = (1 - args.kdweight) * loss + args.kdweight * distill_loss(output, teacher_logits)
 
         if not args.useatten: 
-            loss.backward()
+            trainloss.backward()
         else:
-            ploss = loss + args.alpha * FLvpenalty
+            ploss = trainloss + args.alpha * FLvpenalty
             # import pdb; pdb.set_trace()
             ploss.backward()
 
@@ -419,7 +533,11 @@ def train(traindata, sent_ind_batched, utt_dict_prev, utt_dict_post, model,
             FLvmodel.zero_grad()
         if batch % args.updatedelay == 0:
             # Clip gradients for second level LM
-            torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
+            if args.sparseemb:
+                sparseemb.clip_grad_norm(model.parameters(), args.clip)
+                embOptimizer.step()
+            else:
+                torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
             # Optimise only the second level LM
             optimizer.step()
             model.zero_grad()
@@ -431,13 +549,21 @@ def train(traindata, sent_ind_batched, utt_dict_prev, utt_dict_post, model,
             cur_loss = total_loss / args.log_interval
             cur_penalty = total_penalty / args.log_interval
             elapsed = time.time() - start_time
+            peak_memory = ''
+            if args.cuda:
+                # peak over the last log_interval batches
+                peak_memory = ' | peak mem {:7.1f}MB'.format(torch.cuda.max_memory_allocated() / 2**20)
+                torch.cuda.reset_peak_memory_stats()
             logging('| epoch {:3d} | {:5d}/{:5d} batches | lr {:02.5f} | FLlr {:02.5f} | ms/batch {:5.2f} | '
-                    'loss {:5.2f} | ppl {:8.2f} | penalty {:2.2f}'.format(
+                    'loss {:5.2f} | ppl {:8.2f} | penalty {:2.2f}{}'.format(
                 epoch, batch, traindata.size(0) // args.bptt, lr, FLlr,
-                elapsed * 1000 / args.log_interval, cur_loss, math.exp(cur_loss), float(cur_penalty)))
+                elapsed * 1000 / args.log_interval, cur_loss, math.exp(cur_loss), float(cur_penalty), peak_memory))
             total_loss = 0.
             total_penalty = 0.
             start_time = time.time()
+    if args.sparseemb:
+        # bring the rows no batch touched up to date before evaluation
+        embOptimizer.flush()
     return model, FLvmodel, ids_dict
 
 def loadNgram(path):
@@ -462,14 +588,14 @@ if args.use_sampling:
     train_loader, val_loader, test_loader, dictionary = L2joint_dataloader_atten.create(
         args.data, dictfile, batchSize=1, workers=0, maxlen_prev=args.maxlen_prev,
 	maxlen_post=args.maxlen_post, use_sampling=True, errorfile=args.errorfile,
-	reference=args.reference, ratio=args.ratio, random=args.randsample)
+	reference=args.reference, ratio=args.ratio, random=args.randsample, uttlen=args.uttlen if args.hier else 0)
     train_loader.dataset.dictionary.use_sampling = False
     val_loader.dataset.dictionary.use_sampling = False
     test_loader.dataset.dictionary.use_sampling = False
 else:
     train_loader, val_loader, test_loader, dictionary = L2joint_dataloader_atten.create(
         args.data, dictfile, batchSize=1, workers=0, maxlen_prev=args.maxlen_prev,
-	maxlen_post=args.maxlen_post)
+	maxlen_post=args.maxlen_post, uttlen=args.uttlen if args.hier else 0)
 ntokens = len(dictionary.idx2word)
 eosidx = dictionary.word2idx['<eos>']
 
@@ -478,9 +604,15 @@ logging('Instantiating models and criteria')
 FLvpretrained = torch.load(args.FLvmodel)
 if not args.evalmode:
     if args.useatten:
-        FLvmodel = AttenFlvModel(args.emsize, FLvpretrained.nhid, 1,
-	                         args.nhid, args.dropout, nhead=args.nhead).to(device)
-        FLvmodel.rnn.load_state_dict(FLvpretrained.rnn.state_dict())
+        flvnhid = args.flvnhid if args.flvnhid > 0 else FLvpretrained.nhid
+        FLvmodel = AttenFlvModel(args.emsize, flvnhid, 1,
+	                         args.nhid, args.dropout, nhead=args.nhead,
+	                         direct=args.directemb).to(device)
+        if FLvpretrained.rnn.input_size == args.emsize and FLvpretrained.nhid == flvnhid:
+            FLvmodel.rnn.load_state_dict(FLvpretrained.rnn.state_dict())
+        else:
+            # e.g. a distillation student with a smaller --emsize or --flvnhid
+            logging('Pretrained first level LSTM does not match --emsize/--flvnhid, training it from scratch')
         FLvmodel.rnn.flatten_parameters()
     elif args.scratch:
         FLvmodel = RNNModel(args.model, ntokens, args.emsize, args.nhid, args.nlayers,
@@ -496,11 +628,35 @@ if not args.evalmode:
         prev_sp = args.maxlen_prev // args.seglen
     if args.maxlen_post % args.seglen == 0:
         post_sp = args.maxlen_post // args.seglen
-    model = L2RNNModel(args.model, ntokens, args.emsize, FLvmodel.nhid, args.nhead*(prev_sp+post_sp),
-                       args.naux, args.nhid, args.nlayers, False, args.dropout, reset=args.reset,
-		               nhead=args.nhead, tie_weights=args.tied).to(device)
+    if args.hier:
+        # attend over the 2*hier utterance embeddings of the context
+        model = L2RNNModel(args.model, ntokens, args.emsize, FLvmodel.nhid*args.nhead, 2*args.hier,
+                           args.naux, args.nhid, args.nlayers, True, args.dropout, reset=args.reset,
+                           nhead=args.nhead, tie_weights=args.tied).to(device)
+    else:
+        model = L2RNNModel(args.model, ntokens, args.emsize, FLvmodel.nhid, args.nhead*(prev_sp+post_sp),
+                           args.naux, args.nhid, args.nlayers, False, args.dropout, reset=args.reset,
+                           nhead=args.nhead, tie_weights=args.tied).to(device)
+    model.encoder.sparse = args.sparseemb
 criterion = nn.CrossEntropyLoss()
 interpCrit = nn.CrossEntropyLoss(reduction='none')
+if args.teacher:
+    teacher = torch.load(args.teacher, map_location=device)
+    teacherFLvmodel = torch.load(args.teacherFLv, map_location=device)
+    teacher.rnn.flatten_parameters()
+    teacherFLvmodel.rnn.flatten_parameters()
+    # the teacher stays in evaluation mode and is not updated
+    teacher.eval()
+    teacher.set_mode('eval')
+    teacherFLvmodel.eval()
+    teacherFLvmodel.set_mode('eval')
+    if not args.evalmode:
+        logging('Distilling {} parameters of the teacher into {} of the student'.format(
+            sum(p.numel() for p in list(teacher.parameters()) + list(teacherFLvmodel.parameters())),
+            sum(p.numel() for p in list(model.parameters()) + list(FLvmodel.parameters()))))
+        logging('Context encoder: {} parameters, hidden size {} (teacher {} parameters, hidden size {})'.format(
+            sum(p.numel() for p in FLvmodel.parameters()), FLvmodel.nhid,
+            sum(p.numel() for p in teacherFLvmodel.parameters()), teacherFLvmodel.nhid))
 
 # Start training
 logging('Training Start!')
@@ -588,6 +744,9 @@ if not args.evalmode:
             logging('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.2f} | '
                     'valid ppl {:8.2f}'.format(epoch, (time.time() - epoch_start_time),
                                                val_loss, math.exp(val_loss)))
+            logging('| context encoder {} | context encoding time this epoch {:5.2f}s |'.format(
+                'positional' if args.directemb else 'LSTM', context_time[0]))
+            context_time[0] = 0.0
             logging('-' * 89)
 
             # Do the sampled validation
@@ -695,3 +854,20 @@ logging('=' * 89)
 logging('| End of training | test loss {:5.2f} | test ppl {:8.2f}'.format(
     test_loss, math.exp(test_loss)))
 logging('=' * 89)
+
+# Compare with the teacher on the same test data
+if args.teacher:
+    aggregate_testloss = 0.
+    total_testset = 0
+    for i, test_batched in enumerate(test_loader):
+        for j, segment in enumerate(test_batched):
+            input_seg_file, sent_ind, sent_dict_prev, sent_dict_post = segment
+            data, sent_ind_batched = batchify(input_seg_file, sent_ind, eval_batch_size)
+            teacher_loss, num_of_words, _ = evaluate(data, sent_ind_batched, sent_dict_prev, sent_dict_post,
+                                                     teacher, teacherFLvmodel, test_ids_dict_list[i][j])
+            aggregate_testloss = aggregate_testloss + teacher_loss
+            total_testset += num_of_words
+    teacher_loss = aggregate_testloss / total_testset
+    logging('| Distillation | student test ppl {:8.2f} | teacher test ppl {:8.2f} |'.format(
+        math.exp(test_loss), math.exp(teacher_loss)))
+    logging('=' * 89)
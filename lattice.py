@@ -0,0 +1,220 @@
+"""
+HTK standard lattice format (SLF) reading and writing, and lattice rescoring
+with the second level LM (jointforward.py --lattice).
+Arcs are expanded in topological order. Paths that reach a node with the same
+last n words share one LSTM state, the one of the best partial path, so the
+cost grows with the lattice size rather than the number of paths.
+"""
+import gzip
+import math
+
+import torch
+
+from incremental import stack_states, split_state
+
+NULL_WORDS = {'!NULL'}
+START_WORDS = {'<s>', '!SENT_START'}
+END_WORDS = {'</s>', '!SENT_END'}
+
+class Lattice(object):
+    def __init__(self):
+        self.header = []
+        self.nodes = []
+        self.arcs = []
+
+    def arc_word(self, arc):
+        '''Word of an arc, from the arc or else from its end node'''
+        if 'W' in arc:
+            return arc['W']
+        return self.nodes[int(arc['E'])].get('W', '!NULL')
+
+def parse_fields(line):
+    fields = []
+    for item in line.split():
+        key, _, value = item.partition('=')
+        fields.append((key, value))
+    return fields
+
+def open_lattice(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't')
+    return open(path, mode)
+
+def read_slf(path):
+    lattice = Lattice()
+    with open_lattice(path, 'r') as fin:
+        for line in fin:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            fields = parse_fields(line)
+            key = fields[0][0]
+            if key == 'I':
+                node = dict(fields[1:])
+                lattice.nodes.append(node)
+            elif key == 'J':
+                lattice.arcs.append(dict(fields[1:]))
+            elif key not in ('N', 'L', 'NODES', 'LINKS'):
+                lattice.header += fields
+    return lattice
+
+def write_slf(path, lattice):
+    with open_lattice(path, 'w') as fout:
+        for key, value in lattice.header:
+            fout.write('{}={}\n'.format(key, value))
+        fout.write('N={}\tL={}\n'.format(len(lattice.nodes), len(lattice.arcs)))
+        for i, node in enumerate(lattice.nodes):
+            fout.write('\t'.join(['I={}'.format(i)] + ['{}={}'.format(k, v) for k, v in node.items()]) + '\n')
+        for j, arc in enumerate(lattice.arcs):
+            fout.write('\t'.join(['J={}'.format(j)] + ['{}={}'.format(k, v) for k, v in arc.items()]) + '\n')
+
+class Entry(object):
+    '''A node of the expanded lattice: original node and word history'''
+    __slots__ = ['node', 'history', 'score', 'back', 'parent', 'token', 'state', 'index']
+
+    def __init__(self, node, history):
+        self.node = node
+        self.history = history
+        self.score = -math.inf
+        self.back = None
+        self.parent = None
+        self.token = None
+        self.state = None
+        self.index = None
+
+class LatticeRescorer(object):
+    '''model: L2RNNModel in eval mode (uses init_state/advance/state_logprobs)
+       word2id: word -> id dictionary (values may be strings)
+       nhist: no. of last words that identify an LM state
+       lmscale, wdpenalty, acscale: combination of the arc scores for the 1-best
+       factor: weight of the lattice n-gram score when interpolating, None to replace it'''
+    def __init__(self, model, word2id, eosidx, oovidx, nhist=3, lmscale=10.0, wdpenalty=0.0,
+                 acscale=1.0, factor=None, device='cpu'):
+        self.model = model
+        self.word2id = word2id
+        self.eosidx = eosidx
+        self.oovidx = oovidx
+        self.nhist = nhist
+        self.lmscale = lmscale
+        self.wdpenalty = wdpenalty
+        self.acscale = acscale
+        self.factor = factor
+        self.device = device
+
+    def token(self, word):
+        '''LM token of a word, None for words the LM does not see'''
+        if word in NULL_WORDS or word in START_WORDS:
+            return None
+        if word in END_WORDS:
+            return self.eosidx
+        return int(self.word2id.get(word, self.oovidx))
+
+    def lm_score(self, rnn_logprob, ngram_logprob):
+        if self.factor is None:
+            return rnn_logprob
+        return math.log(self.factor * math.exp(ngram_logprob) + (1 - self.factor) * math.exp(rnn_logprob))
+
+    def rescore(self, lattice, auxiliary):
+        '''auxiliary: [1, naux_in] context vector of the utterance
+           Returns the expanded lattice with rescored l fields and the 1-best words'''
+        nnodes = len(lattice.nodes)
+        outgoing = [[] for i in range(nnodes)]
+        indegree = [0] * nnodes
+        for j, arc in enumerate(lattice.arcs):
+            outgoing[int(arc['S'])].append(j)
+            indegree[int(arc['E'])] += 1
+        entries = [{} for i in range(nnodes)]
+        frontier = [i for i in range(nnodes) if indegree[i] == 0]
+        # every path starts from the state after <eos>
+        start_state = self.model.advance(self.model.init_state(auxiliary, device=self.device),
+                                         torch.LongTensor([self.eosidx]).to(self.device), self.eosidx)
+        for node in frontier:
+            entry = Entry(node, ())
+            entry.score = 0.0
+            entry.state = start_state
+            entries[node][()] = entry
+        expanded = []
+        expanded_arcs = []
+        while frontier:
+            current = [entry for node in frontier for entry in entries[node].values()]
+            for entry in current:
+                entry.index = len(expanded)
+                expanded.append(entry)
+            # states of the entries reached by a word, in one batch
+            pending = [entry for entry in current if entry.state is None and entry.token is not None]
+            if pending:
+                new_state = self.model.advance(stack_states([entry.parent for entry in pending]),
+                                               torch.LongTensor([entry.token for entry in pending]).to(self.device),
+                                               self.eosidx)
+                for entry, state in zip(pending, split_state(new_state)):
+                    entry.state = state
+            for entry in current:
+                if entry.state is None:
+                    entry.state = entry.parent
+                entry.parent = None
+            # next word log-probs of every entry with a word arc leaving it
+            scoring = [entry for entry in current
+                       if any(self.token(lattice.arc_word(lattice.arcs[j])) is not None for j in outgoing[entry.node])]
+            logprobs = {}
+            if scoring:
+                rows = self.model.state_logprobs(stack_states([entry.state for entry in scoring])).cpu()
+                for entry, row in zip(scoring, rows):
+                    logprobs[entry.index] = row
+            next_frontier = []
+            for node in frontier:
+                for entry in entries[node].values():
+                    for j in outgoing[node]:
+                        arc = lattice.arcs[j]
+                        end = int(arc['E'])
+                        token = self.token(lattice.arc_word(arc))
+                        lm = float(arc.get('l', 0.0))
+                        history = entry.history
+                        if token is not None:
+                            lm = self.lm_score(float(logprobs[entry.index][token]), lm)
+                            history = (history + (token,))[-self.nhist:] if self.nhist > 0 else ()
+                        score = (entry.score + self.acscale * float(arc.get('a', 0.0)) + self.lmscale * lm
+                                 + (self.wdpenalty if token is not None else 0.0))
+                        target = entries[end].get(history)
+                        if target is None:
+                            target = Entry(end, history)
+                            entries[end][history] = target
+                        if score > target.score:
+                            target.score = score
+                            target.back = (entry, arc)
+                            target.parent = entry.state
+                            target.token = token
+                        expanded_arcs.append((entry, target, arc, lm))
+                    entry.state = None
+                for j in outgoing[node]:
+                    end = int(lattice.arcs[j]['E'])
+                    indegree[end] -= 1
+                    if indegree[end] == 0:
+                        next_frontier.append(end)
+            frontier = next_frontier
+        return self.expanded_lattice(lattice, expanded, expanded_arcs), self.best_words(lattice, expanded, outgoing)
+
+    def expanded_lattice(self, lattice, expanded, expanded_arcs):
+        out = Lattice()
+        out.header = [(key, value) for key, value in lattice.header if key not in ('lmscale', 'wdpenalty')]
+        out.header += [('lmscale', str(self.lmscale)), ('wdpenalty', str(self.wdpenalty))]
+        out.nodes = [dict(lattice.nodes[entry.node]) for entry in expanded]
+        for source, target, arc, lm in expanded_arcs:
+            new_arc = dict(arc)
+            new_arc['S'] = str(source.index)
+            new_arc['E'] = str(target.index)
+            new_arc['l'] = '{:.5f}'.format(lm)
+            out.arcs.append(new_arc)
+        return out
+
+    def best_words(self, lattice, expanded, outgoing):
+        finals = [entry for entry in expanded if outgoing[entry.node] == []]
+        if finals == []:
+            return []
+        entry = max(finals, key=lambda e: e.score)
+        words = []
+        while entry.back is not None:
+            entry, arc = entry.back
+            word = lattice.arc_word(arc)
+            if word not in NULL_WORDS and word not in START_WORDS and word not in END_WORDS:
+                words.append(word)
+        return words[::-1]
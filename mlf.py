@@ -0,0 +1,34 @@
+"""
+HTK MLF helpers shared by the rescoring tools
+"""
+import sys, os
+
+def read_namemap(mapfile):
+    '''Map n-best utterance names to AMI segment names'''
+    mapping = {}
+    with open(mapfile) as fin:
+        for line in fin:
+            value, key, _, ctmstart, _ = line.split()
+            _, meeting, headset, _ = value.split('_')
+            mapping[key] = value
+    return mapping
+
+def write_entry(fout, labname, words):
+    '''One MLF entry with dummy word times'''
+    start = 100000
+    end = 200000
+    fout.write('\"'+labname+'\"\n')
+    for eachword in words:
+        if eachword[0] == '\'':
+            eachword = '\\' + eachword
+        fout.write(str(start) + ' ' + str(end) + ' ' + eachword+'\n')
+        start += 100000
+        end += 100000
+    fout.write('.\n')
+
+def write_1best(outfile, best_utt_list, mapping):
+    '''best_utt_list: (labname with .rec suffix, list of words) pairs'''
+    with open(outfile, 'w') as fout:
+        fout.write('#!MLF!#\n')
+        for eachutt in best_utt_list:
+            write_entry(fout, mapping[eachutt[0][:-4]], eachutt[1])
@@ -2,6 +2,9 @@ from __future__ import print_function
 import torch.nn as nn
 from torch import cat
 from torch.autograd import Variable
+from inputproj import ProjectionTable, lstm_scan
+from chunkedce import chunked_cross_entropy
+from quantize import float_reference
 
 class RNNModel(nn.Module):
     """Container module with an encoder, a recurrent module, and a decoder."""
@@ -43,10 +46,33 @@ class RNNModel(nn.Module):
         self.decoder.bias.data.zero_()
         self.decoder.weight.data.uniform_(-initrange, initrange)
 
+    def set_projection_table(self, enable=True, half=False):
+        """Inference only: take the first layer input projection of each word
+           from a [ntoken, 4*nhid] table, optionally stored in float16. Only
+           used by the per-step reset path (separate=1)"""
+        if enable and self.rnn_type != 'LSTM':
+            raise ValueError('The input projection table needs an LSTM')
+        self.projtable = ProjectionTable(half) if enable else None
+
+    def use_projection_table(self):
+        return not self.training and getattr(self, 'projtable', None) is not None
+
     def forward(self, input, hidden, separate=0, eosidx = 0, target=None, outputflag=0, hiddenpos=0):
-        emb = self.drop(self.encoder(input))
         output_list = []
         return_hidden = hidden
+        # the table only replaces the input matmul of the per-step reset loop,
+        # the other paths keep the fused LSTM
+        if separate == 1 and self.use_projection_table():
+            gates_in = self.projtable(input, self.encoder.weight, self.rnn.weight_ih_l0,
+                                      [self.rnn.bias_ih_l0, self.rnn.bias_hh_l0])
+            keep = (input != eosidx).float()
+            output, hidden = lstm_scan(self.rnn, gates_in, hidden, keep)
+            output = self.drop(output)
+            if outputflag == 0:
+                decoded = self.decoder(output.view(output.size(0)*output.size(1), output.size(2)))
+                return decoded.view(output.size(0), output.size(1), decoded.size(1)), hidden
+            return output, hidden
+        emb = self.drop(self.encoder(input))
         if separate == 1:
             for i in range(emb.size(0)):
                 resethidden = self.resetsent(hidden, input[i,:], eosidx)
@@ -74,8 +100,14 @@ class RNNModel(nn.Module):
         else:
             return output, hidden
 
+    def decode_loss(self, output, target, chunk=256):
+        """Per-token cross-entropy [seq_len*bsz] of the decoder on output
+           (forward with outputflag=1), chunk positions at a time"""
+        return chunked_cross_entropy(output.view(-1, output.size(-1)), self.decoder.weight,
+                                     self.decoder.bias, target.view(-1), chunk)
+
     def init_hidden(self, bsz):
-        weight = next(self.parameters())
+        weight = float_reference(self)
         if self.rnn_type == 'LSTM':
             return (weight.new_zeros(self.nlayers, bsz, self.nhid),
                     weight.new_zeros(self.nlayers, bsz, self.nhid))
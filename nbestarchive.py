@@ -0,0 +1,128 @@
+"""
+N-best archive: one file per set replacing the list of per-utterance n-best
+files given by --nbest. Hypotheses are stored pre-encoded as int32 word ids
+together with their acoustic and LM scores, and the word strings are kept
+only for writing out the 1-best.
+Usage: python nbestarchive.py <nbest list> <dictionary> <out archive>
+"""
+import sys, os
+import hashlib
+import shutil
+
+import numpy as np
+
+import binstore
+
+MAGIC = b'NBESTA01'
+
+def read_dictionary(dictfile):
+    dictionary = {}
+    with open(dictfile) as fin:
+        for line in fin:
+            ind, word = line.strip().split(' ')
+            if word not in dictionary:
+                dictionary[word] = int(ind)
+    return dictionary
+
+def dictionary_digest(dictfile):
+    with open(dictfile, 'rb') as fin:
+        return hashlib.md5(fin.read()).hexdigest()
+
+def convert(listfile, dictfile, outfile):
+    dictionary = read_dictionary(dictfile)
+    oovidx = dictionary['OOV']
+    utt_offsets = [0]
+    hyp_offsets = [0]
+    text_offsets = [0]
+    ac_scores = []
+    lm_scores = []
+    tokens = []
+    text = []
+    names = []
+    textlen = 0
+    with open(listfile) as fin:
+        for utterancefile in fin:
+            names.append(utterancefile.strip().split('/')[-1])
+            with open(utterancefile.strip()) as uttfile:
+                for line in uttfile:
+                    linevec = line.strip().split()
+                    if linevec == []:
+                        continue
+                    utterance = linevec[4:-1]
+                    ac_scores.append(float(linevec[0]))
+                    lm_scores.append(float(linevec[1]))
+                    tokens += [dictionary.get(word, oovidx) for word in utterance]
+                    hyp_offsets.append(len(tokens))
+                    words = ' '.join(utterance).encode('utf8')
+                    text.append(words)
+                    textlen += len(words)
+                    text_offsets.append(textlen)
+            utt_offsets.append(len(hyp_offsets) - 1)
+    name_bytes = [name.encode('utf8') for name in names]
+    name_offsets = np.cumsum([0] + [len(name) for name in name_bytes])
+    binstore.save(outfile, MAGIC, [
+        ('utt_offsets', np.array(utt_offsets, dtype=np.int64)),
+        ('hyp_offsets', np.array(hyp_offsets, dtype=np.int64)),
+        ('ac_scores', np.array(ac_scores, dtype=np.float64)),
+        ('lm_scores', np.array(lm_scores, dtype=np.float64)),
+        ('tokens', np.array(tokens, dtype=np.int32)),
+        ('text_offsets', np.array(text_offsets, dtype=np.int64)),
+        ('text', np.frombuffer(b''.join(text), dtype=np.uint8)),
+        ('name_offsets', name_offsets.astype(np.int64)),
+        ('names', np.frombuffer(b''.join(name_bytes), dtype=np.uint8))],
+        meta={'ntokens': len(dictionary), 'dictionary': dictionary_digest(dictfile)})
+    # jointforward.py looks for the context next to the n-best input
+    if os.path.exists(listfile + '.context'):
+        shutil.copyfile(listfile + '.context', outfile + '.context')
+    return len(names), len(ac_scores)
+
+class NbestArchive(object):
+    def __init__(self, path):
+        arrays, self.meta = binstore.load(path, MAGIC)
+        self.utt_offsets = arrays['utt_offsets']
+        self.hyp_offsets = arrays['hyp_offsets']
+        self.ac_scores = arrays['ac_scores']
+        self.lm_scores = arrays['lm_scores']
+        self.tokens = arrays['tokens']
+        self.text_offsets = arrays['text_offsets']
+        self.text = arrays['text']
+        self.name_offsets = arrays['name_offsets']
+        self.names = arrays['names']
+
+    def __len__(self):
+        return len(self.utt_offsets) - 1
+
+    def check_dictionary(self, dictfile):
+        if self.meta['dictionary'] != dictionary_digest(dictfile):
+            raise ValueError('N-best archive was encoded with a different dictionary')
+
+    def name(self, utt_idx):
+        start, end = self.name_offsets[utt_idx], self.name_offsets[utt_idx+1]
+        return self.names[start:end].tobytes().decode('utf8')
+
+    def nhyps(self, utt_idx):
+        return int(self.utt_offsets[utt_idx+1] - self.utt_offsets[utt_idx])
+
+    def hyp_range(self, utt_idx):
+        return int(self.utt_offsets[utt_idx]), int(self.utt_offsets[utt_idx+1])
+
+    def token_ids(self, utt_idx):
+        '''Word ids of each hypothesis as views into the mapped file'''
+        start, end = self.hyp_range(utt_idx)
+        return [self.tokens[self.hyp_offsets[i]:self.hyp_offsets[i+1]] for i in range(start, end)]
+
+    def scores(self, utt_idx):
+        start, end = self.hyp_range(utt_idx)
+        return self.ac_scores[start:end], self.lm_scores[start:end]
+
+    def words(self, utt_idx, hyp_idx):
+        hyp = self.utt_offsets[utt_idx] + hyp_idx
+        start, end = self.text_offsets[hyp], self.text_offsets[hyp+1]
+        return self.text[start:end].tobytes().decode('utf8').split()
+
+if __name__ == "__main__":
+    listfile = sys.argv[1]
+    dictfile = sys.argv[2]
+    outfile = sys.argv[3]
+    nutt, nhyp = convert(listfile, dictfile, outfile)
+    print('Archived {} utterances with {} hypotheses into {}'.format(nutt, nhyp, outfile))
@@ -0,0 +1,65 @@
+"""
+Packs the per-utterance n-gram probability files listed in an --ngram list
+into one indexed binary store, and reads it back memory-mapped.
+Arrays: utterance offsets into the hypothesis table, hypothesis offsets
+into the token table, float32 token log-probs
+"""
+import sys, os
+
+import numpy as np
+
+import binstore
+
+MAGIC = b'NGPROB01'
+
+def parse_probline(line):
+    '''One hypothesis line: <len> <w_1> ... <w_len> <total> <p_1> ... <p_n>'''
+    elems = line.strip().split(' ')
+    sent_len = int(elems[0])
+    return [float(prob) for prob in elems[sent_len+2:]]
+
+def pack(listfile, outfile):
+    utt_offsets = [0]
+    hyp_offsets = [0]
+    probs = []
+    with open(listfile) as fin:
+        for probfile in fin:
+            with open(probfile.strip()) as fprob:
+                for line in fprob:
+                    if line.strip() == '':
+                        continue
+                    probs += parse_probline(line)
+                    hyp_offsets.append(len(probs))
+            utt_offsets.append(len(hyp_offsets) - 1)
+    binstore.save(outfile, MAGIC, [
+        ('utt_offsets', np.array(utt_offsets, dtype=np.int64)),
+        ('hyp_offsets', np.array(hyp_offsets, dtype=np.int64)),
+        ('probs', np.array(probs, dtype=np.float32))])
+    return len(utt_offsets)-1, len(hyp_offsets)-1, len(probs)
+
+class NgramProbStore(object):
+    def __init__(self, path):
+        arrays, _ = binstore.load(path, MAGIC)
+        self.utt_offsets = arrays['utt_offsets']
+        self.hyp_offsets = arrays['hyp_offsets']
+        self.probs = arrays['probs']
+
+    def __len__(self):
+        return len(self.utt_offsets) - 1
+
+    def nhyps(self, utt_idx):
+        return int(self.utt_offsets[utt_idx+1] - self.utt_offsets[utt_idx])
+
+    def hypothesis(self, utt_idx, hyp_idx):
+        '''Token log-probs of one hypothesis, a view into the mapped file'''
+        hyp = self.utt_offsets[utt_idx] + hyp_idx
+        return self.probs[self.hyp_offsets[hyp]:self.hyp_offsets[hyp+1]]
+
+    def utterance(self, utt_idx):
+        return [self.hypothesis(utt_idx, i) for i in range(self.nhyps(utt_idx))]
+
+if __name__ == "__main__":
+    listfile = sys.argv[1]
+    outfile = sys.argv[2]
+    nutt, nhyp, ntok = pack(listfile, outfile)
+    print('Packed {} utterances, {} hypotheses, {} tokens into {}'.format(nutt, nhyp, ntok, outfile))
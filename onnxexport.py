@@ -0,0 +1,168 @@
+# coding: utf-8
+"""
+ONNX export of the two-level cross-utterance LM for rescoring with ONNX
+Runtime on CPU (jointforward.py --backend onnxruntime --onnxdir <dir>).
+
+context_encoder.onnx: context word ids [seglen, batch] -> pooled vectors
+    [batch, nhid*nhead], i.e. model.get_word_emb followed by AttenFlvModel
+l2_scorer.onnx: input/target ids [len, batch], auxiliary context [batch, naux_in]
+    and mask [len, batch] -> masked token log-probs [len, batch] and
+    per-hypothesis log-probs [batch]
+Both have dynamic batch and length axes. Sentence boundary resetting is left
+out of the scorer: in an n-best batch <eos> only occurs at the first input,
+where the hidden state is still zero, and in the masked padding.
+
+Run as a script to export, then check parity and speed against PyTorch.
+"""
+import argparse
+import sys, os
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+CONTEXT_FILE = 'context_encoder.onnx'
+SCORER_FILE = 'l2_scorer.onnx'
+
+class ContextEncoder(nn.Module):
+    def __init__(self, model, FLvmodel):
+        super(ContextEncoder, self).__init__()
+        self.encoder = model.encoder
+        self.FLvmodel = FLvmodel
+
+    def forward(self, input):
+        extracted, _ = self.FLvmodel(self.encoder(input), None, device='cpu')
+        return extracted
+
+class L2Scorer(nn.Module):
+    def __init__(self, model):
+        super(L2Scorer, self).__init__()
+        if model.atten:
+            raise ValueError('Only the compressor variant of L2RNNModel can be exported')
+        self.model = model
+
+    def forward(self, input, auxiliary, target, mask):
+        emb = self.model.encoder(input)
+        # the context is the same at every step, compress it once
+        auxiliary_in = self.model.compressor(auxiliary)
+        auxiliary_in = auxiliary_in.unsqueeze(0).expand(input.size(0), -1, -1)
+        output, _ = self.model.rnn(torch.cat([auxiliary_in, emb], 2))
+        logprobs = F.log_softmax(self.model.decoder(output), dim=-1)
+        token_logprobs = logprobs.gather(2, target.unsqueeze(2)).squeeze(2) * mask
+        return token_logprobs, token_logprobs.sum(0)
+
+def dummy_inputs(model, FLvmodel, seglen, seq_len=7, bsize=5):
+    ntokens = model.decoder.out_features
+    context = torch.randint(ntokens, (seglen, 2))
+    input = torch.randint(ntokens, (seq_len, bsize))
+    target = torch.randint(ntokens, (seq_len, bsize))
+    auxiliary = torch.randn(bsize, model.compressor.in_features)
+    mask = torch.ones(seq_len, bsize)
+    return context, (input, auxiliary, target, mask)
+
+def export(model, FLvmodel, outdir, seglen, opset=13):
+    model.eval()
+    FLvmodel.eval()
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    context, scorer_inputs = dummy_inputs(model, FLvmodel, seglen)
+    torch.onnx.export(ContextEncoder(model, FLvmodel), (context,), os.path.join(outdir, CONTEXT_FILE),
+                      input_names=['input'], output_names=['extracted'],
+                      dynamic_axes={'input': {0: 'length', 1: 'batch'}, 'extracted': {0: 'batch'}},
+                      opset_version=opset)
+    torch.onnx.export(L2Scorer(model), scorer_inputs, os.path.join(outdir, SCORER_FILE),
+                      input_names=['input', 'auxiliary', 'target', 'mask'],
+                      output_names=['token_logprobs', 'logprobs'],
+                      dynamic_axes={'input': {0: 'length', 1: 'batch'}, 'auxiliary': {0: 'batch'},
+                                    'target': {0: 'length', 1: 'batch'}, 'mask': {0: 'length', 1: 'batch'},
+                                    'token_logprobs': {0: 'length', 1: 'batch'}, 'logprobs': {0: 'batch'}},
+                      opset_version=opset)
+
+class OnnxRescorer(object):
+    '''ONNX Runtime sessions of the exported context encoder and scorer'''
+    def __init__(self, onnxdir, nthreads=0):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if nthreads > 0:
+            options.intra_op_num_threads = nthreads
+        providers = ['CPUExecutionProvider']
+        self.context = onnxruntime.InferenceSession(os.path.join(onnxdir, CONTEXT_FILE), options, providers=providers)
+        self.scorer = onnxruntime.InferenceSession(os.path.join(onnxdir, SCORER_FILE), options, providers=providers)
+
+    def encode_context(self, input):
+        '''input: LongTensor [seglen, batch]'''
+        return torch.from_numpy(self.context.run(None, {'input': input.cpu().numpy()})[0])
+
+    def score(self, input, auxiliary, target, mask):
+        '''Returns masked token log-probs [len, batch] and their sums [batch]'''
+        token_logprobs, logprobs = self.scorer.run(None, {
+            'input': input.cpu().numpy(), 'auxiliary': auxiliary.cpu().float().numpy(),
+            'target': target.cpu().numpy(), 'mask': mask.cpu().float().numpy()})
+        return torch.from_numpy(token_logprobs), torch.from_numpy(logprobs)
+
+def eager_score(model, input, auxiliary, target, mask):
+    '''The rescoring path of jointforward.py for comparison'''
+    seq_len, bsize = input.size()
+    auxind = torch.arange(bsize).unsqueeze(0).expand(seq_len, -1)
+    output, _, _ = model(input, auxiliary, model.init_hidden(bsize), eosidx=-1, device='cpu', auxind=auxind)
+    logProb = F.cross_entropy(output.view(-1, output.size(2)), target.view(-1), reduction='none')
+    return -(logProb.view(seq_len, bsize) * mask).sum(0)
+
+def eager_context(model, FLvmodel, input):
+    return FLvmodel(model.get_word_emb(input), FLvmodel.init_hidden(input.size(1)), device='cpu')[0]
+
+def timeit(fn, repeats):
+    for i in range(2):
+        fn()
+    start = time.time()
+    for i in range(repeats):
+        fn()
+    return (time.time() - start) / repeats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the cross-utterance LM to ONNX')
+    parser.add_argument('--model', type=str, default='model.pt',
+                        help='location of the 2nd level model')
+    parser.add_argument('--FLvmodel', type=str, default='FLvmodel.pt',
+                        help='location of the 1st level model')
+    parser.add_argument('--onnxdir', type=str, default='onnx',
+                        help='output directory')
+    parser.add_argument('--seglen', type=int, default=36,
+                        help='context segment length')
+    parser.add_argument('--nhyps', type=int, default=50,
+                        help='hypotheses per n-best list in the parity and speed test')
+    parser.add_argument('--hyplen', type=int, default=15,
+                        help='hypothesis length in the parity and speed test')
+    parser.add_argument('--repeats', type=int, default=20,
+                        help='timed repetitions')
+    args = parser.parse_args()
+
+    model = torch.load(args.model, map_location='cpu')
+    FLvmodel = torch.load(args.FLvmodel, map_location='cpu')
+    model.eval()
+    model.set_mode('eval')
+    FLvmodel.eval()
+    FLvmodel.set_mode('eval')
+    export(model, FLvmodel, args.onnxdir, args.seglen)
+    print('Exported to ' + args.onnxdir)
+
+    # Parity and speed on shapes other than the export ones
+    rescorer = OnnxRescorer(args.onnxdir)
+    ntokens = model.decoder.out_features
+    context = torch.randint(ntokens, (args.seglen, 2))
+    input = torch.randint(ntokens, (args.hyplen, args.nhyps))
+    target = torch.randint(ntokens, (args.hyplen, args.nhyps))
+    auxiliary = torch.randn(args.nhyps, model.compressor.in_features)
+    mask = (torch.arange(args.hyplen).unsqueeze(1) < torch.randint(1, args.hyplen+1, (1, args.nhyps))).float()
+    with torch.no_grad():
+        context_diff = (eager_context(model, FLvmodel, context) - rescorer.encode_context(context)).abs().max()
+        score_diff = (eager_score(model, input, auxiliary, target, mask)
+                      - rescorer.score(input, auxiliary, target, mask)[1]).abs().max()
+        print('| parity max abs diff | context {:.2e} | scores {:.2e} |'.format(float(context_diff), float(score_diff)))
+        time_torch = timeit(lambda: (eager_context(model, FLvmodel, context),
+                                     eager_score(model, input, auxiliary, target, mask)), args.repeats)
+        time_ort = timeit(lambda: (rescorer.encode_context(context),
+                                   rescorer.score(input, auxiliary, target, mask)), args.repeats)
+    print('| ms per n-best pytorch {:8.2f} | onnxruntime {:8.2f} | speed-up {:4.2f} |'.format(
+        time_torch * 1000, time_ort * 1000, time_torch / time_ort))
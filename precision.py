@@ -0,0 +1,128 @@
+# coding: utf-8
+"""
+Mixed precision (--amp in train_with_dataloader.py, jointtrain_singleseg.py
+and jointforward.py). With --amp bf16 the LSTM, attention and decoder
+matmuls run under torch.autocast in bfloat16; the weights stay in float32
+and the callers cast the logits to float32 before log-softmax and the loss.
+
+Run as a script to compare fp32 and bf16 on a model trained by
+train_with_dataloader.py: test perplexity, scoring throughput, training
+step time and the activation memory kept for backward.
+"""
+import argparse
+import contextlib
+import math
+import time
+
+import torch
+import torch.nn.functional as F
+
+AMP_MODES = ['fp32', 'bf16']
+
+def autocast(device, mode):
+    '''Autocast context of an --amp mode, fp32 runs without autocast'''
+    if mode == 'fp32':
+        return contextlib.nullcontext()
+    if device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+        raise ValueError('--amp bf16 is not supported by this GPU')
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+
+class SavedTensorMeter(object):
+    '''Bytes of the tensors autograd saves for backward inside the context'''
+    def __init__(self):
+        self.nbytes = 0
+        self.seen = set()
+
+    def pack(self, tensor):
+        key = (tensor.data_ptr(), tensor.dtype)
+        if key not in self.seen:
+            self.seen.add(key)
+            self.nbytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    def __enter__(self):
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(self.pack, lambda tensor: tensor)
+        self.hooks.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.hooks.__exit__(*exc)
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+def evaluate(model, data, bptt, eosidx, device, mode):
+    '''Test perplexity and words per second'''
+    model.eval()
+    model.set_mode('eval')
+    total_loss = 0.
+    hidden = model.init_hidden(data.size(1))
+    sync(device)
+    start = time.time()
+    with torch.no_grad(), autocast(device, mode):
+        for i in range(0, data.size(0) - 1, bptt):
+            input = data[i:i+bptt]
+            target = data[i+1:i+1+input.size(0)].view(-1)
+            output, hidden = model(input, hidden, separate=model.reset, eosidx=eosidx)
+            total_loss += F.cross_entropy(output.view(target.size(0), -1).float(), target, reduction='sum').item()
+    sync(device)
+    nwords = (data.size(0) - 1) * data.size(1)
+    return math.exp(total_loss / nwords), nwords / (time.time() - start)
+
+def train_step(model, data, bptt, eosidx, device, mode, steps=5):
+    '''ms per training step and MB of activations saved for backward'''
+    model.train()
+    model.set_mode('train')
+    meter = SavedTensorMeter()
+    sync(device)
+    start = time.time()
+    for i in range(steps):
+        input = data[:bptt]
+        target = data[1:bptt+1].view(-1)
+        model.zero_grad()
+        with autocast(device, mode):
+            if i == 0:
+                with meter:
+                    output, _ = model(input, model.init_hidden(data.size(1)), separate=model.reset, eosidx=eosidx)
+                    loss = F.cross_entropy(output.view(target.size(0), -1).float(), target)
+            else:
+                output, _ = model(input, model.init_hidden(data.size(1)), separate=model.reset, eosidx=eosidx)
+                loss = F.cross_entropy(output.view(target.size(0), -1).float(), target)
+        loss.backward()
+    sync(device)
+    model.zero_grad()
+    return (time.time() - start) * 1000 / steps, meter.nbytes / 2**20
+
+if __name__ == "__main__":
+    import dataloader
+    parser = argparse.ArgumentParser(description='Compare fp32 and bf16 autocast')
+    parser.add_argument('--data', type=str, default='./data/AMI',
+                        help='location of the data corpus')
+    parser.add_argument('--model', type=str, default='model.pt',
+                        help='model saved by train_with_dataloader.py')
+    parser.add_argument('--batchsize', type=int, default=64,
+                        help='batch size of the training steps')
+    parser.add_argument('--bptt', type=int, default=36,
+                        help='sequence length')
+    parser.add_argument('--cuda', action='store_true',
+                        help='use CUDA')
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+    model = torch.load(args.model, map_location=device)
+    _, _, test_loader = dataloader.create(args.data, batchSize=1, workers=0)
+    eosidx = test_loader.dataset.dictionary.get_eos()
+    test = torch.cat([batch for batch in test_loader])
+    eval_data = test.narrow(0, 0, test.size(0) // 10 * 10).view(10, -1).t().contiguous().to(device)
+    train_data = test.narrow(0, 0, (args.bptt + 1) * args.batchsize).view(args.batchsize, -1).t().contiguous().to(device)
+    results = {}
+    for mode in AMP_MODES:
+        ppl, wps = evaluate(model, eval_data, args.bptt, eosidx, device, mode)
+        step_ms, saved_mb = train_step(model, train_data, args.bptt, eosidx, device, mode)
+        results[mode] = (ppl, wps, step_ms, saved_mb)
+        print('| {} | test ppl {:8.2f} | words/s {:9.1f} | ms/train step {:8.2f} | saved activations {:8.1f}MB |'.format(
+            mode, ppl, wps, step_ms, saved_mb))
+    print('| bf16 vs fp32 | ppl change {:+.2f}% | throughput x{:.2f} | step time x{:.2f} | activations x{:.2f} |'.format(
+        100 * (results['bf16'][0] / results['fp32'][0] - 1), results['bf16'][1] / results['fp32'][1],
+        results['bf16'][2] / results['fp32'][2], results['bf16'][3] / results['fp32'][3]))
@@ -0,0 +1,97 @@
+# coding: utf-8
+"""
+Validation of the int8 rescoring mode against fp32.
+Speed and memory are measured here on n-best shaped batches; perplexity and
+1-best agreement are compared from two score stores of the same dev set:
+    python jointforward.py ... --savescores dev.fp32.scores
+    python jointforward.py ... --quantize --savescores dev.int8.scores
+    python quantcheck.py --model .. --FLvmodel .. --fp32scores dev.fp32.scores --int8scores dev.int8.scores
+"""
+import argparse
+import sys, os
+import time
+import math
+
+import numpy as np
+import torch
+
+from quantize import quantize_model, model_size
+from scorestore import ScoreStore, BestPicker
+
+def time_forward(model, FLvmodel, ntokens, naux, args):
+    '''Seconds per n-best list: context encoding plus hypothesis scoring, with
+       one context row for the whole list as in jointforward.py'''
+    splits = args.maxlen // args.seglen
+    input = torch.randint(ntokens, (args.hyplen, args.nhyps))
+    context = torch.randint(ntokens, (args.seglen, 2 * splits))
+    aux_row = torch.randn(naux)
+    auxind = torch.zeros(args.hyplen, args.nhyps, dtype=torch.long)
+    with torch.no_grad():
+        for i in range(args.repeats + 2):
+            if i == 2:
+                start = time.time()
+            FLvmodel(model.get_word_emb(context), FLvmodel.init_hidden(2 * splits), device='cpu')
+            model(input, aux_row.view(1, -1), model.init_hidden(args.nhyps), auxind=auxind, device='cpu')
+    return (time.time() - start) / args.repeats
+
+def compare_scores(fp32, int8, rnnscale):
+    if len(fp32.rnn_tokens) != len(int8.rnn_tokens):
+        raise ValueError('Score stores do not cover the same hypotheses')
+    ntok = max(1, len(fp32.rnn_tokens))
+    ppl_fp32 = math.exp(-fp32.rnn_tokens.astype(np.float64).sum() / ntok)
+    ppl_int8 = math.exp(-int8.rnn_tokens.astype(np.float64).sum() / ntok)
+    picker = BestPicker(fp32.utt_offsets)
+    best_fp32 = picker((fp32.ac_scores - rnnscale * fp32.rnn_scores())[None, :])[0]
+    best_int8 = picker((int8.ac_scores - rnnscale * int8.rnn_scores())[None, :])[0]
+    agreement = 100.0 * (best_fp32 == best_int8).sum() / max(1, len(best_fp32))
+    print('| hypothesis ppl fp32 {:8.2f} | int8 {:8.2f} | change {:+6.2f}% |'.format(
+        ppl_fp32, ppl_int8, 100.0 * (ppl_int8 - ppl_fp32) / ppl_fp32))
+    print('| 1-best agreement {:6.2f}% over {} utterances |'.format(agreement, len(best_fp32)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare int8 and fp32 rescoring')
+    parser.add_argument('--model', type=str, default='model.pt',
+                        help='location of the 2nd level model')
+    parser.add_argument('--FLvmodel', type=str, default='FLvmodel.pt',
+                        help='location of the 1st level model')
+    parser.add_argument('--quantemb', action='store_true',
+                        help='also quantize the word embeddings')
+    parser.add_argument('--fp32scores', type=str, default='',
+                        help='score store written by jointforward.py --savescores')
+    parser.add_argument('--int8scores', type=str, default='',
+                        help='score store written by jointforward.py --quantize --savescores')
+    parser.add_argument('--rnnscale', type=float, default=6,
+                        help='rnn score scale used to pick the 1-best')
+    parser.add_argument('--nhyps', type=int, default=50,
+                        help='hypotheses per n-best list in the speed test')
+    parser.add_argument('--hyplen', type=int, default=15,
+                        help='hypothesis length in the speed test')
+    parser.add_argument('--maxlen', type=int, default=36,
+                        help='context window length in the speed test')
+    parser.add_argument('--seglen', type=int, default=36,
+                        help='context segment length in the speed test')
+    parser.add_argument('--repeats', type=int, default=20,
+                        help='timed repetitions')
+    args = parser.parse_args()
+
+    model = torch.load(args.model, map_location='cpu')
+    FLvmodel = torch.load(args.FLvmodel, map_location='cpu')
+    model.eval()
+    model.set_mode('eval')
+    FLvmodel.eval()
+    FLvmodel.set_mode('eval')
+    ntokens = model.decoder.out_features
+    # context vector size, also for the attention (e.g. --hier) models
+    naux = model.nutt * model.nseg
+    qmodel = quantize_model(model, embedding=args.quantemb)
+    qFLvmodel = quantize_model(FLvmodel)
+    size_fp32 = model_size(model) + model_size(FLvmodel)
+    size_int8 = model_size(qmodel) + model_size(qFLvmodel)
+    print('| weights fp32 {:7.1f}MB | int8 {:7.1f}MB | ratio {:4.2f} |'.format(
+        size_fp32 / 2**20, size_int8 / 2**20, size_fp32 / size_int8))
+    time_fp32 = time_forward(model, FLvmodel, ntokens, naux, args)
+    time_int8 = time_forward(qmodel, qFLvmodel, ntokens, naux, args)
+    print('| ms per n-best fp32 {:8.2f} | int8 {:8.2f} | speed-up {:4.2f} |'.format(
+        time_fp32 * 1000, time_int8 * 1000, time_fp32 / time_int8))
+    if args.fp32scores and args.int8scores:
+        compare_scores(ScoreStore(args.fp32scores), ScoreStore(args.int8scores), args.rnnscale)
@@ -0,0 +1,35 @@
+"""
+Dynamic int8 quantization of the rescoring LMs for CPU inference.
+LSTM and Linear weights are stored as int8 and activations are quantized
+on the fly; the word embedding can optionally be quantized weight-only.
+"""
+import io
+from itertools import chain
+
+import torch
+import torch.nn as nn
+from torch.quantization import quantize_dynamic, default_dynamic_qconfig, float_qparams_weight_only_qconfig
+
+def quantize_model(model, embedding=False):
+    '''Returns an int8 copy of model, the float model is left untouched'''
+    qconfig_spec = {nn.LSTM: default_dynamic_qconfig, nn.Linear: default_dynamic_qconfig}
+    if embedding:
+        qconfig_spec[nn.Embedding] = float_qparams_weight_only_qconfig
+    model = quantize_dynamic(model.cpu(), qconfig_spec, dtype=torch.qint8, inplace=False)
+    model.eval()
+    return model
+
+def float_reference(module):
+    '''A floating point parameter or buffer of module, to build hidden states
+       with its dtype and device. Dynamically quantized modules have no float
+       parameters left and run on the CPU, so a float32 CPU tensor is used.'''
+    for tensor in chain(module.parameters(), module.buffers()):
+        if tensor.is_floating_point():
+            return tensor
+    return torch.zeros(0)
+
+def model_size(model):
+    '''Size of the serialized state dict in bytes'''
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
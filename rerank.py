@@ -0,0 +1,120 @@
+# coding: utf-8
+import argparse
+import sys, os
+import time
+
+import numpy as np
+
+from scorestore import ScoreStore, BestPicker, segment_sum
+from mlf import read_namemap, write_1best
+import wer
+
+parser = argparse.ArgumentParser(description='Re-rank n-best lists from saved raw hypothesis scores')
+parser.add_argument('--scores', type=str, default='scores.bin',
+                    help='raw score store written by jointforward.py --savescores')
+parser.add_argument('--interp', action='store_true',
+                    help='Linear interpolation of LMs')
+parser.add_argument('--rnnscale', type=str, default='6',
+                    help='rnn score scales to sweep, space separated')
+parser.add_argument('--gscale', type=str, default='12.0',
+                    help='ngram grammar scaling factors to sweep, space separated')
+parser.add_argument('--factor', type=str, default='0.8',
+                    help='ngram interpolation weight factors to sweep, space separated')
+parser.add_argument('--out', type=str, default='',
+                    help='write the 1-best MLF of a single grid point to this file')
+parser.add_argument('--map', type=str, default='nbest/dev.map',
+                    help='AMI name mapping file')
+parser.add_argument('--ref', type=str, default='',
+                    help='reference MLF or STM, reports the WER of every grid point')
+parser.add_argument('--nj', type=int, default=4,
+                    help='number of alignment processes for --ref')
+parser.add_argument('--logfile', type=str, default='rerank_log.txt',
+                    help='Re-ranking log file')
+args = parser.parse_args()
+
+def logging(s, print_=True, log_=True):
+    if print_:
+        print(s)
+    if log_:
+        with open(args.logfile, 'a+') as f_log:
+            f_log.write(s + '\n')
+
+def interp_rnn_scores(store, gscale, factor):
+    '''Negative log-prob of every hypothesis under the interpolated LM'''
+    probs = (np.exp(store.ngram_tokens.astype(np.float64) / gscale) * factor
+             + np.exp(store.rnn_tokens.astype(np.float64)) * (1 - factor))
+    return -segment_sum(np.log(probs), store.token_offsets)
+
+def sweep(store, rnnscales, gscales, factors):
+    '''Yields ((rnnscale, gscale, factor), best hypothesis indices) for the grid'''
+    picker = BestPicker(store.utt_offsets)
+    rnnscales = np.array(rnnscales)
+    if args.interp:
+        if store.ngram_tokens is None:
+            raise ValueError('Score store has no n-gram token log-probs, rerun jointforward.py with --interp')
+        if store.carried_state:
+            raise ValueError('Score store was written with a reset=0 model, whose scores depend on the 1-best '
+                             'at the saved weights; re-ranking is only exact for reset=1 models')
+        lm_points = [(g, f) for g in gscales for f in factors]
+    else:
+        lm_points = [(gscales[0], factors[0])]
+    rnn_scores = store.rnn_scores()
+    for gscale, factor in lm_points:
+        if args.interp:
+            rnn_scores = interp_rnn_scores(store, gscale, factor)
+        # all rnn scales of this LM combination in one go
+        total_scores = store.ac_scores[None, :] - rnnscales[:, None] * rnn_scores[None, :]
+        best = picker(total_scores)
+        for i, rnnscale in enumerate(rnnscales):
+            yield (rnnscale, gscale, factor), best[i]
+
+def hypothesis_errors(store, grid_best, refs, mapping, nj):
+    '''Aligns every hypothesis that is 1-best somewhere on the grid once.
+       Returns {hyp: errors}, utterances with a reference, reference word count'''
+    utt_of_hyp = BestPicker(store.utt_offsets).utt_of_hyp
+    names = [mapping[store.name(i)] for i in range(len(store))]
+    scored = np.array([name in refs for name in names])
+    needed = np.unique(np.concatenate([best for _, best in grid_best]))
+    needed = needed[scored[utt_of_hyp[needed]]]
+    pairs = [(int(hyp), refs[names[utt_of_hyp[hyp]]], store.words(hyp)) for hyp in needed]
+    errors = {}
+    if nj > 1:
+        with wer.Pool(nj) as pool:
+            results = list(pool.imap(wer.align_utterance, pairs, 64))
+    else:
+        results = [wer.align_utterance(pair) for pair in pairs]
+    for hyp, _, _, alignment in results:
+        errors[hyp] = sum(1 for op, _, _ in alignment if op != 'C')
+    nref = sum(len(refs[name]) for name in names if name in refs)
+    return errors, scored, nref
+
+def report(store, grid_best):
+    baseline = BestPicker(store.utt_offsets)(store.ac_scores[None, :])[0]
+    if args.ref:
+        errors, scored, nref = hypothesis_errors(store, grid_best, wer.read_reference(args.ref),
+                                                 read_namemap(args.map), args.nj)
+    for (rnnscale, gscale, factor), best in grid_best:
+        line = '| rnnscale {:6.2f} | gscale {:6.2f} | factor {:4.2f} | changed 1-best {:6d}/{:6d} |'.format(
+            rnnscale, gscale, factor, int((best != baseline).sum()), len(best))
+        if args.ref:
+            nerr = sum(errors[int(hyp)] for hyp in best[scored])
+            line += ' WER {:5.2f}% |'.format(100.0 * nerr / max(1, nref))
+        logging(line)
+
+if __name__ == "__main__":
+    start_time = time.time()
+    store = ScoreStore(args.scores)
+    rnnscales = [float(i) for i in args.rnnscale.strip().split()]
+    gscales = [float(i) for i in args.gscale.strip().split()]
+    factors = [float(i) for i in args.factor.strip().split()]
+    logging('Re-ranking {} utterances, {} hypotheses'.format(len(store), store.nhyps_total()))
+    grid_best = list(sweep(store, rnnscales, gscales, factors))
+    report(store, grid_best)
+    logging('Sweep over {} points took {:5.2f}s'.format(len(grid_best), time.time()-start_time))
+    if args.out:
+        if len(grid_best) != 1:
+            raise ValueError('--out needs a single rnnscale/gscale/factor point')
+        _, best = grid_best[0]
+        best_utt_list = [(store.name(i) + '.rec', store.words(hyp)) for i, hyp in enumerate(best)]
+        write_1best(args.out, best_utt_list, read_namemap(args.map))
+        logging('1-best written to ' + args.out)
@@ -0,0 +1,103 @@
+# coding: utf-8
+"""
+Client of rescoreserver.py. Run as a script it is a load generator:
+it replays an n-best list against the server from several concurrent
+clients and reports throughput and p50/p99 latency.
+"""
+import argparse
+import sys, os
+import time
+import json
+import threading
+from urllib.request import Request, urlopen
+
+class RescoreClient(object):
+    def __init__(self, host='127.0.0.1', port=8765, timeout=60):
+        self.url = 'http://{}:{}/'.format(host, port)
+        self.timeout = timeout
+
+    def rescore(self, hyps, prev=[], post=[]):
+        '''hyps: n-best lines as in the n-best files, prev/post: context utterances'''
+        body = json.dumps({'hyps': hyps, 'prev': prev, 'post': post}).encode('utf8')
+        request = Request(self.url, data=body, headers={'Content-Type': 'application/json'})
+        with urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read().decode('utf8'))
+
+def read_requests(nbestlist, contextfile, ncontext):
+    '''One request per n-best file, with ncontext neighbouring context lines each side'''
+    with open(nbestlist) as fin:
+        utterancefiles = [line.strip() for line in fin]
+    context = []
+    if contextfile:
+        with open(contextfile) as fin:
+            context = [' '.join(line.split()[1:-1]) for line in fin]
+    requests = []
+    for i, utterancefile in enumerate(utterancefiles):
+        with open(utterancefile) as uttfile:
+            hyps = [line for line in uttfile if line.strip() != '']
+        prev = context[max(0, i-ncontext):i]
+        post = context[i+1:i+1+ncontext]
+        requests.append((hyps, prev, post))
+    return requests
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values)-1, int(p / 100.0 * len(values)))]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load generator for rescoreserver.py')
+    parser.add_argument('--nbest', type=str, default='dev.nbest.info.txt',
+                        help='n-best list, one n-best file per utterance')
+    parser.add_argument('--context', type=str, default='',
+                        help='context file, defaults to <nbest>.context')
+    parser.add_argument('--ncontext', type=int, default=5,
+                        help='number of context utterances sent on each side')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='server address')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='server port')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='number of concurrent clients')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='total number of requests to send')
+    args = parser.parse_args()
+
+    contextfile = args.context if args.context else args.nbest + '.context'
+    if not os.path.exists(contextfile):
+        contextfile = ''
+    requests = read_requests(args.nbest, contextfile, args.ncontext)
+    latencies = []
+    failures = [0]
+    cursor = [0]
+    lock = threading.Lock()
+
+    def worker():
+        client = RescoreClient(args.host, args.port)
+        while True:
+            with lock:
+                if cursor[0] >= args.requests:
+                    return
+                hyps, prev, post = requests[cursor[0] % len(requests)]
+                cursor[0] += 1
+            start = time.time()
+            try:
+                client.rescore(hyps, prev, post)
+            except Exception:
+                with lock:
+                    failures[0] += 1
+                continue
+            with lock:
+                latencies.append(time.time() - start)
+
+    start_time = time.time()
+    threads = [threading.Thread(target=worker) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start_time
+    print('requests {:6d} | failed {:4d} | concurrency {:3d} | time {:6.2f}s'.format(
+        len(latencies), failures[0], args.concurrency, elapsed))
+    if latencies:
+        print('throughput {:8.2f} req/s | p50 {:8.2f} ms | p99 {:8.2f} ms'.format(
+            len(latencies) / elapsed, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
@@ -0,0 +1,207 @@
+# coding: utf-8
+"""
+Long-running n-best rescoring service on localhost HTTP. L2RNNModel and
+AttenFlvModel stay resident, and concurrent requests are batched together
+(up to --maxbatch hypotheses or --maxwait ms after the first one) into one
+context encoding and one second level forward pass.
+Uses the atten_shared context arrangement of jointforward.py.
+
+POST / with json {"hyps": [n-best lines], "prev": [utterances], "post": [utterances]}
+returns {"rnnscores": [...], "total": [...], "best": index, "words": [...]}
+"""
+import argparse
+import sys, os
+import time
+import json
+import threading
+import queue
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import torch
+
+from nbestarchive import read_dictionary
+import hypscore
+
+parser = argparse.ArgumentParser(description='Cross-utterance LM n-best rescoring server')
+parser.add_argument('--data', type=str, default='./data/AMI',
+                    help='location of the data corpus')
+parser.add_argument('--model', type=str, default='model.pt',
+                    help='location of the 2nd level model')
+parser.add_argument('--FLvmodel', type=str, default='FLvmodel.pt',
+                    help='location of the 1st level model')
+parser.add_argument('--cuda', action='store_true',
+                    help='use CUDA')
+parser.add_argument('--rnnscale', type=float, default=6,
+                    help='how much importance to attach to rnn score')
+parser.add_argument('--maxlen', type=int, default=36,
+                    help='No. of words to look at')
+parser.add_argument('--seglen', type=int, default=36,
+                    help='No. of words in each context segment')
+parser.add_argument('--host', type=str, default='127.0.0.1',
+                    help='address to listen on')
+parser.add_argument('--port', type=int, default=8765,
+                    help='port to listen on')
+parser.add_argument('--maxbatch', type=int, default=512,
+                    help='maximum number of hypotheses forwarded together')
+parser.add_argument('--maxwait', type=float, default=10,
+                    help='milliseconds to wait for more requests after the first one')
+parser.add_argument('--logfile', type=str, default='rescoreserver_log.txt',
+                    help='Server log file')
+args = parser.parse_args()
+
+def logging(s, print_=True, log_=True):
+    if print_:
+        print(s)
+    if log_:
+        with open(args.logfile, 'a+') as f_log:
+            f_log.write(s + '\n')
+
+device = torch.device("cuda" if args.cuda else "cpu")
+dictionary = read_dictionary(os.path.join(args.data, 'dictionary.txt'))
+ntokens = len(dictionary)
+eosidx = dictionary['<eos>']
+oovidx = dictionary['OOV']
+
+def readin_models():
+    logging("Reading models...")
+    with open(args.model, 'rb') as f:
+        model = torch.load(f, map_location=device)
+    with open(args.FLvmodel, 'rb') as f:
+        FLvmodel = torch.load(f, map_location=device)
+    model.rnn.flatten_parameters()
+    FLvmodel.rnn.flatten_parameters()
+    model.eval()
+    model.set_mode('eval')
+    FLvmodel.eval()
+    FLvmodel.set_mode('eval')
+    return model, FLvmodel
+
+def encode(words):
+    return [dictionary.get(word, oovidx) for word in words]
+
+def context_ids(prev, post):
+    '''Same windowing as SharedFLvAttenForwarding: last maxlen words before,
+       first maxlen words after, padded with <eos>'''
+    sent_tank_prev = []
+    for utt in prev:
+        sent_tank_prev += encode(utt.split())
+    sent_tank_prev = sent_tank_prev[-args.maxlen:]
+    sent_tank_prev = [eosidx] * (args.maxlen - len(sent_tank_prev)) + sent_tank_prev
+    sent_tank_post = []
+    for utt in post:
+        sent_tank_post += encode(utt.split())
+    sent_tank_post = sent_tank_post[:args.maxlen]
+    sent_tank_post += [eosidx] * (args.maxlen - len(sent_tank_post))
+    return sent_tank_prev, sent_tank_post
+
+class Request(object):
+    def __init__(self, body):
+        self.utterances = []
+        self.hyp_ids = []
+        self.ac_scores = []
+        for line in body['hyps']:
+            linevec = line.strip().split()
+            self.utterances.append(linevec[4:-1])
+            self.hyp_ids.append(encode(linevec[4:-1]))
+            self.ac_scores.append(float(linevec[0]))
+        self.prev_ids, self.post_ids = context_ids(body.get('prev', []), body.get('post', []))
+        self.done = threading.Event()
+        self.result = None
+
+def encode_context(model, FLvmodel, ids):
+    '''ids: one maxlen window per request, returns [nreq, splits*nhid*nhead]'''
+    splits = args.maxlen // args.seglen
+    nreq = len(ids)
+    input = torch.LongTensor(ids).to(device).view(nreq*splits, args.seglen).t().contiguous()
+    FLvhidden = FLvmodel.init_hidden(nreq*splits)
+    extracted, _ = FLvmodel(model.get_word_emb(input), FLvhidden, device=device)
+    return extracted.view(nreq, -1)
+
+def score_batch(model, FLvmodel, requests):
+    # previous and future windows of all requests in one first level batch
+    windows = [ids for req in requests for ids in (req.prev_ids, req.post_ids)]
+    aux = encode_context(model, FLvmodel, windows).view(len(requests), -1)
+    # identical word sequences within a request share one forward pass
+    unique_keys, hyp_to_unique = hypscore.unique_sequences(
+        [(i, tuple(ids)) for i, req in enumerate(requests) for ids in req.hyp_ids])
+    req_of_hyp = [i for i, _ in unique_keys]
+    input_tensor, target_tensor, mask, _ = hypscore.pad_hypotheses([ids for _, ids in unique_keys], eosidx, device)
+    # each hypothesis uses the context row of its request at every position
+    auxind = torch.LongTensor(req_of_hyp).to(device).unsqueeze(0).expand(input_tensor.size(0), -1)
+    _, rnnscores, _ = hypscore.score_hypotheses(model, input_tensor, target_tensor, mask, aux, auxind,
+                                                eosidx, device)
+    rnnscores = rnnscores.cpu()[torch.LongTensor(hyp_to_unique)]
+    start = 0
+    for req in requests:
+        end = start + len(req.hyp_ids)
+        req_scores = rnnscores[start:end]
+        total = - req_scores * args.rnnscale + torch.tensor(req.ac_scores)
+        best = int(torch.argmax(total))
+        req.result = {'rnnscores': req_scores.tolist(), 'total': total.tolist(),
+                      'best': best, 'words': req.utterances[best]}
+        start = end
+
+def batching_loop(model, FLvmodel, requests):
+    '''Takes the first waiting request, then keeps collecting until the batch
+       is full or the deadline passes, and scores them together'''
+    with torch.no_grad():
+        while True:
+            batch = [requests.get()]
+            nhyps = len(batch[0].hyp_ids)
+            deadline = time.time() + args.maxwait / 1000.0
+            while nhyps < args.maxbatch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    req = requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(req)
+                nhyps += len(req.hyp_ids)
+            try:
+                score_batch(model, FLvmodel, batch)
+            except Exception as err:
+                logging('Batch failed: ' + repr(err))
+                for req in batch:
+                    req.result = {'error': repr(err)}
+            for req in batch:
+                req.done.set()
+
+class RescoreHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            req = Request(json.loads(self.rfile.read(length).decode('utf8')))
+        except (ValueError, KeyError, IndexError) as err:
+            self.reply(400, {'error': repr(err)})
+            return
+        if req.hyp_ids == []:
+            self.reply(400, {'error': 'empty n-best list'})
+            return
+        self.server.requests.put(req)
+        req.done.wait()
+        self.reply(500 if 'error' in req.result else 200, req.result)
+
+    def reply(self, code, result):
+        body = json.dumps(result).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *log_args):
+        pass
+
+if __name__ == "__main__":
+    model, FLvmodel = readin_models()
+    server = ThreadingHTTPServer((args.host, args.port), RescoreHandler)
+    server.requests = queue.Queue()
+    worker = threading.Thread(target=batching_loop, args=(model, FLvmodel, server.requests), daemon=True)
+    worker.start()
+    logging('Rescoring server listening on {}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging('Server stopped')
@@ -0,0 +1,116 @@
+"""
+Columnar store of the raw per-hypothesis scores produced by jointforward.py
+(--savescores), so that rnnscale, gscale and factor can be tuned without
+forwarding the neural LMs again. See rerank.py.
+Per hypothesis: acoustic score, n-best LM score, RNN log-prob and the RNN
+and n-gram per-token log-probs (n-gram ones unscaled, as in the stream files)
+Re-ranking is exact when every hypothesis is scored from a zero state. With
+--interp and a reset=0 model, jointforward.py carries the hidden state of each
+1-best into the next utterance, so the scores depend on the weights they were
+saved at; such stores are marked and rerank.py refuses to sweep them.
+"""
+import sys, os
+
+import numpy as np
+
+import binstore
+
+MAGIC = b'HYPSCR01'
+
+class ScoreWriter(object):
+    def __init__(self, carried_state=False):
+        '''carried_state: the hypotheses were scored from the state of the
+           previous 1-best, not from a zero state'''
+        self.carried_state = carried_state
+        self.names = []
+        self.nhyps = []
+        self.ac_scores = []
+        self.lm_scores = []
+        self.rnn_tokens = []
+        self.ngram_tokens = []
+        self.words = []
+
+    def add_utterance(self, name, ac_scores, lm_scores, rnn_tokens, words, ngram_tokens=None):
+        '''rnn_tokens, ngram_tokens: per hypothesis arrays of token log-probs'''
+        self.names.append(name)
+        self.nhyps.append(len(ac_scores))
+        self.ac_scores += list(ac_scores)
+        self.lm_scores += list(lm_scores)
+        self.rnn_tokens += [np.asarray(tokens, dtype=np.float32) for tokens in rnn_tokens]
+        if ngram_tokens is not None:
+            self.ngram_tokens += [np.asarray(tokens, dtype=np.float32) for tokens in ngram_tokens]
+        self.words += [' '.join(utterance) for utterance in words]
+
+    def save(self, path):
+        token_lens = [len(tokens) for tokens in self.rnn_tokens]
+        arrays = [
+            ('utt_offsets', np.cumsum([0] + self.nhyps).astype(np.int64)),
+            ('ac_scores', np.array(self.ac_scores, dtype=np.float64)),
+            ('lm_scores', np.array(self.lm_scores, dtype=np.float64)),
+            ('token_offsets', np.cumsum([0] + token_lens).astype(np.int64)),
+            ('rnn_tokens', np.concatenate(self.rnn_tokens or [np.zeros(0, dtype=np.float32)]))]
+        if self.ngram_tokens:
+            arrays.append(('ngram_tokens', np.concatenate(self.ngram_tokens)))
+        words = [utterance.encode('utf8') for utterance in self.words]
+        names = [name.encode('utf8') for name in self.names]
+        arrays += [
+            ('word_offsets', np.cumsum([0] + [len(w) for w in words]).astype(np.int64)),
+            ('words', np.frombuffer(b''.join(words), dtype=np.uint8)),
+            ('name_offsets', np.cumsum([0] + [len(n) for n in names]).astype(np.int64)),
+            ('names', np.frombuffer(b''.join(names), dtype=np.uint8))]
+        binstore.save(path, MAGIC, arrays, meta={'carried_state': self.carried_state})
+
+class ScoreStore(object):
+    def __init__(self, path):
+        arrays, meta = binstore.load(path, MAGIC)
+        self.utt_offsets = arrays['utt_offsets']
+        self.ac_scores = arrays['ac_scores']
+        self.lm_scores = arrays['lm_scores']
+        self.token_offsets = arrays['token_offsets']
+        self.rnn_tokens = arrays['rnn_tokens']
+        self.ngram_tokens = arrays.get('ngram_tokens')
+        self.word_offsets = arrays['word_offsets']
+        self.words_blob = arrays['words']
+        self.name_offsets = arrays['name_offsets']
+        self.names_blob = arrays['names']
+        self.carried_state = meta.get('carried_state', False)
+
+    def __len__(self):
+        return len(self.utt_offsets) - 1
+
+    def nhyps_total(self):
+        return len(self.ac_scores)
+
+    def name(self, utt_idx):
+        start, end = self.name_offsets[utt_idx], self.name_offsets[utt_idx+1]
+        return self.names_blob[start:end].tobytes().decode('utf8')
+
+    def words(self, hyp):
+        '''Words of a hypothesis, indexed over the whole set'''
+        start, end = self.word_offsets[hyp], self.word_offsets[hyp+1]
+        return self.words_blob[start:end].tobytes().decode('utf8').split()
+
+    def rnn_scores(self):
+        '''Negative RNN log-prob of every hypothesis'''
+        return -segment_sum(self.rnn_tokens.astype(np.float64), self.token_offsets)
+
+class BestPicker(object):
+    '''Per-utterance argmax over a padded [nutt, maxhyp] view of the hypotheses'''
+    def __init__(self, utt_offsets):
+        counts = np.diff(utt_offsets)
+        self.nutt = len(counts)
+        self.maxhyp = int(counts.max()) if self.nutt > 0 else 0
+        self.utt_start = utt_offsets[:-1]
+        self.utt_of_hyp = np.repeat(np.arange(self.nutt), counts)
+        self.pos = np.arange(utt_offsets[-1]) - self.utt_start[self.utt_of_hyp]
+
+    def __call__(self, total_scores):
+        '''total_scores: [npoints, nhyp], returns [npoints, nutt] best hypothesis indices'''
+        padded = np.full((total_scores.shape[0], self.nutt, self.maxhyp), -np.inf)
+        padded[:, self.utt_of_hyp, self.pos] = total_scores
+        return padded.argmax(2) + self.utt_start
+
+def segment_sum(values, offsets):
+    '''Sum values over [offsets[i], offsets[i+1]), empty segments give 0'''
+    cumulative = np.concatenate([[0.0], np.cumsum(values)])
+    return cumulative[offsets[1:]] - cumulative[offsets[:-1]]
@@ -0,0 +1,133 @@
+# coding: utf-8
+"""
+Sparse gradient training of the word embeddings (--sparseemb in
+train_with_dataloader.py and jointtrain_singleseg.py).
+With nn.Embedding(sparse=True) the embedding gradient only holds the rows of
+the batch. SparseEmbeddingSGD updates those rows alone; the weight decay the
+other rows would have received at every step is accumulated and applied when
+a row is used again or at flush(), so after a flush the weights match dense
+SGD with weight_decay.
+
+Run as a script to benchmark dense against sparse steps.
+"""
+import argparse
+import math
+import time
+
+import torch
+
+def split_parameters(model, embedding):
+    '''Parameters of model other than the embedding weight'''
+    return [p for p in model.parameters() if p is not embedding.weight]
+
+def clip_grad_norm(parameters, max_norm):
+    '''clip_grad_norm_ that also accepts sparse gradients'''
+    parameters = [p for p in parameters if p.grad is not None]
+    norms = []
+    for p in parameters:
+        if p.grad.is_sparse:
+            p.grad = p.grad.coalesce()
+            norms.append(p.grad._values().norm())
+        else:
+            norms.append(p.grad.norm())
+    if norms == []:
+        return torch.tensor(0.)
+    total_norm = torch.stack([norm.float().to(norms[0].device) for norm in norms]).norm()
+    clip_coef = max_norm / (float(total_norm) + 1e-6)
+    if clip_coef < 1:
+        for p in parameters:
+            p.grad.mul_(clip_coef)
+    return total_norm
+
+class SparseEmbeddingSGD(object):
+    '''SGD with lazily applied weight decay for the weight of an
+       nn.Embedding(sparse=True)'''
+    def __init__(self, embedding, lr, weight_decay=0):
+        self.weight = embedding.weight
+        self.lr = lr
+        self.weight_decay = weight_decay
+        # sum of log(1 - lr*weight_decay) over the steps, and its value when
+        # each row was last brought up to date
+        self.log_decay = 0.0
+        self.stamp = torch.zeros(self.weight.size(0), dtype=torch.float64, device=self.weight.device)
+        if lr * weight_decay >= 1:
+            raise ValueError('lr * weight_decay must be below 1 for the lazy weight decay')
+
+    def zero_grad(self):
+        self.weight.grad = None
+
+    def catch_up(self, rows):
+        '''Applies the pending weight decay of rows'''
+        scale = torch.exp(self.log_decay - self.stamp[rows]).to(self.weight.dtype)
+        self.weight.data[rows] *= scale.unsqueeze(1)
+        self.stamp[rows] = self.log_decay
+
+    def step(self):
+        grad = self.weight.grad
+        decay = 1 - self.lr * self.weight_decay
+        with torch.no_grad():
+            if grad is not None:
+                grad = grad.coalesce()
+                rows = grad._indices()[0]
+                if self.weight_decay:
+                    self.catch_up(rows)
+                    self.weight.data[rows] = decay * self.weight.data[rows] - self.lr * grad._values()
+                else:
+                    self.weight.data.index_add_(0, rows, grad._values(), alpha=-self.lr)
+            if self.weight_decay:
+                self.log_decay += math.log(decay)
+                if grad is not None:
+                    self.stamp[rows] = self.log_decay
+
+    def flush(self):
+        '''Applies the pending weight decay of all rows'''
+        if self.weight_decay:
+            with torch.no_grad():
+                self.catch_up(torch.arange(self.weight.size(0), device=self.weight.device))
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+def benchmark(ntoken, ninp, nrows, steps, device, lr=1.0, wdecay=1e-4):
+    '''ms per step of dense SGD and of SparseEmbeddingSGD on an embedding
+       layer whose batches use nrows random rows, and the max weight difference'''
+    dense = torch.nn.Embedding(ntoken, ninp).to(device)
+    sparse = torch.nn.Embedding(ntoken, ninp, sparse=True).to(device)
+    sparse.weight.data.copy_(dense.weight.data)
+    batches = [torch.randint(ntoken, (nrows,), device=device) for i in range(steps)]
+    dense_opt = torch.optim.SGD(dense.parameters(), lr=lr, weight_decay=wdecay)
+    sparse_opt = SparseEmbeddingSGD(sparse, lr, wdecay)
+    times = []
+    for layer, opt in [(dense, dense_opt), (sparse, sparse_opt)]:
+        sync(device)
+        start = time.time()
+        for input in batches:
+            opt.zero_grad()
+            layer(input).pow(2).sum().backward()
+            opt.step()
+        if opt is sparse_opt:
+            opt.flush()
+        sync(device)
+        times.append((time.time() - start) * 1000 / steps)
+    return times[0], times[1], float((dense.weight - sparse.weight).abs().max())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark sparse embedding updates')
+    parser.add_argument('--vocabs', type=str, default='13080 50000 200000',
+                        help='vocabulary sizes')
+    parser.add_argument('--emsize', type=int, default=256,
+                        help='embedding dimension')
+    parser.add_argument('--nrows', type=int, default=700,
+                        help='word positions per batch (bptt x batch size)')
+    parser.add_argument('--steps', type=int, default=50,
+                        help='timed steps')
+    parser.add_argument('--cuda', action='store_true',
+                        help='use CUDA')
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+    for ntoken in [int(v) for v in args.vocabs.split()]:
+        dense_ms, sparse_ms, diff = benchmark(ntoken, args.emsize, args.nrows, args.steps, device)
+        print('| vocab {:7d} | dense ms/step {:8.3f} | sparse ms/step {:8.3f} | speed-up {:5.2f} | max diff {:.2e} |'.format(
+            ntoken, dense_ms, sparse_ms, dense_ms / sparse_ms, diff))
@@ -10,6 +10,8 @@ from operator import itemgetter
 
 import dataloader
 import model
+import sparseemb
+import precision
 
 arglist = []
 parser = argparse.ArgumentParser(description='PyTorch Wikitext-2 RNN/LSTM Language Model')
@@ -43,8 +45,19 @@ parser.add_argument('--rnndrop', type=float, default=0.2,
                     help='dropout applied to rnns (0 = no dropout)')
 parser.add_argument('--tied', action='store_true',
                     help='tie the word embedding and softmax weights')
+parser.add_argument('--amp', type=str, default='fp32', choices=precision.AMP_MODES,
+                    help='bf16: LSTM and decoder matmuls under bfloat16 autocast, loss and weights in fp32')
+parser.add_argument('--cechunk', type=int, default=0,
+                    help='decode and compute the loss this many positions at a time, recomputing in backward (0 = off)')
+parser.add_argument('--sparseemb', action='store_true',
+                    help='sparse word embedding gradients, only the rows of each batch are updated')
 parser.add_argument('--evalmode', action='store_true',
                     help='Evaluation only mode')
+parser.add_argument('--projtable', action='store_true',
+                    help='test/valid evaluation of --reset 1 models: gather the LSTM input projection '
+                         'of each word from a vocabulary table')
+parser.add_argument('--projhalf', action='store_true',
+                    help='store the --projtable table in float16')
 parser.add_argument('--seed', type=int, default=1111,
                     help='random seed')
 parser.add_argument('--cuda', action='store_true',
@@ -148,6 +161,10 @@ if args.stream_out and eval_batch_size != 1:
 ###############################################################################
 ntokens = len(dictionary)
 model = model.RNNModel(args.model, ntokens, args.emsize, args.nhid, args.nlayers, args.rnndrop, args.dropout, args.tied, reset=args.reset)
+if args.sparseemb:
+    if args.tied:
+        raise ValueError('--sparseemb cannot be combined with --tied, the decoder gradient is dense')
+    model.encoder.sparse = True
 criterion = nn.CrossEntropyLoss()
 interpCrit = nn.CrossEntropyLoss(reduction='none')
 
@@ -199,9 +216,13 @@ def evaluate(data_source, ngramProb=None):
                 _, batch_ngramProb = get_batch(ngramProb, i)
             # gs534 add sentence resetting
             eosidx = dictionary.get_eos()
-            output, hidden = model(data, hidden, separate=args.reset, eosidx=eosidx)
-            output_flat = output.view(-1, ntokens)
-            logProb = interpCrit(output.view(-1, ntokens), targets)
+            with precision.autocast(device, args.amp):
+                if args.cechunk > 0:
+                    output, hidden = model(data, hidden, separate=args.reset, eosidx=eosidx, outputflag=1)
+                    logProb = model.decode_loss(output, targets, args.cechunk)
+                else:
+                    output, hidden = model(data, hidden, separate=args.reset, eosidx=eosidx)
+                    logProb = interpCrit(output.view(-1, ntokens).float(), targets)
             rnnProbs = torch.exp(-logProb)
             if args.interp and args.evalmode:
                 final_prob = args.factor * rnnProbs + (1 - args.factor) * batch_ngramProb
@@ -221,7 +242,13 @@ def train(model, train_data, lr):
     start_time = time.time()
     ntokens = len(dictionary)
     hidden = model.init_hidden(args.batch_size)
-    optimizer = torch.optim.SGD(model.parameters(), lr=lr, weight_decay=args.wdecay)
+    if args.sparseemb:
+        # the embedding rows of each batch are updated separately
+        optimizer = torch.optim.SGD(sparseemb.split_parameters(model, model.encoder), lr=lr,
+                                    weight_decay=args.wdecay)
+        embOptimizer = sparseemb.SparseEmbeddingSGD(model.encoder, lr, weight_decay=args.wdecay)
+    else:
+        optimizer = torch.optim.SGD(model.parameters(), lr=lr, weight_decay=args.wdecay)
     # optimizer = torch.optim.Adam(model.parameters(), lr=lr)
     for batch, i in enumerate(range(0, train_data.size(0) - 1, args.bptt)):
         data, targets = get_batch(train_data, i)
@@ -231,16 +258,24 @@ def train(model, train_data, lr):
         model.zero_grad()
         # gs534 add sentence resetting
         eosidx = dictionary.get_eos()
-        if args.loss == 'nce':
-            output, hidden = model(data, hidden, eosidx, targets)
-            loss = criterion(output)
-            loss.backward()
-        else:
-            output, hidden = model(data, hidden, separate=args.reset, eosidx=eosidx)
-            loss = criterion(output.view(-1, ntokens), targets)
-            loss.backward()
+        with precision.autocast(device, args.amp):
+            if args.loss == 'nce':
+                output, hidden = model(data, hidden, eosidx, targets)
+                loss = criterion(output)
+            elif args.cechunk > 0:
+                output, hidden = model(data, hidden, separate=args.reset, eosidx=eosidx, outputflag=1)
+                loss = model.decode_loss(output, targets, args.cechunk).mean()
+            else:
+                output, hidden = model(data, hidden, separate=args.reset, eosidx=eosidx)
+                # log-softmax and loss in fp32
+                loss = criterion(output.view(-1, ntokens).float(), targets)
+        loss.backward()
         # `clip_grad_norm` helps prevent the exploding gradient problem in RNNs / LSTMs.
-        torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
+        if args.sparseemb:
+            sparseemb.clip_grad_norm(model.parameters(), args.clip)
+            embOptimizer.step()
+        else:
+            torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
         #for p in model.parameters():
         #    p.data.add_(-lr, p.grad.data)
         optimizer.step()
@@ -256,6 +291,9 @@ def train(model, train_data, lr):
                 elapsed * 1000 / args.log_interval, cur_loss, math.exp(cur_loss)))
             total_loss = 0
             start_time = time.time()
+    if args.sparseemb:
+        # bring the rows no batch touched up to date before evaluation
+        embOptimizer.flush()
 
 
 def export_onnx(path, batch_size, seq_len):
@@ -321,6 +359,9 @@ with open(args.save, 'rb') as f:
     # after load the rnn params are not a continuous chunk of memory
     # this makes them a continuous chunk, and will speed up forward pass
     model.rnn.flatten_parameters()
+if args.projtable:
+    # only used by the per-step reset loop, see RNNModel.set_projection_table
+    model.set_projection_table(half=args.projhalf)
 
 # Set cpu evaluate mode
 device = torch.device("cuda")
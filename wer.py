@@ -0,0 +1,217 @@
+# coding: utf-8
+"""
+Word error rate scoring of rescoring output without sclite.
+Reads the .1best MLF written by jointforward.py / rerank.py and a reference
+MLF or STM, aligns every utterance with a row-vectorised Levenshtein DP in a
+process pool, and writes an sclite-style detailed report whose confusion,
+insertion and deletion sections ErrorSampling.build_confusion can read.
+"""
+import argparse
+import sys, os
+from collections import Counter, OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+
+def normalise(word):
+    # MLFs escape words starting with a quote
+    if word[0] == '\\':
+        word = word[1:]
+    return word
+
+def read_mlf(path):
+    '''Returns an ordered dict of utterance name (no extension) -> words'''
+    utts = OrderedDict()
+    current = None
+    with open(path) as fin:
+        for line in fin:
+            line = line.strip()
+            if line == '' or line[0] == '#':
+                continue
+            if line[0] == '\"':
+                current = os.path.splitext(line.strip('\"'))[0]
+                utts[current] = []
+            elif line == '.':
+                current = None
+            elif current is not None:
+                # either "WORD" or "start end WORD [score]"
+                elems = line.split()
+                word = elems[2] if len(elems) >= 3 and elems[0].isdigit() and elems[1].isdigit() else elems[0]
+                utts[current].append(normalise(word))
+    return utts
+
+def read_stm(path):
+    '''STM lines: file channel speaker start end [<label>] words, keyed by speaker
+       field which stm_gen.py fills with the AMI segment name'''
+    utts = OrderedDict()
+    with open(path) as fin:
+        for line in fin:
+            elems = line.split()
+            if elems == [] or elems[0].startswith(';;'):
+                continue
+            words = elems[5:]
+            if words != [] and words[0][0] == '<':
+                words = words[1:]
+            utts[elems[2]] = [normalise(word) for word in words]
+    return utts
+
+def read_reference(path):
+    if path.endswith('.stm'):
+        return read_stm(path)
+    return read_mlf(path)
+
+def edit_distance_matrix(ref, hyp):
+    '''ref, hyp: int arrays. Each row is computed with numpy: substitutions and
+       deletions elementwise, insertions as a running minimum along the row'''
+    n, m = len(ref), len(hyp)
+    D = np.zeros((n+1, m+1), dtype=np.int64)
+    steps = np.arange(m+1)
+    D[0] = steps
+    row = np.empty(m+1, dtype=np.int64)
+    for i in range(1, n+1):
+        row[0] = i
+        row[1:] = np.minimum(D[i-1, 1:] + 1, D[i-1, :-1] + (hyp != ref[i-1]))
+        D[i] = np.minimum.accumulate(row - steps) + steps
+    return D
+
+def align(ref, hyp):
+    '''Returns the alignment as a list of (op, ref word, hyp word), op in C/S/D/I'''
+    vocab = {}
+    ref_ids = np.array([vocab.setdefault(word, len(vocab)) for word in ref], dtype=np.int64)
+    hyp_ids = np.array([vocab.setdefault(word, len(vocab)) for word in hyp], dtype=np.int64)
+    D = edit_distance_matrix(ref_ids, hyp_ids)
+    i, j = len(ref), len(hyp)
+    alignment = []
+    while i > 0 or j > 0:
+        if i > 0 and j > 0 and D[i, j] == D[i-1, j-1] + (ref[i-1] != hyp[j-1]):
+            alignment.append(('C' if ref[i-1] == hyp[j-1] else 'S', ref[i-1], hyp[j-1]))
+            i, j = i - 1, j - 1
+        elif i > 0 and D[i, j] == D[i-1, j] + 1:
+            alignment.append(('D', ref[i-1], None))
+            i -= 1
+        else:
+            alignment.append(('I', None, hyp[j-1]))
+            j -= 1
+    alignment.reverse()
+    return alignment
+
+def align_utterance(pair):
+    name, ref, hyp = pair
+    return name, len(ref), len(hyp), align(ref, hyp)
+
+class ErrorCounts(object):
+    def __init__(self):
+        self.nsent = 0
+        self.sent_err = Counter()
+        self.nref = 0
+        self.nhyp = 0
+        self.ops = Counter()
+        self.confusions = Counter()
+        self.insertions = Counter()
+        self.deletions = Counter()
+        self.substitutions = Counter()
+
+    def add(self, nref, nhyp, alignment):
+        self.nsent += 1
+        self.nref += nref
+        self.nhyp += nhyp
+        sent_ops = Counter(op for op, _, _ in alignment)
+        self.ops.update(sent_ops)
+        if sent_ops['S'] + sent_ops['D'] + sent_ops['I'] > 0:
+            self.sent_err['err'] += 1
+        for op in ['S', 'D', 'I']:
+            if sent_ops[op] > 0:
+                self.sent_err[op] += 1
+        for op, refword, hypword in alignment:
+            if op == 'S':
+                self.confusions[(refword, hypword)] += 1
+                self.substitutions[refword] += 1
+            elif op == 'D':
+                self.deletions[refword] += 1
+            elif op == 'I':
+                self.insertions[hypword] += 1
+
+    def errors(self):
+        return self.ops['S'] + self.ops['D'] + self.ops['I']
+
+    def wer(self):
+        return 100.0 * self.errors() / max(1, self.nref)
+
+    def summary(self):
+        return 'WER {:5.2f}% [ {} / {}, {} sub, {} del, {} ins ]'.format(
+            self.wer(), self.errors(), self.nref, self.ops['S'], self.ops['D'], self.ops['I'])
+
+def score(refs, hyps, nj=1, chunksize=64):
+    '''refs, hyps: dicts name -> words. Utterances missing from hyps count as deleted'''
+    pairs = [(name, ref, hyps.get(name, [])) for name, ref in refs.items()]
+    counts = ErrorCounts()
+    if nj > 1:
+        with Pool(nj) as pool:
+            for name, nref, nhyp, alignment in pool.imap(align_utterance, pairs, chunksize):
+                counts.add(nref, nhyp, alignment)
+    else:
+        for pair in pairs:
+            name, nref, nhyp, alignment = align_utterance(pair)
+            counts.add(nref, nhyp, alignment)
+    return counts
+
+def percent(n, total):
+    return '{:5.1f}%'.format(100.0 * n / max(1, total))
+
+def write_ranked(fout, title, counter, fmt):
+    fout.write('{:<33s}Total                 ({})\n'.format(title, len(counter)))
+    fout.write('{:<33s}With >=  1 occurances ({})\n\n'.format('', len(counter)))
+    for rank, (key, count) in enumerate(sorted(counter.items(), key=lambda x: (-x[1], x[0]))):
+        fout.write('{:4d}: {:4d}  ->  {}\n'.format(rank+1, count, fmt(key)))
+    fout.write('     {}\n\n\n\n'.format(sum(counter.values())))
+
+def write_report(outfile, system, counts):
+    '''Same section layout as the sclite dtl report used for confusions.txt'''
+    S, D, I = counts.ops['S'], counts.ops['D'], counts.ops['I']
+    with open(outfile, 'w') as fout:
+        fout.write('DETAILED OVERALL REPORT FOR THE SYSTEM: {}\n\n'.format(system))
+        fout.write('SENTENCE RECOGNITION PERFORMANCE\n\n')
+        fout.write(' sentences                                        {}\n'.format(counts.nsent))
+        fout.write(' with errors                            {}   ({})\n\n'.format(
+            percent(counts.sent_err['err'], counts.nsent), counts.sent_err['err']))
+        for name, op in [('substitions', 'S'), ('deletions', 'D'), ('insertions', 'I')]:
+            fout.write('   with {:<33s}{}   ({})\n'.format(
+                name, percent(counts.sent_err[op], counts.nsent), counts.sent_err[op]))
+        fout.write('\n\nWORD RECOGNITION PERFORMANCE\n\n')
+        fout.write('Percent Total Error       = {}   ({})\n\n'.format(percent(S+D+I, counts.nref), S+D+I))
+        fout.write('Percent Correct           = {}   ({})\n\n'.format(
+            percent(counts.ops['C'], counts.nref), counts.ops['C']))
+        fout.write('Percent Substitution      = {}   ({})\n'.format(percent(S, counts.nref), S))
+        fout.write('Percent Deletions         = {}   ({})\n'.format(percent(D, counts.nref), D))
+        fout.write('Percent Insertions        = {}   ({})\n'.format(percent(I, counts.nref), I))
+        fout.write('Percent Word Accuracy     = {}\n\n\n'.format(percent(counts.nref-S-D-I, counts.nref)))
+        fout.write('Ref. words                =           ({})\n'.format(counts.nref))
+        fout.write('Hyp. words                =           ({})\n'.format(counts.nhyp))
+        fout.write('Aligned words             =           ({})\n\n'.format(sum(counts.ops.values())))
+        write_ranked(fout, 'CONFUSION PAIRS', counts.confusions, lambda pair: '{} ==> {}'.format(*pair))
+        write_ranked(fout, 'INSERTIONS', counts.insertions, str)
+        write_ranked(fout, 'DELETIONS', counts.deletions, str)
+        write_ranked(fout, 'SUBSTITUTIONS', counts.substitutions, str)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Score a 1-best MLF against reference labels')
+    parser.add_argument('--hyp', type=str, required=True,
+                        help='1-best MLF written by jointforward.py or rerank.py')
+    parser.add_argument('--ref', type=str, default='data/AMI/dev.ref.mlf',
+                        help='reference MLF or STM file')
+    parser.add_argument('--report', type=str, default='',
+                        help='detailed report file, defaults to <hyp>.dtl')
+    parser.add_argument('--nj', type=int, default=4,
+                        help='number of alignment processes')
+    args = parser.parse_args()
+
+    refs = read_reference(args.ref)
+    hyps = read_mlf(args.hyp)
+    missing = sum(1 for name in hyps if name not in refs)
+    if missing > 0:
+        print('{} hypothesis utterances have no reference and are ignored'.format(missing))
+    counts = score(refs, hyps, args.nj)
+    report = args.report if args.report else args.hyp + '.dtl'
+    write_report(report, args.hyp, counts)
+    print(counts.summary())
+    print('Detailed report written to ' + report)